@@ -5,7 +5,8 @@ import sys
 __all__ = [
     "FieldError",
     "StreamError",
-    "StreamRuntimeError"
+    "StreamRuntimeError",
+    "StreamStallError"
 ]
 
 class FieldError(Exception):
@@ -16,6 +17,23 @@ class StreamError(Exception):
     """Exception raised on stream."""
     pass
 
+class StreamStallError(StreamError):
+    """Exception raised when a stream was aborted because there was no
+    progress for longer than the stall timeout.
+
+    Attributes:
+        * `report`: text report about state of nodes, pipes and threads
+        * `cycles`: list of cycles of nodes waiting for each other
+    """
+    def __init__(self, message=None, report=None, cycles=None):
+        super(StreamStallError, self).__init__(message)
+        self.report = report
+        self.cycles = cycles or []
+
+    def __str__(self):
+        message = self.args[0] if self.args else None
+        return "%s\n%s" % (message or "", self.report)
+
 class StreamRuntimeError(Exception):
     """Exception raised when a node fails during `run()` phase.
 
@@ -11,6 +11,7 @@ from brewery.ds.stream_auditor import *
 from brewery.ds.yaml_dir_streams import *
 from brewery.ds.sql_streams import *
 from brewery.ds.html_target import *
+from brewery.ds.async_streams import *
 
 __all__ = (
     "Field",
@@ -31,6 +32,15 @@ __all__ = (
     "YamlDirectoryDataTarget",
     "SQLDataSource",
     "SQLDataTarget",
+    "SQLResultCache",
+    "sql_engine",
+    "reflected_table",
+    "forget_table",
+    "clear_sql_caches",
     "StreamAuditor",
-    "SimpleHTMLDataTarget"
+    "SimpleHTMLDataTarget",
+    "AsyncDataSource",
+    "AsyncDataTarget",
+    "AsyncSourceAdapter",
+    "AsyncTargetAdapter"
 )
@@ -0,0 +1,392 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Asynchronous data sources and targets.
+
+Synchronous streams do one thing at a time: a source node waits for a fetch
+to complete before it asks for the next one, a target node waits for every
+write. Asynchronous streams issue requests to a shared pool of I/O threads
+and keep more of them in flight at once:
+
+* :class:`AsyncDataSource` splits reading into independent *requests* (for
+  example pages of a REST resource or ranges of a collection). Up to
+  `max_in_flight` requests are being fetched at once, rows are yielded in
+  request order.
+* :class:`AsyncDataTarget` writes rows in batches with :meth:`append_many`,
+  which returns a :class:`Future`. Up to `max_in_flight` batches are being
+  written at once.
+
+Both are regular data streams, they are used by the :class:`StreamSourceNode`
+and :class:`StreamTargetNode` as any other stream. When the stream is run by
+the cooperative scheduler (``Stream.run(scheduler="cooperative")``) a node
+waiting for a :class:`Future` yields to other nodes of its worker, therefore
+many I/O nodes might share one thread.
+
+Existing synchronous streams can be used through :class:`AsyncSourceAdapter`
+(reads ahead in background) and :class:`AsyncTargetAdapter` (writes in
+background).
+"""
+
+import threading
+import collections
+import sys
+import Queue
+import base
+
+__all__ = (
+    "Future",
+    "IOExecutor",
+    "default_executor",
+    "AsyncDataSource",
+    "AsyncDataTarget",
+    "AsyncSourceAdapter",
+    "AsyncTargetAdapter"
+)
+
+class Future(object):
+    """Result of an asynchronous operation."""
+
+    def __init__(self):
+        self._done = False
+        self._result = None
+        self._exc_info = None
+        self._waiters = []
+        self._lock = threading.Lock()
+
+    def done(self):
+        """Returns `True` if the operation is finished."""
+        return self._done
+
+    def set_result(self, result):
+        self._finish(result, None)
+
+    def set_exception(self, exc_info):
+        """Set exception of the operation. `exc_info` is a tuple as returned
+        by ``sys.exc_info()``."""
+        self._finish(None, exc_info)
+
+    def _finish(self, result, exc_info):
+        with self._lock:
+            self._result = result
+            self._exc_info = exc_info
+            self._done = True
+            waiters = self._waiters
+            self._waiters = []
+
+        for waiter in waiters:
+            waiter.wake()
+
+    def exception(self):
+        """Wait for the operation and return its exception or `None`."""
+        self._wait()
+        if self._exc_info:
+            return self._exc_info[1]
+        return None
+
+    def result(self):
+        """Wait for the operation and return its result. Exception raised by
+        the operation is re-raised."""
+        self._wait()
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def _wait(self):
+        # Waiter of a cooperative task yields to the scheduler, others block
+        from brewery.scheduler import current_waiter
+
+        while True:
+            with self._lock:
+                if self._done:
+                    return
+                waiter = current_waiter()
+                self._waiters.append(waiter)
+            waiter.wait()
+
+class IOExecutor(object):
+    """Pool of threads executing blocking I/O calls."""
+
+    def __init__(self, threads=8):
+        """Creates an executor.
+
+        :Parameters:
+            * `threads` - maximal number of I/O threads, default is 8. Threads
+              are created on demand and run until the process ends.
+        """
+        super(IOExecutor, self).__init__()
+
+        self.max_threads = threads
+        self.threads = []
+        self._queue = Queue.Queue()
+        self._idle = 0
+        self._queued = 0
+        self._lock = threading.Lock()
+
+    def submit(self, function, *args, **kwargs):
+        """Schedule `function` to be called with `args` and `kwargs` by one
+        of the I/O threads. Returns a :class:`Future`."""
+        future = Future()
+
+        with self._lock:
+            self._queued += 1
+            if self._queued > self._idle \
+                    and len(self.threads) < self.max_threads:
+                thread = threading.Thread(target=self._work,
+                                name="brewery-io-%d" % len(self.threads))
+                thread.daemon = True
+                self.threads.append(thread)
+                self._idle += 1
+                thread.start()
+
+        self._queue.put((future, function, args, kwargs))
+        return future
+
+    def _work(self):
+        while True:
+            (future, function, args, kwargs) = self._queue.get()
+            with self._lock:
+                self._queued -= 1
+                self._idle -= 1
+            try:
+                future.set_result(function(*args, **kwargs))
+            except Exception:
+                future.set_exception(sys.exc_info())
+            with self._lock:
+                self._idle += 1
+
+_default_executor = None
+_executor_lock = threading.Lock()
+
+def default_executor():
+    """Returns process-wide :class:`IOExecutor` shared by all asynchronous
+    streams which were not given an executor explicitly."""
+    global _default_executor
+
+    with _executor_lock:
+        if _default_executor is None:
+            _default_executor = IOExecutor()
+        return _default_executor
+
+class AsyncDataSource(base.DataSource):
+    """Data source which reads data with independent requests executed
+    concurrently. Subclasses should implement :meth:`requests`."""
+
+    def __init__(self, max_in_flight=4, executor=None):
+        """Creates an asynchronous data source.
+
+        :Attributes:
+            * `max_in_flight` - number of requests being executed at once,
+              default is 4
+            * `executor` - :class:`IOExecutor` for the requests, default is
+              the shared executor
+        """
+        super(AsyncDataSource, self).__init__()
+        self.max_in_flight = max_in_flight
+        self.executor = executor
+        self.fields = None
+
+    def requests(self):
+        """Return iterable of requests. Request is a callable without
+        arguments returning a list of rows. Requests are called from the I/O
+        threads, might be called concurrently and should not depend on each
+        other. The iterable is consumed lazily, as the requests are
+        submitted."""
+        raise NotImplementedError()
+
+    def rows(self):
+        executor = self.executor or default_executor()
+        pending = collections.deque()
+        requests = iter(self.requests())
+
+        def submit():
+            while requests and len(pending) < self.max_in_flight:
+                request = next(requests, None)
+                if request is None:
+                    return None
+                pending.append(executor.submit(request))
+            return requests
+
+        try:
+            requests = submit()
+            while pending:
+                rows = pending.popleft().result()
+                # Next request is executed while the rows are processed
+                requests = submit()
+                for row in rows:
+                    yield row
+        finally:
+            # Do not wait for the requests of an abandoned iterator
+            pending.clear()
+
+    def records(self):
+        names = self.fields.names()
+        for row in self.rows():
+            yield dict(zip(names, row))
+
+class AsyncDataTarget(base.DataTarget):
+    """Data target which writes batches of rows concurrently. Subclasses
+    should implement :meth:`write_batch`."""
+
+    def __init__(self, batch_size=1000, max_in_flight=4, executor=None):
+        """Creates an asynchronous data target.
+
+        :Attributes:
+            * `batch_size` - number of rows collected by :meth:`append`
+              before they are written, default is 1000
+            * `max_in_flight` - number of batches being written at once,
+              default is 4. Use 1 if the target requires ordered writes.
+            * `executor` - :class:`IOExecutor` for the writes, default is
+              the shared executor
+        """
+        super(AsyncDataTarget, self).__init__()
+        self.batch_size = batch_size
+        self.max_in_flight = max_in_flight
+        self.executor = executor
+        self.fields = None
+
+        self._buffer = []
+        self._pending = collections.deque()
+
+    def write_batch(self, rows):
+        """Write list of rows. Called from the I/O threads, might be called
+        concurrently unless `max_in_flight` is 1."""
+        raise NotImplementedError()
+
+    def append(self, obj):
+        if type(obj) == dict:
+            obj = [obj.get(name) for name in self.fields.names()]
+
+        self._buffer.append(obj)
+        if len(self._buffer) >= self.batch_size:
+            rows = self._buffer
+            self._buffer = []
+            self.append_many(rows)
+
+    def append_many(self, rows):
+        """Write list of `rows` asynchronously, returns a :class:`Future`.
+        Waits for the oldest pending write if there are `max_in_flight` of
+        them already. Failed write is raised by the next call of
+        :meth:`append_many` or :meth:`flush`."""
+        self._wait(self.max_in_flight - 1)
+
+        executor = self.executor or default_executor()
+        future = executor.submit(self.write_batch, list(rows))
+        self._pending.append(future)
+        return future
+
+    def _wait(self, count):
+        """Wait until at most `count` writes are pending. Raises exception of
+        a failed write."""
+        while len(self._pending) > count:
+            future = self._pending.popleft()
+            future.result()
+
+        # Report failures early
+        while self._pending and self._pending[0].done():
+            self._pending.popleft().result()
+
+    def flush(self):
+        """Write buffered rows and wait for all pending writes."""
+        if self._buffer:
+            rows = self._buffer
+            self._buffer = []
+            self.append_many(rows)
+
+        self._wait(0)
+
+    def finalize(self):
+        self.flush()
+
+class AsyncSourceAdapter(AsyncDataSource):
+    """Reads rows of a synchronous data source in background, in batches.
+    Next batch is being read while the previous one is processed."""
+
+    def __init__(self, source, batch_size=1000, executor=None):
+        """Creates an adapter for a synchronous data `source`.
+
+        :Attributes:
+            * `source` - adapted data source
+            * `batch_size` - number of rows read by one request
+        """
+        super(AsyncSourceAdapter, self).__init__(max_in_flight=1,
+                                                 executor=executor)
+        self.source = source
+        self.batch_size = batch_size
+        self._iterator = None
+        self._exhausted = False
+
+    @property
+    def fields(self):
+        return self.source.fields
+
+    @fields.setter
+    def fields(self, fields):
+        if fields is not None:
+            self.source.fields = fields
+
+    def initialize(self):
+        self.source.initialize()
+
+    def finalize(self):
+        self.source.finalize()
+
+    def _read_batch(self):
+        rows = []
+        for row in self._iterator:
+            rows.append(row)
+            if len(rows) >= self.batch_size:
+                break
+        else:
+            self._exhausted = True
+        return rows
+
+    def requests(self):
+        self._iterator = iter(self.source.rows())
+        self._exhausted = False
+        # Source iterator is not thread-safe, one request is in flight
+        while not self._exhausted:
+            yield self._read_batch
+
+class AsyncTargetAdapter(AsyncDataTarget):
+    """Writes rows to a synchronous data target in background. Target's
+    ``append_many(rows)`` is used if the target provides it, otherwise rows
+    are appended one by one."""
+
+    def __init__(self, target, batch_size=1000, max_in_flight=1,
+                 executor=None):
+        """Creates an adapter for a synchronous data `target`.
+
+        :Attributes:
+            * `target` - adapted data target
+            * `max_in_flight` - number of concurrent writes, default is 1.
+              Use more only if the target is thread-safe.
+        """
+        super(AsyncTargetAdapter, self).__init__(batch_size=batch_size,
+                                                 max_in_flight=max_in_flight,
+                                                 executor=executor)
+        self.target = target
+
+    @property
+    def fields(self):
+        return self.target.fields
+
+    @fields.setter
+    def fields(self, fields):
+        if fields is not None:
+            self.target.fields = fields
+
+    def initialize(self):
+        self.target.initialize()
+
+    def write_batch(self, rows):
+        append_many = getattr(self.target, "append_many", None)
+        if append_many:
+            append_many(rows)
+        else:
+            for row in rows:
+                self.target.append(row)
+
+    def finalize(self):
+        try:
+            self.flush()
+        finally:
+            self.target.finalize()
@@ -23,32 +23,58 @@
 # * append_row(row) - row is tuple of values, raises exception if there are more values than fields
 # * append_record(record) - record is a dictionary, raises exception if dict key is not in field list
 
-import urllib2
+import os
+import mmap
 import urlparse
+import cStringIO
+import itertools
 import brewery.dq
 from brewery.metadata import collapse_record, Field
+from brewery.ds.compression import compression_method, DecompressingReader, \
+                                   CompressingWriter
 
-def open_resource(resource, mode = None):
+def open_resource(resource, mode = None, mapped = False, compression = None,
+                  compress_level = None, compress_threads = 1, read_size = None):
     """Get file-like handle for a resource. Conversion:
 
     * if resource is a string and it is not URL or it is file:// URL, then opens a file
     * if resource is URL then opens urllib2 handle
     * otherwise assume that resource is a file-like handle
 
+    If `mapped` is ``True`` then local files opened for reading are memory
+    mapped, see :class:`MappedFile`.
+
+    Compressed resources are decompressed while read and compressed while
+    written (see :mod:`brewery.ds.compression`). `compression` is ``gzip``,
+    ``bz2``, ``xz`` or ``zstd``; by default it is given by the file name or
+    URL extension, ``"none"`` disables compression. Compressed data are read
+    in blocks of `read_size` bytes (default 1 MB). When writing,
+    `compress_level` is the compression level and `compress_threads` is
+    number of blocks compressed concurrently.
+
     Returns tuple: (handle, should_close) where `handle` is file-like object and `should_close` is
         a flag whether returned handle should be closed or not. Closed should be resources which
-        where opened by this method, that is resources referenced by a string or URL.
+        where opened by this method, that is resources referenced by a string or URL, and
+        compression wrappers of file-like handles (closing them does not close the handle).
     """
 
+    method = compression_method(resource, compression)
+    if method:
+        return _open_compressed(resource, mode, method, compress_level,
+                                compress_threads, read_size)
+
     if type(resource) == str or type(resource) == unicode:
         should_close = True
         parts = urlparse.urlparse(resource)
         if parts.scheme == '' or parts.scheme == 'file':
-            if mode:
+            if mapped and mode in (None, "r", "rb"):
+                handle = MappedFile(local_path(resource))
+            elif mode:
                 handle = open(resource, mode=mode)
             else:
                 handle = open(resource)
         else:
+            import urllib2
             handle = urllib2.urlopen(resource)
     else:
         should_close = False
@@ -56,6 +82,163 @@ def open_resource(resource, mode = None):
 
     return handle, should_close
 
+def _open_compressed(resource, mode, method, level, threads, read_size):
+    writing = bool(mode) and mode[0] in "wa"
+    if isinstance(resource, basestring):
+        path = local_path(resource)
+        if path is not None:
+            raw = open(path, mode[0] + "b" if writing else "rb")
+        elif writing:
+            raise ValueError("Can not write compressed data to URL %s" % resource)
+        else:
+            import urllib2
+            raw = urllib2.urlopen(resource)
+        close_raw = True
+    else:
+        raw = resource
+        close_raw = False
+
+    if writing:
+        handle = CompressingWriter(raw, method, level=level, threads=threads,
+                                   close_raw=close_raw)
+    else:
+        handle = DecompressingReader(raw, method, read_size=read_size,
+                                     close_raw=close_raw)
+    return handle, True
+
+def local_path(resource):
+    """Return file system path of `resource` if it is a file name or a
+    file:// URL, otherwise ``None``."""
+
+    if not isinstance(resource, basestring):
+        return None
+
+    parts = urlparse.urlparse(resource)
+    if parts.scheme == 'file':
+        return parts.path
+    elif parts.scheme == '':
+        return resource
+    else:
+        return None
+
+# Size of mapped blocks split into lines at once
+mapped_block_size = 1024 * 1024
+
+class MappedFile(object):
+    """Read-only file-like object over a memory mapped local file or its
+    byte range. Data are read from the mapped pages without read system
+    calls and without a file buffer; the mapping of a file is shared by all
+    processes reading it.
+
+    Iteration scans the mapping for newlines in blocks of about 1 MB and
+    splits each block into lines in C. Lines are still separate strings,
+    as the ``csv`` module of Python 2 parses lines, not a buffer - fields
+    are not parsed directly from the mapping."""
+
+    def __init__(self, path, start=0, end=None):
+        """Map file at `path`. Only bytes from `start` to `end` are read,
+        offsets are relative to `start`."""
+        self.file = open(path, "rb")
+        size = os.fstat(self.file.fileno()).st_size
+
+        if size:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            # Empty file can not be mapped
+            self.map = mmap.mmap(-1, 1)
+
+        self.start = start
+        self.end = size if end is None else min(end, size)
+        self.map.seek(start)
+
+    def read(self, size=-1):
+        remaining = self.end - self.map.tell()
+        if size < 0 or size > remaining:
+            size = remaining
+        return self.map.read(max(size, 0))
+
+    def readline(self):
+        if self.map.tell() >= self.end:
+            return ""
+        line = self.map.readline()
+        over = self.map.tell() - self.end
+        if over > 0:
+            line = line[:-over]
+            self.map.seek(self.end)
+        return line
+
+    def __iter__(self):
+        # Lines are produced by C iterators, not by a Python loop
+        blocks = itertools.imap(cStringIO.StringIO, self._blocks())
+        return itertools.chain.from_iterable(blocks)
+
+    def _blocks(self):
+        """Yield blocks of complete lines from the current position."""
+        data = self.map
+        end = self.end
+        position = data.tell()
+        while position < end:
+            # Block ends after the last newline within the block size
+            limit = min(position + mapped_block_size, end)
+            if limit < end:
+                newline = data.rfind("\n", position, limit)
+                if newline < 0:
+                    # Line longer than the block
+                    newline = data.find("\n", limit, end)
+                limit = end if newline < 0 else newline + 1
+
+            block = data[position:limit]
+            position = limit
+            data.seek(position)
+            yield block
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.tell()
+        elif whence == 2:
+            offset += self.end - self.start
+        self.map.seek(self.start + offset)
+
+    def tell(self):
+        return self.map.tell() - self.start
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def estimate_line_count(resource, sample_size=65536):
+    """Estimate number of lines of a local file `resource` from its size and
+    number of lines in the first `sample_size` bytes. Small files are counted
+    exactly. Returns ``None`` if `resource` is not a local file or if it is
+    compressed.
+    """
+
+    path = local_path(resource)
+    if path is None or compression_method(path):
+        return None
+
+    try:
+        size = os.path.getsize(path)
+        with open(path, "rb") as handle:
+            sample = handle.read(sample_size)
+    except (IOError, OSError):
+        return None
+
+    lines = sample.count("\n")
+    if sample and not sample.endswith("\n"):
+        lines += 1
+
+    if len(sample) >= size:
+        return lines
+    else:
+        return int(size * lines / float(len(sample)))
+
 class DataStream(object):
     """Shared methods for data targets and data sources"""
 
@@ -142,6 +325,28 @@ class DataSource(DataStream):
         """
         raise NotImplementedError()
 
+    def push_predicate(self, predicate):
+        """Ask the source to return only rows matching `predicate` (a
+        :class:`brewery.planner.Predicate`), ``None`` removes the predicate. Returns ``True`` if
+        the source is going to filter the rows. Data sources that are able to filter data more
+        efficiently than python code, such as databases, should implement this method. Default
+        implementation returns ``False``."""
+        return False
+
+    def push_fields(self, keep_fields=None, drop_fields=None):
+        """Ask the source to return only `keep_fields` or to skip `drop_fields`, ``None`` for
+        both removes the projection. Returns ``True`` if the source is going to return only
+        requested fields, `fields` are changed accordingly on initialization. Default
+        implementation returns ``False``."""
+        return False
+
+    def push_aggregation(self, aggregation):
+        """Ask the source to return rows aggregated according to `aggregation` (a
+        :class:`brewery.planner.Aggregation`), ``None`` removes the aggregation. Returns ``True``
+        if the source is going to return aggregated rows, `fields` are changed accordingly on
+        initialization. Default implementation returns ``False``."""
+        return False
+
     def read_fields(self, limit = 0, collapse = False):
         """Read field descriptions from data source. You should use this for datasets that do not
         provide metadata directly, such as CSV files, document bases databases or directories with
@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Compressed file streams.
+
+Files are decompressed while they are read and compressed while they are
+written, without temporary files. Supported methods are ``gzip`` and
+``bz2``, optionally ``xz`` (requires the ``backports.lzma`` package) and
+``zstd`` (requires the ``zstandard`` package). The method is selected by
+the file name extension (``.gz``, ``.bz2``, ``.xz``, ``.zst``) or
+explicitly, see :func:`brewery.ds.base.open_resource`.
+
+Files consisting of more compressed members (streams or frames), for
+example those written by ``pigz``, ``pbzip2`` or by the :class:`CompressingWriter`
+with more threads, are read as one file.
+"""
+
+import zlib
+import bz2
+import collections
+import urlparse
+from brewery.utils import LazyModule
+
+backports = LazyModule("backports.lzma", "xz compressed files",
+                       "https://pypi.python.org/pypi/backports.lzma",
+                       package="backports.lzma")
+zstandard = LazyModule("zstandard", "zstd compressed files",
+                       "https://pypi.python.org/pypi/zstandard")
+
+__all__ = (
+    "compression_method",
+    "DecompressingReader",
+    "CompressingWriter"
+)
+
+compression_extensions = {
+    ".gz": "gzip",
+    ".gzip": "gzip",
+    ".bz2": "bz2",
+    ".xz": "xz",
+    ".zst": "zstd"
+}
+
+# Default size of compressed blocks read at once
+default_read_size = 1024 * 1024
+
+# Default size of blocks compressed by one thread
+default_block_size = 1024 * 1024
+
+def _gzip_compressor(level):
+    if level is None:
+        level = 6
+    return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+def _bz2_compressor(level):
+    return bz2.BZ2Compressor(level or 9)
+
+def _xz_compressor(level):
+    if level is None:
+        level = 6
+    return backports.lzma.LZMACompressor(preset=level)
+
+def _zstd_compressor(level):
+    if level is None:
+        level = 3
+    return zstandard.ZstdCompressor(level=level).compressobj()
+
+def _gzip_decompressor():
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+def _xz_decompressor():
+    return backports.lzma.LZMADecompressor()
+
+def _zstd_decompressor():
+    return zstandard.ZstdDecompressor().decompressobj()
+
+_compressors = {
+    "gzip": _gzip_compressor,
+    "bz2": _bz2_compressor,
+    "xz": _xz_compressor,
+    "zstd": _zstd_compressor
+}
+
+_decompressors = {
+    "gzip": _gzip_decompressor,
+    "bz2": bz2.BZ2Decompressor,
+    "xz": _xz_decompressor,
+    "zstd": _zstd_decompressor
+}
+
+def compression_method(resource, compression=None):
+    """Return compression method of `resource`: `compression` if it is
+    specified, otherwise method given by file name (or URL path) extension
+    of `resource`. Returns ``None`` if the resource is not compressed or if
+    `compression` is ``False`` or ``"none"``."""
+
+    if compression is False or compression == "none":
+        return None
+    elif compression:
+        if compression not in _compressors:
+            raise ValueError("Unknown compression '%s'" % compression)
+        return compression
+
+    if not isinstance(resource, basestring):
+        return None
+
+    path = urlparse.urlparse(resource).path or resource
+    for extension, method in compression_extensions.items():
+        if path.endswith(extension):
+            return method
+    return None
+
+class DecompressingReader(object):
+    """Read-only file-like object decompressing data of file-like object
+    `raw`. Compressed data are read in blocks of `read_size` bytes (default
+    is 1 MB), lines are split from whole decompressed blocks."""
+
+    def __init__(self, raw, method, read_size=None, close_raw=True):
+        self.raw = raw
+        self.method = method
+        self.read_size = read_size or default_read_size
+        self.close_raw = close_raw
+
+        self._factory = _decompressors[method]
+        self._decompressor = self._factory()
+        self._buffer = ""
+        self._position = 0
+
+    def _decompress(self, data):
+        parts = []
+        while data:
+            try:
+                parts.append(self._decompressor.decompress(data))
+            except EOFError:
+                # Previous member ended with the previous block
+                self._decompressor = self._factory()
+                continue
+            data = getattr(self._decompressor, "unused_data", "")
+            if data:
+                # Next member
+                self._decompressor = self._factory()
+        return "".join(parts)
+
+    def _fill(self):
+        """Append next decompressed block to the buffer. Returns ``False`` at
+        the end of the file."""
+        while True:
+            block = self.raw.read(self.read_size)
+            if not block:
+                return False
+            data = self._decompress(block)
+            if data:
+                self._buffer = self._buffer[self._position:] + data
+                self._position = 0
+                return True
+
+    def read(self, size=-1):
+        if size < 0:
+            while self._fill():
+                pass
+            size = len(self._buffer) - self._position
+        else:
+            while len(self._buffer) - self._position < size and self._fill():
+                pass
+
+        data = self._buffer[self._position:self._position + size]
+        self._position += len(data)
+        return data
+
+    def readline(self):
+        newline = self._buffer.find("\n", self._position)
+        while newline < 0:
+            searched = len(self._buffer) - self._position
+            if not self._fill():
+                break
+            newline = self._buffer.find("\n", searched)
+
+        if newline < 0:
+            line = self._buffer[self._position:]
+        else:
+            line = self._buffer[self._position:newline + 1]
+        self._position += len(line)
+        return line
+
+    def __iter__(self):
+        rest = self._buffer[self._position:]
+        self._buffer = ""
+        self._position = 0
+
+        while True:
+            block = self.raw.read(self.read_size)
+            if not block:
+                if rest:
+                    yield rest
+                return
+            lines = (rest + self._decompress(block)).splitlines(True)
+            # Last line might continue in the next block
+            rest = lines.pop() if lines else ""
+            for line in lines:
+                yield line
+
+    def close(self):
+        if self.close_raw:
+            self.raw.close()
+
+class CompressingWriter(object):
+    """Write-only file-like object compressing data into file-like object
+    `raw`. With more `threads` data are split into blocks of `block_size`
+    bytes (default 1 MB) which are compressed concurrently as independent
+    members of the file, as ``pigz`` does. Up to `threads` blocks are being
+    compressed at once by the shared I/O threads (see
+    :func:`brewery.ds.async_streams.default_executor`), the compression
+    libraries release the interpreter lock while they compress."""
+
+    def __init__(self, raw, method, level=None, threads=1, block_size=None,
+                 close_raw=True):
+        self.raw = raw
+        self.method = method
+        self.level = level
+        self.threads = threads or 1
+        self.block_size = block_size or default_block_size
+        self.close_raw = close_raw
+
+        self._factory = _compressors[method]
+        if self.threads > 1:
+            from brewery.ds.async_streams import default_executor
+
+            self._compressor = None
+            self._executor = default_executor()
+            self._pending = collections.deque()
+            self._blocks = []
+            self._buffered = 0
+        else:
+            self._compressor = self._factory(level)
+
+    def _compress_block(self, data):
+        compressor = self._factory(self.level)
+        return compressor.compress(data) + compressor.flush()
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode("utf-8")
+
+        if self._compressor is not None:
+            self.raw.write(self._compressor.compress(data))
+            return
+
+        self._blocks.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.block_size:
+            self._submit()
+
+    def _submit(self):
+        data = "".join(self._blocks)
+        self._blocks = []
+        self._buffered = 0
+        if data:
+            future = self._executor.submit(self._compress_block, data)
+            self._pending.append(future)
+        # Write compressed blocks in order
+        self._write_pending(self.threads)
+
+    def _write_pending(self, count):
+        while len(self._pending) > count \
+                or (self._pending and self._pending[0].done()):
+            self.raw.write(self._pending.popleft().result())
+
+    def flush(self):
+        """Write compressed blocks which are finished. Data which are not
+        compressed yet stay buffered, compression is finished by
+        :meth:`close`."""
+        if self._compressor is None:
+            self._write_pending(len(self._pending))
+        self.raw.flush()
+
+    def close(self):
+        """Finish compression and close the `raw` file if `close_raw` is
+        ``True``, otherwise flush it."""
+        if self._compressor is not None:
+            self.raw.write(self._compressor.flush())
+        else:
+            self._submit()
+            self._write_pending(0)
+
+        if self.close_raw:
+            self.raw.close()
+        else:
+            self.raw.flush()
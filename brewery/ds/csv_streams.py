@@ -2,11 +2,35 @@
 # -*- coding: utf-8 -*-
 
 import csv
+import os
 import codecs
 import cStringIO
+import datetime
+import itertools
+import operator
+import multiprocessing
 import base
 import brewery.metadata
 
+# Encodings read without recoding, values are decoded from UTF-8
+_utf8_encodings = ("utf-8", "utf8", "ascii", "us-ascii")
+
+# Size of blocks recoded at once
+_recode_block_size = 65536
+
+# Default size of the CSV writer output buffer
+default_write_buffer_size = 65536
+
+# Default size of byte ranges parsed by worker processes
+default_range_size = 32 * 1024 * 1024
+
+# Size of blocks in which quotes of a range are counted
+_scan_block_size = 1024 * 1024
+
+# Dialect attributes passed to worker processes
+_dialect_attributes = ("delimiter", "quotechar", "escapechar", "doublequote",
+                       "skipinitialspace", "lineterminator", "quoting")
+
 class UTF8Recoder(object):
     """
     Iterator that reads an encoded stream and reencodes the input to UTF-8
@@ -25,10 +49,39 @@ class UTF8Recoder(object):
     def next(self):
         return self.reader.next().encode('utf-8')
 
+class BlockRecoder(object):
+    """Iterator over lines of an encoded stream, re-encoded to UTF-8. Input
+    is decoded and encoded in large blocks, not line by line."""
+
+    def __init__(self, f, encoding, block_size=None):
+        self.file = f
+        self.decoder = codecs.getincrementaldecoder(encoding)()
+        self.block_size = block_size or _recode_block_size
+
+    def __iter__(self):
+        rest = ""
+        while True:
+            block = self.file.read(self.block_size)
+            data = self.decoder.decode(block, final=not block).encode("utf-8")
+            lines = (rest + data).splitlines(True)
+            if not block:
+                for line in lines:
+                    yield line
+                return
+            # Last line might continue in the next block
+            rest = lines.pop() if lines else ""
+            for line in lines:
+                yield line
+
+_true_strings = frozenset(("true", "yes", "on", "t", "y", "1"))
+
 def to_bool(value):
-    """Return boolean value. Convert string to True when "true", "yes" or "on"
-    """
-    return bool(value) or lower(value) in ["true", "yes", "on"]
+    """Return boolean value. Strings are ``True`` when they are "true",
+    "yes", "on", "t", "y" or "1" (case insensitive), other values are
+    converted with ``bool()``."""
+    if isinstance(value, basestring):
+        return value.strip().lower() in _true_strings
+    return bool(value)
 
 storage_conversion = {
     "unknown": None,
@@ -40,42 +93,246 @@ storage_conversion = {
     "date": None
 }
 
+# Date formats tried by the date converter: (format, has time)
+default_date_formats = (
+    ("%Y-%m-%d", False),
+    ("%Y-%m-%d %H:%M:%S", True),
+    ("%Y-%m-%dT%H:%M:%S", True),
+    ("%Y-%m-%d %H:%M:%S.%f", True),
+    ("%d.%m.%Y", False),
+    ("%m/%d/%Y", False),
+    ("%Y%m%d", False)
+)
+
+class DateConverter(object):
+    """Converts strings to dates or date-times. Format which parsed the last
+    value is tried first, ISO dates are parsed without `strptime()`."""
+
+    def __init__(self, formats=None):
+        formats = formats or default_date_formats
+        self.formats = [(f, True) if isinstance(f, basestring) else f
+                            for f in formats]
+        self.format = self.formats[0]
+
+    def __call__(self, value):
+        if not value:
+            return None
+
+        (format, has_time) = self.format
+        if format == "%Y-%m-%d" and len(value) == 10 \
+                and value[4] == "-" and value[7] == "-":
+            try:
+                return datetime.date(int(value[0:4]), int(value[5:7]),
+                                     int(value[8:10]))
+            except ValueError:
+                pass
+        try:
+            return self._parse(value, format, has_time)
+        except ValueError:
+            pass
+
+        for candidate in self.formats:
+            try:
+                result = self._parse(value, *candidate)
+            except ValueError:
+                continue
+            self.format = candidate
+            return result
+
+        raise ValueError("Date '%s' does not match any of the formats" % value)
+
+    def _parse(self, value, format, has_time):
+        result = datetime.datetime.strptime(value, format)
+        if has_time:
+            return result
+        return result.date()
+
+    def convert_many(self, values):
+        """Convert list of values."""
+        if self.format[0] == "%Y-%m-%d":
+            date = datetime.date
+            try:
+                return [date(int(v[0:4]), int(v[5:7]), int(v[8:10]))
+                            if len(v) == 10 and v[4] == "-" and v[7] == "-"
+                            else self(v)
+                        for v in values]
+            except ValueError:
+                pass
+        return map(self, values)
+
+def _number_converter(function):
+    def convert(value):
+        if value:
+            return function(value)
+        return None
+    return convert
+
+_decode = operator.methodcaller("decode", "utf-8")
+
+def _decode_or_null(value):
+    if value:
+        return value.decode("utf-8")
+    return None
+
+def _bool_converter(value):
+    if value:
+        return to_bool(value)
+    return None
+
+# Types written by the CSV module as they are, str() of dates is ASCII
+_plain_types = frozenset((str, int, long, float, bool, type(None),
+                          datetime.date, datetime.datetime))
+
+def _encode_value(value):
+    if type(value) is unicode:
+        return value.encode("utf-8")
+    return unicode(value).encode("utf-8")
+
+def _encode_row(row):
+    return [value if type(value) in _plain_types else _encode_value(value)
+                for value in row]
+
+def _number_column(function):
+    def convert(values):
+        try:
+            return map(function, values)
+        except ValueError:
+            # Empty values
+            return [function(value) if value else None for value in values]
+    return convert
+
+def _decode_column(values):
+    return map(_decode, values)
+
+def _decode_or_null_column(values):
+    return [value.decode("utf-8") if value else None for value in values]
+
+def _bool_column(values):
+    return [value.strip().lower() in _true_strings if value else None
+                for value in values]
+
+def column_converter(field, empty_as_null=False, date_formats=None):
+    """Return function converting list of CSV values of `field` (one column
+    of a batch of rows), see :func:`field_converter`."""
+    storage_type = field.storage_type
+    if storage_type == "integer":
+        return _number_column(int)
+    elif storage_type == "float":
+        return _number_column(float)
+    elif storage_type == "boolean":
+        return _bool_column
+    elif storage_type == "date":
+        return DateConverter(date_formats).convert_many
+    elif empty_as_null:
+        return _decode_or_null_column
+    else:
+        return _decode_column
+
+def field_converter(field, empty_as_null=False, date_formats=None):
+    """Return function converting a CSV value (UTF-8 string) of `field` to
+    its storage type. Empty numbers, booleans and dates are ``None``, empty
+    strings are ``None`` if `empty_as_null` is ``True``."""
+    storage_type = field.storage_type
+    if storage_type == "integer":
+        return _number_converter(int)
+    elif storage_type == "float":
+        return _number_converter(float)
+    elif storage_type == "boolean":
+        return _bool_converter
+    elif storage_type == "date":
+        return DateConverter(date_formats)
+    elif empty_as_null:
+        return _decode_or_null
+    else:
+        return _decode
+
 class UnicodeReader:
     """
     A CSV reader which will iterate over lines in the CSV file "f",
     which is encoded in the given encoding.
+
+    Values are converted to the storage type of the fields (see
+    :func:`field_converter`) with a converter bound to each column. Input
+    in other encoding than UTF-8 is recoded in blocks. Only the columns of
+    the fields are decoded and converted, see :meth:`set_fields`.
     """
 
-    def __init__(self, f, dialect=csv.excel, encoding="utf-8", empty_as_null=False, **kwds):
-        f = UTF8Recoder(f, encoding)
+    def __init__(self, f, dialect=csv.excel, encoding="utf-8", empty_as_null=False,
+                 date_formats=None, **kwds):
+        if encoding and encoding.lower() not in _utf8_encodings:
+            f = BlockRecoder(f, encoding)
         self.reader = csv.reader(f, dialect=dialect, **kwds)
         self.converters = []
+        self.column_converters = []
+        self.columns = None
         self.empty_as_null = empty_as_null
-
-    def set_fields(self, fields):
-        self.converters = [storage_conversion[f.storage_type] for f in fields]
+        self.date_formats = date_formats
+
+    def set_fields(self, fields, columns=None):
+        """Set fields of the rows. `columns` is a list of indexes of columns
+        of the fields, if the file contains other columns as well. Other
+        columns are left as parsed by the CSV module, they are not decoded
+        or converted."""
+        self.converters = [field_converter(f, self.empty_as_null,
+                                           self.date_formats) for f in fields]
+        self.column_converters = [column_converter(f, self.empty_as_null,
+                                                   self.date_formats)
+                                    for f in fields]
+        self.columns = columns
 
     def next(self):
         row = self.reader.next()
-        result = []
-
-        # FIXME: make this nicer, this is just quick hack
-        for i, value in enumerate(row):
-            if self.converters:
-                f = self.converters[i]
-            else:
-                f = None
-
-            if f:
-                result.append(f(value))
-            else:
-                uni_str = unicode(value, "utf-8")
-                if not uni_str and self.empty_as_null:
-                    result.append(None)
+        if not self.converters:
+            return self._decode_row(row)
+        if self.columns is not None:
+            row = self._project(row)
+
+        return [convert(value) for convert, value in
+                    itertools.izip(self.converters, row)]
+
+    def batches(self, size=1000):
+        """Iterate over lists of `size` converted rows. Values are converted
+        column by column."""
+        reader = self.reader
+        converters = self.converters
+        column_converters = self.column_converters
+        indexes = self.columns
+        if indexes is None:
+            width = len(converters)
+        else:
+            width = max(indexes) + 1 if indexes else 0
+        izip = itertools.izip
+        while True:
+            rows = list(itertools.islice(reader, size))
+            if not rows:
+                break
+            if not converters:
+                yield [self._decode_row(row) for row in rows]
+            elif min(map(len, rows)) >= width:
+                if indexes is None:
+                    columns = zip(*rows)
                 else:
-                    result.append(uni_str)
-            
-        return result
+                    columns = [map(operator.itemgetter(i), rows) for i in indexes]
+                columns = [convert(column) for convert, column
+                                in izip(column_converters, columns)]
+                yield map(list, izip(*columns))
+            else:
+                # Short rows
+                if indexes is not None:
+                    rows = map(self._project, rows)
+                yield [[convert(value) for convert, value in izip(converters, row)]
+                            for row in rows]
+            if len(rows) < size:
+                break
+
+    def _project(self, row):
+        length = len(row)
+        return [row[i] if i < length else "" for i in self.columns]
+
+    def _decode_row(self, row):
+        if self.empty_as_null:
+            return map(_decode_or_null, row)
+        return map(_decode, row)
 
     def __iter__(self):
         return self
@@ -85,40 +342,98 @@ class UnicodeWriter:
     A CSV writer which will write rows to CSV file "f",
     which is encoded in the given encoding.
 
+    Rows are written as UTF-8 into a buffer, which is written to the file
+    (re-encoded at once if the encoding is not UTF-8) when it is larger than
+    `buffer_size`. Call :meth:`flush` to write the rest. Unicode strings are
+    encoded, strings, numbers, dates and ``None`` are passed to the CSV
+    module as they are, other values are converted with ``unicode()``.
+
     From: <http://docs.python.org/lib/csv-examples.html>
     """
 
-    def __init__(self, f, dialect=csv.excel, encoding="utf-8", **kwds):
+    def __init__(self, f, dialect=csv.excel, encoding="utf-8", buffer_size=None,
+                 **kwds):
         # Redirect output to a queue
         self.queue = cStringIO.StringIO()
         self.writer = csv.writer(self.queue, dialect=dialect, **kwds)
         self.stream = f
-        self.encoder = codecs.getincrementalencoder(encoding)()
+        self.buffer_size = buffer_size or default_write_buffer_size
+        # Rows are encoded as UTF-8, other encodings (including ASCII) have
+        # to be checked by the encoder
+        if encoding and codecs.lookup(encoding).name != "utf-8":
+            self.encoder = codecs.getincrementalencoder(encoding)()
+        else:
+            self.encoder = None
 
     def writerow(self, row):
-        new_row = []
-        for value in row:
-            if type(value) == unicode or type(value) == str:
-                new_row.append(value.encode("utf-8"))
-            elif value is not None:
-                new_row.append(unicode(value))
-            else:
-                new_row.append(None)
-                
-        self.writer.writerow(new_row)
-        # Fetch UTF-8 output from the queue ...
-        data = self.queue.getvalue()
-        data = data.decode("utf-8")
-        # ... and reencode it into the target encoding
-        data = self.encoder.encode(data)
-        # write to the target stream
-        self.stream.write(data)
-        # empty queue
-        self.queue.truncate(0)
+        self.writer.writerow(_encode_row(row))
+        if self.queue.tell() >= self.buffer_size:
+            self.flush()
 
     def writerows(self, rows):
-        for row in rows:
-            self.writerow(row)
+        self.writer.writerows(itertools.imap(_encode_row, rows))
+        if self.queue.tell() >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """Write buffered rows to the file."""
+        data = self.queue.getvalue()
+        if not data:
+            return
+        if self.encoder:
+            data = self.encoder.encode(data.decode("utf-8"))
+        self.stream.write(data)
+        self.queue.seek(0)
+        self.queue.truncate()
+
+def _scan_csv_range(args):
+    """Scan byte range of a CSV file for record boundary candidates. Returns
+    tuple (`quotes`, `even`, `odd`) where `quotes` is number of quote
+    characters in the range, `even` and `odd` are offsets after the first
+    newline preceded by even or odd number of quotes within the range."""
+    (path, start, end, quotechar) = args
+    with base.MappedFile(path, start, end) as handle:
+        data = handle.map
+        end = handle.end
+
+        if not quotechar:
+            newline = data.find("\n", start, end)
+            offset = newline + 1 if newline >= 0 else None
+            return (0, offset, None)
+
+        candidates = [None, None]
+        count = 0
+        position = start
+        while candidates[0] is None or candidates[1] is None:
+            newline = data.find("\n", position, end)
+            if newline < 0:
+                break
+            count += data[position:newline].count(quotechar)
+            if candidates[count % 2] is None:
+                candidates[count % 2] = newline + 1
+            position = newline + 1
+
+        quotes = 0
+        for offset in xrange(start, end, _scan_block_size):
+            block_end = min(offset + _scan_block_size, end)
+            quotes += data[offset:block_end].count(quotechar)
+
+    return (quotes, candidates[0], candidates[1])
+
+def _parse_csv_range(args):
+    """Parse byte range of a CSV file, returns list of converted rows."""
+    (path, start, end, options) = args
+
+    options = dict(options)
+    fields = brewery.metadata.FieldList(options.pop("fields"))
+    columns = options.pop("columns")
+    rows = []
+    with base.MappedFile(path, start, end) as handle:
+        reader = UnicodeReader(handle, **options)
+        reader.set_fields(fields, columns)
+        for batch in reader.batches():
+            rows += batch
+    return rows
 
 class CSVDataSource(base.DataSource):
     """docstring for ClassName
@@ -127,7 +442,9 @@ class CSVDataSource(base.DataSource):
     """
     def __init__(self, resource, read_header=True, dialect=None, encoding=None,
                  detect_header=False, sample_size=200, skip_rows=None,
-                 empty_as_null=True,fields=None, **reader_args):
+                 empty_as_null=True,fields=None, date_formats=None,
+                 processes=1, range_size=None, ordered=True, mapped=False,
+                 keep_fields=None, compression=None, **reader_args):
         """Creates a CSV data source stream.
         
         :Attributes:
@@ -143,9 +460,39 @@ class CSVDataSource(base.DataSource):
               prevent loading huge CSV files at once.
             * skip_rows: number of rows to be skipped. Default: ``None``
             * empty_as_null: treat empty strings as ``Null`` values
+            * date_formats: list of `strptime()` formats of ``date`` fields,
+              default formats are ISO dates and date-times and few common
+              date formats. Format of the previous value is tried first.
+            * processes: number of worker processes parsing a local file in
+              parallel, default is 1 (no worker processes). ``"auto"`` uses
+              one process per CPU.
+            * range_size: size in bytes of a file range parsed by one worker
+              process, default is 32 MB
+            * ordered: if ``True`` (default) rows of parallel parsing are in
+              file order, otherwise ranges are returned as they are parsed
+            * mapped: if ``True`` a local file is memory mapped instead of
+              being read through a file buffer. Worker processes of parallel
+              parsing always map the file.
+            * keep_fields: list of fields (columns) to be read, default is
+              all fields. Values of other columns are not decoded nor
+              converted.
+            * compression: ``gzip``, ``bz2``, ``xz`` or ``zstd``, by default
+              given by the file extension (such as ``data.csv.gz``).
+              Compressed files are decompressed while read, see
+              :func:`brewery.ds.base.open_resource`.
+
+        Values are converted according to the field storage types: integers,
+        floats, booleans and dates. Empty values of these types are ``None``.
             
         Note: avoid auto-detection when you are reading from remote URL
-        stream.
+        stream or from a compressed file.
+
+        Parallel parsing splits the file into byte ranges ending at record
+        boundaries. Boundaries are found by counting quote characters, which
+        handles quoted newlines; quote characters are expected only around
+        and doubled inside quoted values. Files with an `escapechar`, in
+        encodings where a newline is not a single ``\\n`` byte, compressed
+        files and non-local resources are parsed in the current process.
         
         """
         self.read_header = read_header
@@ -162,6 +509,20 @@ class CSVDataSource(base.DataSource):
         self.close_file = False
         self.skip_rows = skip_rows
         self.fields = fields
+        self.date_formats = date_formats
+
+        if processes == "auto":
+            processes = multiprocessing.cpu_count()
+        self.processes = processes or 1
+        self.range_size = range_size or default_range_size
+        self.ordered = ordered
+        self.mapped = mapped
+        self.keep_fields = keep_fields
+        self.compression = compression
+
+        self.pushed_fields = None
+        self._all_fields = None
+        self._columns = None
         
     def initialize(self):
         """Initialize CSV source stream:
@@ -182,7 +543,9 @@ class CSVDataSource(base.DataSource):
         `analytical_type` = ``unknown``.
         """
 
-        self.file, self.close_file = base.open_resource(self.resource)
+        self.file, self.close_file = base.open_resource(self.resource,
+                                                        mapped=self.mapped,
+                                                        compression=self.compression)
 
         handle = None
         
@@ -208,6 +571,7 @@ class CSVDataSource(base.DataSource):
         # self.reader = csv.reader(handle, **self.reader_args)
         self.reader = UnicodeReader(self.file, encoding=self.encoding,
                                     empty_as_null=self.empty_as_null,
+                                    date_formats=self.date_formats,
                                     **self.reader_args)
 
         if self.skip_rows:
@@ -229,27 +593,180 @@ class CSVDataSource(base.DataSource):
                                "Either read fields from CSV header or "
                                "set them manually")
 
-        self.reader.set_fields(self.fields)
+        if self._all_fields is None:
+            self._all_fields = self.fields
+
+        fields = self._all_fields
+        if self.keep_fields:
+            fields = brewery.metadata.FieldMap(keep=self.keep_fields).map(fields)
+        if self.pushed_fields:
+            fields = self.pushed_fields.map(fields)
+
+        if len(fields) < len(self._all_fields):
+            names = self._all_fields.names()
+            self._columns = [names.index(name) for name in fields.names()]
+        else:
+            self._columns = None
+
+        self.fields = fields
+        self.reader.set_fields(self.fields, self._columns)
+
+    def push_fields(self, keep_fields=None, drop_fields=None):
+        """Read only `keep_fields` or skip `drop_fields`. Fields are changed
+        on next :meth:`initialize`."""
+        if keep_fields or drop_fields:
+            self.pushed_fields = brewery.metadata.FieldMap(keep=keep_fields,
+                                                           drop=drop_fields)
+        else:
+            self.pushed_fields = None
+        return True
         
     def finalize(self):
         if self.file and self.close_file:
             self.file.close()
 
     def rows(self):
+        return itertools.chain.from_iterable(self.batches())
+
+    def batches(self, size=1000):
+        """Return iterator over lists of `size` rows."""
         if not self.reader:
             raise RuntimeError("Stream is not initialized")
         if not self.fields:
             raise RuntimeError("Fields are not initialized")
-        return self.reader
+        if self.processes > 1 and self._parallel_options():
+            return self._parallel_batches(size)
+        return self.reader.batches(size)
+
+    def _parallel_options(self):
+        """Return reader options for the worker processes or ``None`` if the
+        resource can not be parsed in parallel."""
+        if base.local_path(self.resource) is None \
+                or base.compression_method(self.resource, self.compression):
+            return None
+
+        encoding = self.encoding or "utf-8"
+        if u"\n\"".encode(encoding) != "\n\"":
+            return None
+
+        options = {}
+        dialect = self.reader_args.get("dialect")
+        if dialect:
+            for name in _dialect_attributes:
+                options[name] = getattr(dialect, name)
+        for name, value in self.reader_args.items():
+            if name != "dialect":
+                options[name] = value
+
+        if options.get("escapechar"):
+            return None
+
+        options.update(encoding=self.encoding,
+                       empty_as_null=self.empty_as_null,
+                       date_formats=self.date_formats,
+                       fields=[(f.name, f.storage_type) for f in self.fields],
+                       columns=self._columns)
+        return options
+
+    def _data_offset(self, path, options):
+        """Return offset of the first data record, after the skipped rows and
+        the header."""
+        skip = (self.skip_rows or 0) + (1 if self.read_header else 0)
+        dialect = dict((name, options[name]) for name in _dialect_attributes
+                            if name in options)
+        consumed = [0]
+
+        with open(path, "rb") as handle:
+            def lines():
+                for line in iter(handle.readline, ""):
+                    consumed[0] += len(line)
+                    yield line
+            reader = csv.reader(lines(), **dialect)
+            for i in range(0, skip):
+                next(reader, None)
+
+        return consumed[0]
+
+    def ranges(self):
+        """Return list of (`start`, `end`) byte ranges of the local file
+        aligned on record boundaries. The ranges are scanned for boundaries
+        by the worker processes."""
+        options = self._parallel_options()
+        path = base.local_path(self.resource)
+        start = self._data_offset(path, options)
+        size = os.path.getsize(path)
+
+        if options.get("quoting") == csv.QUOTE_NONE:
+            quotechar = None
+        else:
+            quotechar = options.get("quotechar", '"')
+
+        chunks = range(start, size, self.range_size)
+        requests = [(path, offset, min(offset + self.range_size, size), quotechar)
+                        for offset in chunks]
+
+        pool = multiprocessing.Pool(self.processes)
+        try:
+            scans = pool.map(_scan_csv_range, requests)
+        finally:
+            pool.terminate()
+
+        # Range starts at the first newline outside of a quoted value in
+        # the chunk, which depends on number of quotes before the chunk
+        boundaries = [start]
+        quotes = scans[0][0] if scans else 0
+        for (count, even, odd) in scans[1:]:
+            boundary = odd if quotes % 2 else even
+            quotes += count
+            if boundary is not None and boundary > boundaries[-1]:
+                boundaries.append(boundary)
+
+        boundaries = [b for b in boundaries if b < size]
+        return zip(boundaries, boundaries[1:] + [size])
+
+    def _parallel_batches(self, size):
+        """Yield batches of `size` rows parsed by the worker processes. Rows
+        of consecutive ranges are joined into full batches, only the last
+        batch might be shorter."""
+        options = self._parallel_options()
+        path = base.local_path(self.resource)
+        requests = [(path, start, end, options) for start, end in self.ranges()]
+
+        pool = multiprocessing.Pool(self.processes)
+        try:
+            if self.ordered:
+                results = pool.imap(_parse_csv_range, requests)
+            else:
+                results = pool.imap_unordered(_parse_csv_range, requests)
+            pending = []
+            for rows in results:
+                start = 0
+                if pending:
+                    # Complete the batch started by the previous range
+                    start = size - len(pending)
+                    pending.extend(rows[:start])
+                    if len(pending) < size:
+                        continue
+                    yield pending
+                end = start + (len(rows) - start) // size * size
+                for i in xrange(start, end, size):
+                    yield rows[i:i + size]
+                pending = rows[end:]
+            if pending:
+                yield pending
+            pool.close()
+        finally:
+            pool.terminate()
 
     def records(self):
         fields = self.fields.names()
-        for row in self.reader:
+        for row in self.rows():
             yield dict(zip(fields, row))
 
 class CSVDataTarget(base.DataTarget):
     def __init__(self, resource, write_headers=True, truncate=True, encoding="utf-8", 
-                dialect=None,fields=None, **kwds):
+                dialect=None,fields=None, buffer_size=None, compression=None,
+                compress_level=None, compress_threads=1, **kwds):
         """Creates a CSV data target
         
         :Attributes:
@@ -257,6 +774,15 @@ class CSVDataTarget(base.DataTarget):
               object
             * write_headers: write field names as headers into output file
             * truncate: remove data from file before writing, default: True
+            * buffer_size: size of output buffer in bytes, default is 64 kB.
+              Rows are written to the file when the buffer is full and when
+              the target is finalized.
+            * compression: ``gzip``, ``bz2``, ``xz`` or ``zstd``, by default
+              given by the file extension (such as ``data.csv.gz``)
+            * compress_level: compression level, default depends on the
+              compression method
+            * compress_threads: number of blocks compressed concurrently,
+              default is 1
             
         """
         self.resource = resource
@@ -265,6 +791,10 @@ class CSVDataTarget(base.DataTarget):
         self.encoding = encoding
         self.dialect = dialect
         self.fields = fields
+        self.buffer_size = buffer_size
+        self.compression = compression
+        self.compress_level = compress_level
+        self.compress_threads = compress_threads
         self.kwds = kwds
 
         self.close_file = False
@@ -273,10 +803,14 @@ class CSVDataTarget(base.DataTarget):
     def initialize(self):
         mode = "w" if self.truncate else "a"
 
-        self.file, self.close_file = base.open_resource(self.resource, mode)
+        self.file, self.close_file = base.open_resource(self.resource, mode,
+                                            compression=self.compression,
+                                            compress_level=self.compress_level,
+                                            compress_threads=self.compress_threads)
 
         self.writer = UnicodeWriter(self.file, encoding = self.encoding, 
-                                    dialect = self.dialect, **self.kwds)
+                                    dialect = self.dialect,
+                                    buffer_size = self.buffer_size, **self.kwds)
         
         if self.write_headers:
             self.writer.writerow(self.fields.names())
@@ -284,8 +818,12 @@ class CSVDataTarget(base.DataTarget):
         self.field_names = self.fields.names()
         
     def finalize(self):
-        if self.file and self.close_file:
-            self.file.close()
+        if self.file:
+            self.writer.flush()
+            if self.close_file:
+                self.file.close()
+            else:
+                self.file.flush()
 
     def append(self, obj):
         if type(obj) == dict:
@@ -296,3 +834,8 @@ class CSVDataTarget(base.DataTarget):
             row = obj
                 
         self.writer.writerow(row)
+
+    def append_many(self, rows):
+        """Append list of rows (lists or tuples). Faster than appending them
+        one by one."""
+        self.writer.writerows(rows)
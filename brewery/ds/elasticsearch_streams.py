@@ -5,12 +5,9 @@ import base
 from brewery import dq
 import time
 from brewery.metadata import expand_record
+from brewery.utils import LazyModule
 
-try:
-    from pyes.es import ES
-except ImportError:
-    from brewery.utils import MissingPackage
-    pyes = MissingPackage("pyes", "ElasticSearch streams", "http://www.elasticsearch.org/")
+pyes = LazyModule("pyes.es", "ElasticSearch streams", "http://www.elasticsearch.org/")
 
 class ESDataSource(base.DataSource):
     """docstring for ClassName
@@ -46,7 +43,7 @@ class ESDataSource(base.DataSource):
         if self.port:
             server += ":" + self.port
 
-        self.connection = ES(server, **args)
+        self.connection = pyes.es.ES(server, **args)
         self.connection.default_indices = self.database_name
         self.connection.default_types = self.document_type
 
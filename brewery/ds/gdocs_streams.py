@@ -3,11 +3,9 @@
 
 import base
 import brewery.metadata as metadata
-try:
-    import gdata.spreadsheet.text_db
-except:
-    from brewery.utils import MissingPackage
-    gdata = MissingPackage("gdata", "Google data (spreadsheet) source/target")
+from brewery.utils import LazyModule
+
+gdata = LazyModule("gdata.spreadsheet.text_db", "Google data (spreadsheet) source/target")
 
 # Documentation:
 # http://gdata-python-client.googlecode.com/svn/trunk/pydocs/
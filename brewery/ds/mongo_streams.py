@@ -3,18 +3,16 @@
 
 import base
 import brewery.dq
+import brewery.metadata
+from brewery.utils import LazyModule
 
-try:
-    import pymongo
-except ImportError:
-    from brewery.utils import MissingPackage
-    pymongo = MissingPackage("pymongo", "MongoDB streams", "http://www.mongodb.org/downloads/")
+pymongo = LazyModule("pymongo", "MongoDB streams", "http://www.mongodb.org/downloads/")
 
 class MongoDBDataSource(base.DataSource):
     """docstring for ClassName
     """
     def __init__(self, collection, database=None, host=None, port=None,
-                 expand=False, **mongo_args):
+                 expand=False, keep_fields=None, **mongo_args):
         """Creates a MongoDB data source stream.
 
         :Attributes:
@@ -24,6 +22,9 @@ class MongoDBDataSource(base.DataSource):
             * port: mongo port, default is ``27017``
             * expand: expand dictionary values and treat children as top-level keys with dot '.'
                 separated key path to the child..
+            * keep_fields: list of fields (keys) to be read, default is all fields
+
+        Documents might be filtered by the database with :meth:`push_predicate`.
         """
 
         self.collection_name = collection
@@ -32,9 +33,14 @@ class MongoDBDataSource(base.DataSource):
         self.port = port
         self.mongo_args = mongo_args
         self.expand = expand
+        self.keep_fields = keep_fields
+
+        self.predicate = None
+        self.pushed_fields = None
 
         self.collection = None
         self.fields = None
+        self._all_fields = None
 
     def initialize(self):
         """Initialize Mongo source stream:
@@ -50,6 +56,36 @@ class MongoDBDataSource(base.DataSource):
         self.database = self.connection[self.database_name]
         self.collection = self.database[self.collection_name]
 
+        if self.fields and self._all_fields is None:
+            self._all_fields = brewery.metadata.FieldList(self.fields)
+        if self._all_fields is not None:
+            fields = self._all_fields
+            if self.keep_fields:
+                fields = brewery.metadata.FieldMap(keep=self.keep_fields).map(fields)
+            if self.pushed_fields:
+                fields = self.pushed_fields.map(fields)
+            self.fields = fields
+
+    def push_predicate(self, predicate):
+        """Filter documents in the database with `predicate` (MongoDB query)."""
+        self.predicate = predicate
+        return True
+
+    def push_fields(self, keep_fields=None, drop_fields=None):
+        """Read only `keep_fields` or skip `drop_fields` (MongoDB projection). Fields are changed
+        on next :meth:`initialize`."""
+        if keep_fields or drop_fields:
+            self.pushed_fields = brewery.metadata.FieldMap(keep=keep_fields,
+                                                           drop=drop_fields)
+        else:
+            self.pushed_fields = None
+        return True
+
+    def query(self):
+        """Return MongoDB query document of the source."""
+        if self.predicate is None:
+            return None
+        return self.predicate.mongo_query()
 
     def read_fields(self, limit=0):
         keys = []
@@ -96,14 +132,15 @@ class MongoDBDataSource(base.DataSource):
 
             fields.append(field)
 
-        self.fields = list(fields)
+        self.fields = brewery.metadata.FieldList(fields)
+        self._all_fields = self.fields
         return self.fields
 
     def rows(self):
         if not self.collection:
             raise RuntimeError("Stream is not initialized")
-        fields = self.fields.names
-        iterator = self.collection.find(fields=fields)
+        fields = self.fields.names()
+        iterator = self.collection.find(self.query(), fields=fields)
         return MongoDBRowIterator(iterator, fields)
 
     def records(self):
@@ -114,7 +151,7 @@ class MongoDBDataSource(base.DataSource):
             fields = self.fields.names()
         else:
             fields = None
-        iterator = self.collection.find(fields=fields)
+        iterator = self.collection.find(self.query(), fields=fields)
         return MongoDBRecordIterator(iterator, self.expand)
 
 class MongoDBRowIterator(object):
@@ -241,3 +278,19 @@ class MongoDBDataTarget(base.DataTarget):
             record = base.expand_record(record)
 
         self.collection.insert(record)
+
+    def append_many(self, rows):
+        """Insert list of rows or records with one bulk insert."""
+        records = []
+        for obj in rows:
+            if type(obj) == dict:
+                record = obj
+            else:
+                record = dict(zip(self.field_names, obj))
+
+            if self.expand:
+                record = base.expand_record(record)
+            records.append(record)
+
+        if records:
+            self.collection.insert(records)
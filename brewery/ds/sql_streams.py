@@ -2,41 +2,102 @@
 
 import base
 import brewery.metadata
-
-try:
-    import sqlalchemy
-
-    # (sql type, storage type, analytical type)
-    _sql_to_brewery_types = (
-        (sqlalchemy.types.UnicodeText, "text", "typeless"),
-        (sqlalchemy.types.Text, "text", "typeless"),
-        (sqlalchemy.types.Unicode, "string", "set"),
-        (sqlalchemy.types.String, "string", "set"),
-        (sqlalchemy.types.Integer, "integer", "discrete"),
-        (sqlalchemy.types.Numeric, "float", "range"),
-        (sqlalchemy.types.DateTime, "date", "typeless"),
-        (sqlalchemy.types.Date, "date", "typeless"),
-        (sqlalchemy.types.Time, "unknown", "typeless"),
-        (sqlalchemy.types.Interval, "unknown", "typeless"),
-        (sqlalchemy.types.Boolean, "boolean", "flag"),
-        (sqlalchemy.types.Binary, "unknown", "typeless")
-    )
-
-    concrete_sql_type_map = {
-        "string": sqlalchemy.types.Unicode,
-        "text": sqlalchemy.types.UnicodeText,
-        "date": sqlalchemy.types.Date,
-        "time": sqlalchemy.types.DateTime,
-        "integer": sqlalchemy.types.Integer,
-        "float": sqlalchemy.types.Numeric,
-        "boolean": sqlalchemy.types.SmallInteger
-    }
-except:
-    from brewery.utils import MissingPackage
-    sqlalchemy = MissingPackage("sqlalchemy", "SQL streams", "http://www.sqlalchemy.org/",
-                                comment = "Recommended version is > 0.7")
-    _sql_to_brewery_types = ()
-    concrete_sql_type_map = {}
+import itertools
+import threading
+import Queue
+import sys
+import os
+import time
+import datetime
+import decimal
+import hashlib
+import tempfile
+import cPickle as pickle
+import cStringIO as StringIO
+import uuid
+import weakref
+
+from brewery.utils import LazyModule
+
+sqlalchemy = LazyModule("sqlalchemy", "SQL streams", "http://www.sqlalchemy.org/",
+                        comment = "Recommended version is > 0.7")
+
+_type_maps = None
+
+def _sql_type_maps():
+    """Returns tuple (`sql_to_brewery_types`, `concrete_sql_type_map`). Created on first use, as
+    they require sqlalchemy to be imported."""
+    global _type_maps
+
+    if _type_maps is None:
+        # (sql type, storage type, analytical type)
+        sql_to_brewery_types = (
+            (sqlalchemy.types.UnicodeText, "text", "typeless"),
+            (sqlalchemy.types.Text, "text", "typeless"),
+            (sqlalchemy.types.Unicode, "string", "set"),
+            (sqlalchemy.types.String, "string", "set"),
+            (sqlalchemy.types.Integer, "integer", "discrete"),
+            (sqlalchemy.types.Numeric, "float", "range"),
+            (sqlalchemy.types.DateTime, "date", "typeless"),
+            (sqlalchemy.types.Date, "date", "typeless"),
+            (sqlalchemy.types.Time, "unknown", "typeless"),
+            (sqlalchemy.types.Interval, "unknown", "typeless"),
+            (sqlalchemy.types.Boolean, "boolean", "flag"),
+            (sqlalchemy.types.Binary, "unknown", "typeless")
+        )
+
+        concrete_sql_type_map = {
+            "string": sqlalchemy.types.Unicode,
+            "text": sqlalchemy.types.UnicodeText,
+            "date": sqlalchemy.types.Date,
+            "time": sqlalchemy.types.DateTime,
+            "integer": sqlalchemy.types.Integer,
+            "float": sqlalchemy.types.Numeric,
+            "boolean": sqlalchemy.types.SmallInteger
+        }
+        _type_maps = (sql_to_brewery_types, concrete_sql_type_map)
+
+    return _type_maps
+
+# Drivers able to stream results with server-side cursors (the `stream_results`
+# execution option)
+_streaming_drivers = ("psycopg2", )
+
+# Dialects whose drivers fetch whole result to the client by default
+_buffering_dialects = ("mysql", )
+
+# Bulk insert methods of the SQL data target
+_bulk_methods = ("auto", "dicts", "executemany", "multirow", "copy", "load_data")
+
+# Upsert methods of the SQL data target
+_upsert_methods = ("auto", "on_conflict", "on_duplicate_key", "staging")
+
+# Column numbering rows of staging tables in order of insertion
+_staging_row_column = "_staging_row"
+
+# Parameter placeholders of positional DB API parameter styles. Drivers with
+# the ``pyformat`` style accept ``%s`` with tuples as well.
+_placeholders = {"qmark": "?", "format": "%s", "pyformat": "%s"}
+
+def _copy_text(value, true="t", false="f"):
+    """Return `value` as a field of PostgreSQL ``COPY`` or MySQL ``LOAD DATA``
+    text format: tab-separated, ``\\N`` is NULL, special characters are
+    escaped with a backslash."""
+    if value is None:
+        return "\\N"
+    if value is True:
+        return true
+    if value is False:
+        return false
+    if isinstance(value, float):
+        # str() would round to 12 significant digits
+        return repr(value)
+    if isinstance(value, unicode):
+        value = value.encode("utf-8")
+    elif not isinstance(value, str):
+        value = str(value)
+    return value.replace("\\", "\\\\").replace("\t", "\\t") \
+                .replace("\n", "\\n").replace("\r", "\\r")
 
 def split_table_schema(table_name):
     """Get schema and table name from table reference.
@@ -50,6 +111,67 @@ def split_table_schema(table_name):
     else:
         return (None, split[0])
 
+# Process-wide engines by URL and reflected tables by engine. Metadata of
+# reflected tables is not bound, so the engine key can be collected.
+_engines = {}
+_reflected = weakref.WeakKeyDictionary()
+_registry_lock = threading.Lock()
+
+def sql_engine(url, **options):
+    """Return SQLAlchemy engine for `url`, created with `options` on first
+    use. Engines (and their connection pools) are shared by all SQL streams,
+    nodes and stream runs of the process."""
+    key = (str(url), tuple(sorted(options.items())))
+    with _registry_lock:
+        engine = _engines.get(key)
+        if engine is None:
+            engine = sqlalchemy.create_engine(url, **options)
+            _engines[key] = engine
+        return engine
+
+def _engine_metadata(engine):
+    """Return tuple (`metadata`, `lock`) of tables reflected from `engine`."""
+    with _registry_lock:
+        entry = _reflected.get(engine)
+        if entry is None:
+            entry = (sqlalchemy.MetaData(), threading.Lock())
+            _reflected[engine] = entry
+        return entry
+
+def reflected_table(engine, name, schema=None):
+    """Return table `name` reflected from the database of `engine`. Table is
+    reflected once and shared until :func:`forget_table` or
+    :func:`clear_sql_caches` is called. The table is not bound to the engine,
+    its statements have to be executed explicitly by an engine or a
+    connection."""
+    (metadata, lock) = _engine_metadata(engine)
+    key = "%s.%s" % (schema, name) if schema else name
+    with lock:
+        table = metadata.tables.get(key)
+        if table is None:
+            table = sqlalchemy.Table(name, metadata, autoload=True,
+                                     autoload_with=engine, schema=schema)
+        return table
+
+def forget_table(engine, name, schema=None):
+    """Remove reflected table `name` from the cache, for example when the
+    table was created or replaced."""
+    (metadata, lock) = _engine_metadata(engine)
+    key = "%s.%s" % (schema, name) if schema else name
+    with lock:
+        table = metadata.tables.get(key)
+        if table is not None:
+            metadata.remove(table)
+
+def clear_sql_caches():
+    """Forget all reflected tables and dispose connection pools of the
+    shared engines."""
+    with _registry_lock:
+        engines = _engines.values()
+        _engines.clear()
+        _reflected.clear()
+    for engine in engines:
+        engine.dispose()
 
 class SQLContext(object):
     """Holds context of SQL store operations."""
@@ -67,7 +189,7 @@ class SQLContext(object):
             self.connection = connection
             self.should_close = False
         else:
-            engine = sqlalchemy.create_engine(url)
+            engine = sql_engine(url)
             self.connection = engine.connect()
             self.should_close = True
 
@@ -80,11 +202,24 @@ class SQLContext(object):
             self.connection.close()
 
     def table(self, name, autoload=True):
-        """Get table by name"""
+        """Get table by name. Reflected tables are shared by all contexts of
+        the engine, see :func:`reflected_table`."""
 
+        if autoload:
+            return reflected_table(self.metadata.bind, name, self.schema)
         return sqlalchemy.Table(name, self.metadata,
                                 autoload=autoload, schema=self.schema)
 
+    def execute(self, statement, **params):
+        """Execute `statement` with the engine of the context. Statements are
+        not executed with the context connection, which might belong to
+        another thread."""
+        return self.metadata.bind.execute(statement, **params)
+
+    def forget_table(self, name):
+        """Remove table `name` from the reflected tables cache."""
+        forget_table(self.metadata.bind, name, self.schema)
+
 def fields_from_table(table):
     """Get fields from a table. Field types are normalized to the Brewery
     data types. Analytical type is set according to a default conversion
@@ -96,7 +231,7 @@ def fields_from_table(table):
         field = brewery.metadata.Field(name=column.name)
         field.concrete_storage_type = column.type
 
-        for conv in _sql_to_brewery_types:
+        for conv in _sql_type_maps()[0]:
             if issubclass(column.type.__class__, conv[0]):
                 field.storage_type = conv[1]
                 field.analytical_type = conv[2]
@@ -112,6 +247,181 @@ def fields_from_table(table):
 
     return brewery.metadata.FieldList(fields)
 
+# (python type, storage type, analytical type) of statement result values
+_value_types = (
+    (bool, "boolean", "flag"),
+    ((int, long), "integer", "discrete"),
+    ((float, decimal.Decimal), "float", "range"),
+    ((datetime.date, datetime.datetime), "date", "typeless"),
+    (basestring, "string", "set")
+)
+
+def fields_from_result(names, row=None):
+    """Get fields of a statement result with column `names`. Field types are
+    guessed from values of a sample `row`, fields are ``unknown`` if there is
+    no row or the value is empty."""
+    fields = brewery.metadata.FieldList()
+    for i, name in enumerate(names):
+        field = brewery.metadata.Field(name=name)
+        if row is not None and row[i] is not None:
+            for conv in _value_types:
+                if isinstance(row[i], conv[0]):
+                    field.storage_type = conv[1]
+                    field.analytical_type = conv[2]
+                    break
+        fields.append(field)
+
+    return fields
+
+class SQLResultCache(object):
+    """Local cache of SQL statement results. Results are stored in files in a
+    directory, keyed by database URL, statement text and parameters. Entry is
+    valid until its time to live passes or until the freshness token given by
+    the data source changes.
+
+    Cached results are pickled, so they are read only from a directory owned
+    by the current user and not writable by others - other users could
+    otherwise plant files executing code when they are read."""
+
+    def __init__(self, path=None):
+        """Creates a statement result cache.
+
+        :Attributes:
+            * `path` - directory with cached results, created with access for
+              the current user only if it does not exist. Default is
+              ``brewery/sql`` in the user cache directory (``$XDG_CACHE_HOME``
+              or ``~/.cache``).
+        """
+        super(SQLResultCache, self).__init__()
+        if not path:
+            base = os.environ.get("XDG_CACHE_HOME") \
+                        or os.path.join(os.path.expanduser("~"), ".cache")
+            path = os.path.join(base, "brewery", "sql")
+        self.path = path
+
+    def _check_path(self):
+        """Raise `IOError` if the cache directory is not private to the
+        current user. Returns ``False`` if the directory does not exist."""
+        try:
+            info = os.stat(self.path)
+        except OSError:
+            return False
+        if hasattr(os, "getuid") and (info.st_uid != os.getuid()
+                                      or info.st_mode & 0o022):
+            raise IOError("SQL result cache directory '%s' is not owned by "
+                          "the current user or is writable by others"
+                          % self.path)
+        return True
+
+    def key(self, url, statement, params=None):
+        """Return cache key of a `statement` with `params` executed on the
+        database at `url`."""
+        params = sorted((params or {}).items())
+        text = repr((str(url), unicode(statement), params))
+        return hashlib.sha1(text).hexdigest()
+
+    def _entry_path(self, key, extension):
+        return os.path.join(self.path, key + extension)
+
+    def entry(self, key, ttl=None, token=None):
+        """Return description of a valid cache entry - dictionary with keys
+        `created`, `token`, `fields` and `count` - or ``None`` if the entry
+        does not exist, is older than `ttl` seconds or was stored with another
+        freshness `token`."""
+        if not self._check_path():
+            return None
+        try:
+            with open(self._entry_path(key, ".meta"), "rb") as handle:
+                entry = pickle.load(handle)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return None
+
+        if ttl is not None and time.time() - entry["created"] > ttl:
+            return None
+        if entry["token"] != token:
+            return None
+        return entry
+
+    def rows(self, key):
+        """Iterate over rows of cache entry `key`."""
+        self._check_path()
+        with open(self._entry_path(key, ".rows"), "rb") as handle:
+            unpickler = pickle.Unpickler(handle)
+            while True:
+                try:
+                    rows = unpickler.load()
+                except EOFError:
+                    break
+                for row in rows:
+                    yield row
+
+    def store(self, key, names, rows, token=None, chunk_size=1000):
+        """Store `rows` of a result with column `names` under `key`. Returns
+        an iterator passing the rows as they are stored. Entry is valid only
+        after the iterator is exhausted."""
+        if not os.path.exists(self.path):
+            try:
+                os.makedirs(self.path, 0o700)
+            except OSError:
+                # Created by another process meanwhile
+                pass
+        self._check_path()
+
+        (fd, temp_path) = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        count = 0
+        sample = None
+        complete = False
+        try:
+            with os.fdopen(fd, "wb") as handle:
+                pickler = pickle.Pickler(handle, pickle.HIGHEST_PROTOCOL)
+                chunk = []
+                for row in rows:
+                    row = tuple(row)
+                    chunk.append(row)
+                    if len(chunk) >= chunk_size:
+                        pickler.dump(chunk)
+                        pickler.clear_memo()
+                        chunk = []
+                    if sample is None:
+                        sample = row
+                    count += 1
+                    yield row
+                if chunk:
+                    pickler.dump(chunk)
+
+            fields = fields_from_result(names, sample)
+            entry = {
+                "created": time.time(),
+                "token": token,
+                "fields": [(f.name, f.storage_type, f.analytical_type)
+                                for f in fields],
+                "count": count
+            }
+
+            # Rows are replaced before the description, stale description
+            # is removed first so it does not refer to new rows
+            meta_path = self._entry_path(key, ".meta")
+            if os.path.exists(meta_path):
+                os.remove(meta_path)
+            os.rename(temp_path, self._entry_path(key, ".rows"))
+
+            (fd, temp_path) = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+            with os.fdopen(fd, "wb") as handle:
+                pickle.dump(entry, handle, pickle.HIGHEST_PROTOCOL)
+            os.rename(temp_path, meta_path)
+            complete = True
+        finally:
+            if not complete and os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def invalidate(self, key=None):
+        """Remove cache entry `key` or all entries if no key is given."""
+        if not os.path.exists(self.path):
+            return
+        for name in os.listdir(self.path):
+            if key is None or name.startswith(key + "."):
+                os.remove(os.path.join(self.path, name))
+
 def concrete_storage_type(field, type_map={}):
     """Derives a concrete storage type for the field based on field conversion
        dictionary"""
@@ -123,7 +433,7 @@ def concrete_storage_type(field, type_map={}):
             concrete_type = type_map.get(field.storage_type)
 
         if not concrete_type:
-            concrete_type = concrete_sql_type_map.get(field.storage_type)
+            concrete_type = _sql_type_maps()[1].get(field.storage_type)
 
         if not concrete_type:
             raise ValueError("unable to find concrete storage type for field '%s' "
@@ -136,17 +446,67 @@ class SQLDataSource(base.DataSource):
     """
     def __init__(self, connection=None, url=None,
                     table=None, statement=None, schema=None, autoinit = True,
-                    **options):
+                    keep_fields=None, fetch="auto", chunk_size=1000, key=None,
+                    partition_column=None, partitions=1, partition_method="range",
+                    ordered=False, params=None, cache=None, cache_ttl=None,
+                    cache_check=None, **options):
         """Creates a relational database data source stream.
 
         :Attributes:
             * url: SQLAlchemy URL - either this or connection should be specified
             * connection: SQLAlchemy database connection - either this or url should be specified
             * table: table name
-            * statement: SQL statement to be used as a data source (not supported yet)
+            * statement: SQL statement to be used as a data source - text with
+              ``:name`` parameters or a SQLAlchemy selectable. Fields are
+              inferred from the result if they are not set.
             * autoinit: initialize on creation, no explicit initialize() is
               needed
+            * keep_fields: list of fields (columns) to be read, default is all
+              fields
+            * fetch: how rows are fetched from the database:
+              ``stream`` - server-side cursor (`stream_results`, supported by
+              psycopg2), ``cursor`` - client cursor, ``keyset`` - pages of
+              `chunk_size` rows ordered by `key`, each read by a separate
+              query, for drivers that would otherwise buffer whole result in
+              the client. Default is ``auto``: ``stream`` if the driver
+              supports it, ``keyset`` for MySQL, otherwise ``cursor``.
+            * chunk_size: number of rows fetched at once, default is 1000
+            * key: unique not-null column used by the ``keyset`` fetch, default
+              is the primary key of the table (if it has one column)
+            * partition_column: column used to split the table into
+              `partitions` read concurrently, each through its own connection
+            * partitions: number of partitions (concurrent connections),
+              default is 1 - no partitioning
+            * partition_method: ``range`` - equal ranges between minimum and
+              maximum of a numeric or date column (default), ``hash`` - rows
+              with the same ``ABS(column) MOD partitions`` of an integer column
+            * ordered: if ``True`` partitions are passed one after another,
+              each ordered by the partition column - rows of ``range``
+              partitions are ordered by the column. Default is ``False``: rows
+              are passed as they are read from any partition.
+            * params: dictionary of `statement` parameters
+            * cache: cache `statement` results locally - a
+              :class:`SQLResultCache`, path to a cache directory or ``True``
+              for the default cache directory
+            * cache_ttl: number of seconds a cached result is valid, default
+              is no limit
+            * cache_check: function called with the SQLAlchemy engine,
+              returning a freshness token (such as last update time of the
+              source tables). Cached result is used only while the token is
+              the same as when the result was stored.
             * options: SQL alchemy connect() options
+
+        Rows might be filtered in the database with :meth:`push_predicate`.
+        Rows are passed as they are fetched, memory used by the source does
+        not depend on the size of the table.
+
+        Fields of a statement source are inferred from the first row of the
+        statement result, set `fields` before initialization to avoid it. The
+        result is kept open and its rows are passed by the first
+        :meth:`rows`, the statement is not executed twice. With a cache the
+        statement result is stored on the first execution.
+        Predicates, projections and aggregations are not pushed into
+        statements.
         """
 
         super(SQLDataSource, self).__init__()
@@ -155,10 +515,6 @@ class SQLDataSource(base.DataSource):
             raise AttributeError("Either table or statement should be " \
                                  "provided for SQL data source")
 
-        if statement:
-            raise NotImplementedError("SQL source stream based on statement " \
-                                      "is not yet implemented")
-
         if not options:
             options = {}
 
@@ -170,9 +526,38 @@ class SQLDataSource(base.DataSource):
         self.schema = schema
         self.options = options
 
+        if fetch not in ("auto", "stream", "cursor", "keyset"):
+            raise ValueError("Unknown SQL fetch method '%s'" % fetch)
+        if partition_method not in ("range", "hash"):
+            raise ValueError("Unknown SQL partition method '%s'" % partition_method)
+
+        self.keep_fields = keep_fields
+        self.fetch = fetch
+        self.chunk_size = chunk_size
+        self.key = key
+        self.partition_column = partition_column
+        self.partitions = partitions
+        self.partition_method = partition_method
+        self.ordered = ordered
+        self.params = params or {}
+        self.cache_ttl = cache_ttl
+        self.cache_check = cache_check
+        if cache is True:
+            cache = SQLResultCache()
+        elif isinstance(cache, basestring):
+            cache = SQLResultCache(cache)
+        self.cache = cache
+        self.predicate = None
+        self.pushed_fields = None
+        self.aggregation = None
+
         self.context = None
         self.table = None
         self.fields = None
+        self._all_fields = None
+        # Result of the statement executed to read fields and its first row,
+        # passed by the next rows()
+        self._first_result = None
 
         if autoinit:
             self.initialize()
@@ -183,23 +568,394 @@ class SQLDataSource(base.DataSource):
         """
         if not self.context:
             self.context = SQLContext(self.url, self.connection, self.schema)
-        if self.table is None:
+        if self.table is None and self.statement is None:
             self.table = self.context.table(self.table_name)
         if not self.fields:
             self.read_fields()
+        if self._all_fields is None:
+            self._all_fields = self.fields
+
+        fields = self._all_fields
+        if self.keep_fields:
+            fields = brewery.metadata.FieldMap(keep=self.keep_fields).map(fields)
+        if self.pushed_fields:
+            fields = self.pushed_fields.map(fields)
+        if self.aggregation:
+            fields = self.aggregation.output_fields(fields)
+        self.fields = fields
         self.field_names = self.fields.names()
 
+    def push_predicate(self, predicate):
+        """Filter rows in the database with `predicate` (``WHERE`` clause)."""
+        if self.statement is not None:
+            return False
+        self.predicate = predicate
+        return True
+
+    def push_fields(self, keep_fields=None, drop_fields=None):
+        """Read only `keep_fields` or skip `drop_fields` (columns of the ``SELECT`` statement).
+        Fields are changed on next :meth:`initialize`."""
+        if self.statement is not None:
+            return False
+        if keep_fields or drop_fields:
+            self.pushed_fields = brewery.metadata.FieldMap(keep=keep_fields,
+                                                           drop=drop_fields)
+        else:
+            self.pushed_fields = None
+        return True
+
+    def push_aggregation(self, aggregation):
+        """Read rows aggregated with a ``GROUP BY`` statement. Fields are changed on next
+        :meth:`initialize`."""
+        if self.statement is not None:
+            return False
+        self.aggregation = aggregation
+        return True
+
     def finalize(self):
+        self._close_first_result()
         self.context.close()
 
+    def _close_first_result(self):
+        if self._first_result is not None:
+            self._first_result[0].close()
+            self._first_result = None
+
     def read_fields(self):
-        self.fields = fields_from_table(self.table)
+        if self.statement is None:
+            self.fields = fields_from_table(self.table)
+        elif self.cache:
+            key = self._cache_key()
+            token = self._cache_token()
+            entry = self.cache.entry(key, self.cache_ttl, token)
+            if entry is None:
+                for row in self._store_result(key, token):
+                    pass
+                entry = self.cache.entry(key, None, token)
+            self.fields = brewery.metadata.FieldList(entry["fields"])
+        else:
+            self._close_first_result()
+            result = self.context.execute(self._executable(), **self.params)
+            row = None
+            try:
+                row = result.fetchone()
+                self.fields = fields_from_result(result.keys(), row)
+            finally:
+                if row is None:
+                    result.close()
+            if row is not None:
+                self._first_result = (result, row)
+
+        self._all_fields = self.fields
         return self.fields
 
+    def selection(self):
+        """Return the ``SELECT`` statement of the source."""
+        if self.statement is not None:
+            if isinstance(self.statement, basestring):
+                return sqlalchemy.sql.expression.text(self.statement,
+                                                  bind=self.context.metadata.bind)
+            return self.statement
+        if self.aggregation:
+            statement = self.aggregation.sql_statement(self.table.c)
+        elif self.keep_fields or self.pushed_fields:
+            columns = [self.table.c[name] for name in self.field_names]
+            statement = sqlalchemy.sql.expression.select(columns)
+        else:
+            statement = self.table.select()
+
+        if self.predicate is not None:
+            statement = statement.where(self.predicate.sql_clause(self.table.c))
+
+        return statement
+
+    def fetch_method(self):
+        """Return fetch method used for reading rows: ``stream``, ``cursor``
+        or ``keyset``. See `fetch` attribute of the data source."""
+        dialect = self.context.connection.dialect
+        method = self.fetch
+        if method == "auto":
+            if dialect.driver in _streaming_drivers:
+                method = "stream"
+            elif dialect.name in _buffering_dialects:
+                method = "keyset"
+            else:
+                method = "cursor"
+
+        if method == "keyset" and (self.statement is not None or self.aggregation
+                                   or self._key_column() is None):
+            if self.fetch == "keyset":
+                raise ValueError("Keyset fetch requires a single-column key of table '%s'"
+                                 % self.table_name)
+            method = "cursor"
+
+        return method
+
+    def _key_column(self):
+        if self.key:
+            return self.table.c[self.key]
+        keys = list(self.table.primary_key.columns)
+        if len(keys) == 1:
+            return keys[0]
+        return None
+
     def rows(self):
         if not self.context:
             raise RuntimeError("Stream is not initialized")
-        return self.table.select().execute()
+
+        if self.statement is not None:
+            return self._statement_rows()
+
+        method = self.fetch_method()
+        statement = self.selection()
+
+        if self.partition_column and self.partitions > 1 and not self.aggregation:
+            clauses = self.partition_clauses()
+            if clauses:
+                column = self.table.c[self.partition_column]
+                statements = []
+                for clause in clauses:
+                    partition = statement.where(clause)
+                    if self.ordered:
+                        partition = partition.order_by(column)
+                    if method == "stream":
+                        partition = partition.execution_options(stream_results=True)
+                    statements.append(partition)
+                return self._partitioned_rows(statements)
+
+        if method == "keyset":
+            return self._keyset_rows(statement)
+        if method == "stream":
+            statement = statement.execution_options(stream_results=True)
+        rows = self._fetch_rows(statement)
+        if self.aggregation:
+            rows = itertools.imap(self._aggregation_converter(), rows)
+        return rows
+
+    def _aggregation_converter(self):
+        """Return function converting aggregated rows to the value types of
+        the :class:`AggregateNode`: sums, minimums and maximums of integer
+        and float fields are `int` and `float`, averages are `float`. Some
+        databases return ``Decimal`` for ``SUM`` and ``AVG``."""
+        types = {"integer": int, "float": float}
+        converters = [None] * len(self.aggregation.keys)
+        for measure in self.aggregation.measures:
+            value_type = types.get(self._all_fields.field(measure).storage_type)
+            converters += [value_type, value_type, value_type, float]
+        converters.append(int)
+
+        def convert(row):
+            return [value if value is None or function is None else function(value)
+                        for function, value in zip(converters, row)]
+        return convert
+
+    def _statement_rows(self):
+        """Rows of the statement source, read from the cache if possible."""
+        if self.cache:
+            rows = self._cached_rows()
+        elif self._first_result is not None:
+            (result, row) = self._first_result
+            self._first_result = None
+            rows = itertools.chain([row], self._fetch_result(result))
+        else:
+            rows = self._fetch_rows(self._executable(), self.params)
+
+        if self.keep_fields:
+            row_filter = brewery.metadata.FieldMap(keep=self.keep_fields) \
+                                        .row_filter(self._all_fields)
+            rows = itertools.imap(row_filter, rows)
+
+        return rows
+
+    def _executable(self):
+        statement = self.selection()
+        if self.fetch_method() == "stream":
+            statement = statement.execution_options(stream_results=True)
+        return statement
+
+    def _cache_key(self):
+        engine = self.context.metadata.bind
+        statement = self.selection()
+        # Values bound in a selectable are not part of the statement text
+        params = dict(statement.compile(bind=engine).params)
+        params.update(self.params)
+        return self.cache.key(engine.url, statement, params)
+
+    def _cache_token(self):
+        if self.cache_check:
+            return self.cache_check(self.context.metadata.bind)
+        return None
+
+    def _cached_rows(self):
+        """Return statement rows from the cache. Statement is executed and
+        its result stored if there is no valid cache entry."""
+        key = self._cache_key()
+        token = self._cache_token()
+        if self.cache.entry(key, self.cache_ttl, token) is not None:
+            return self.cache.rows(key)
+        return self._store_result(key, token)
+
+    def _store_result(self, key, token):
+        """Execute the statement, return its rows stored as they are read."""
+        result = self.context.execute(self._executable(), **self.params)
+        rows = self._fetch_result(result)
+        return self.cache.store(key, result.keys(), rows, token,
+                                chunk_size=self.chunk_size)
+
+    def _fetch_rows(self, statement, params=None):
+        """Yield rows of `statement` fetched in chunks."""
+        result = self.context.execute(statement, **(params or {}))
+        return self._fetch_result(result)
+
+    def _fetch_result(self, result):
+        """Yield rows of `result` fetched in chunks."""
+        try:
+            while True:
+                rows = result.fetchmany(self.chunk_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            result.close()
+
+    def _keyset_rows(self, statement):
+        """Yield rows of `statement` read in pages ordered by the key column.
+        Each page is a separate query continuing after the last key."""
+        key = self._key_column()
+        names = self.field_names
+        hidden = key.name not in names
+        if hidden:
+            statement = statement.column(key)
+            index = len(names)
+        else:
+            index = names.index(key.name)
+
+        statement = statement.order_by(key).limit(self.chunk_size)
+        last = None
+        while True:
+            if last is None:
+                page = statement
+            else:
+                page = statement.where(key > last)
+
+            rows = self.context.execute(page).fetchall()
+            for row in rows:
+                yield tuple(row)[:-1] if hidden else row
+
+            if len(rows) < self.chunk_size:
+                break
+            last = rows[-1][index]
+
+    def partition_clauses(self):
+        """Return list of ``WHERE`` clauses, one for each partition. Rows with
+        empty partition column belong to the first partition. Returns empty
+        list if the rows can not be split (empty table or one value)."""
+        column = self.table.c[self.partition_column]
+        count = self.partitions
+
+        if self.partition_method == "hash":
+            if not isinstance(column.type, sqlalchemy.types.Integer):
+                raise ValueError("Hash partitioning requires an integer column, "
+                                 "'%s' is not" % column.name)
+            bucket = sqlalchemy.func.abs(column) % count
+            clauses = [bucket == i for i in range(count)]
+            clauses[0] = sqlalchemy.or_(clauses[0], column == None)
+            return clauses
+
+        bounds = self.partition_bounds()
+        if not bounds:
+            return []
+
+        clauses = [sqlalchemy.or_(column < bounds[0], column == None)]
+        for low, high in zip(bounds[:-1], bounds[1:]):
+            clauses.append(sqlalchemy.and_(column >= low, column < high))
+        clauses.append(column >= bounds[-1])
+        return clauses
+
+    def partition_bounds(self):
+        """Return list of values splitting range of the partition column into
+        equal parts. Minimum and maximum are read from the database."""
+        column = self.table.c[self.partition_column]
+        func = sqlalchemy.func
+        statement = sqlalchemy.sql.expression.select([func.min(column),
+                                                      func.max(column)])
+        if self.predicate is not None:
+            statement = statement.where(self.predicate.sql_clause(self.table.c))
+        (low, high) = self.context.execute(statement).fetchone()
+
+        if low is None or low == high:
+            return []
+
+        try:
+            step = high - low
+            bounds = [low + step * i / self.partitions
+                        for i in range(1, self.partitions)]
+        except TypeError:
+            raise ValueError("Range partitioning requires a numeric or date "
+                             "column, '%s' is not" % column.name)
+
+        # Small integer ranges give repeated bounds
+        return sorted(set(bound for bound in bounds if bound > low))
+
+    def _partitioned_rows(self, statements):
+        """Yield rows of `statements` executed concurrently, each in its own
+        thread and connection."""
+        stop = threading.Event()
+        if self.ordered:
+            queues = [Queue.Queue(4) for statement in statements]
+        else:
+            queues = [Queue.Queue(4 * len(statements))] * len(statements)
+
+        def put(queue, item):
+            # Abandoned consumer does not read the queue any more
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    return
+                except Queue.Full:
+                    pass
+
+        def read(statement, queue):
+            try:
+                result = self.context.execute(statement)
+                try:
+                    while not stop.is_set():
+                        rows = result.fetchmany(self.chunk_size)
+                        if not rows:
+                            break
+                        put(queue, ("rows", rows))
+                finally:
+                    result.close()
+            except Exception:
+                put(queue, ("error", sys.exc_info()))
+            else:
+                put(queue, ("end", None))
+
+        for i, (statement, queue) in enumerate(zip(statements, queues)):
+            thread = threading.Thread(target=read, args=(statement, queue),
+                                      name="brewery-sql-partition-%d" % i)
+            thread.daemon = True
+            thread.start()
+
+        try:
+            if self.ordered:
+                readers = [(queue, 1) for queue in queues]
+            else:
+                readers = [(queues[0], len(statements))]
+
+            for queue, remaining in readers:
+                while remaining:
+                    (kind, value) = queue.get()
+                    if kind == "rows":
+                        for row in value:
+                            yield row
+                    elif kind == "end":
+                        remaining -= 1
+                    else:
+                        raise value[0], value[1], value[2]
+        finally:
+            stop.set()
 
     def records(self):
         if not self.context:
@@ -217,7 +973,9 @@ class SQLDataTarget(base.DataTarget):
                     create=False, replace=False,
                     add_id_key=False, id_key_name=None,
                     buffer_size=None, fields=None, concrete_type_map=None,
-                    **options):
+                    bulk="auto", commit_size=None, writers=1, commit="batch",
+                    partition_field=None, mode="insert", keys=None,
+                    upsert_method="auto", **options):
         """Creates a relational database data target stream.
 
         :Attributes:
@@ -235,9 +993,47 @@ class SQLDataTarget(base.DataTarget):
             * buffer_size: size of INSERT buffer - how many records are collected before they are
               inserted using multi-insert statement. Default is 1000
             * fields : fieldlist for a new table
+            * bulk: how the buffered rows are inserted: ``executemany`` -
+              one prepared ``INSERT`` executed with all rows, ``multirow`` -
+              ``INSERT`` statements with many ``VALUES`` rows, ``copy`` -
+              PostgreSQL ``COPY FROM STDIN`` (psycopg2), ``load_data`` -
+              MySQL ``LOAD DATA LOCAL INFILE`` (requires `local_infile` to be
+              enabled for the connection), ``dicts`` - SQLAlchemy insert with
+              a dictionary for each row. Default is ``auto``: ``copy`` for
+              psycopg2, ``multirow`` for SQLite, otherwise ``executemany``
+              if the driver accepts positional parameters.
+            * commit_size: number of rows inserted in one transaction, default
+              is one transaction for each buffer
+            * writers: number of connections inserting buffers concurrently,
+              default is 1. Rows of concurrent writers are inserted in no
+              particular order.
+            * commit: ``batch`` - each writer commits its rows as they are
+              inserted (see `commit_size`), already committed rows stay in
+              the table if the load fails. ``all`` - writers insert into a
+              staging table, rows are moved to the target table in one
+              transaction by :meth:`flush` (together with the `truncate`),
+              the target table is not changed if the load fails.
+            * partition_field: with more writers, rows with the same value of
+              this field are inserted by the same writer - each writer writes
+              to a subset of partitions of a partitioned table
+            * mode: ``insert`` (default) or ``upsert`` - rows with existing
+              `keys` update the table rows, only rows with changed values are
+              written
+            * keys: list of key fields of the ``upsert`` mode. Keys should
+              have a unique constraint (it is created with the table),
+              except for the ``staging`` method.
+            * upsert_method: ``on_conflict`` - ``INSERT ... ON CONFLICT DO
+              UPDATE`` (SQLite 3.24, PostgreSQL 9.5), ``on_duplicate_key`` -
+              MySQL ``INSERT ... ON DUPLICATE KEY UPDATE``, ``staging`` -
+              rows are inserted into a staging table and merged with
+              ``UPDATE`` and ``INSERT`` statements, for other databases.
+              Default is ``auto`` - chosen by the database.
 
         Note: avoid auto-detection when you are reading from remote URL stream.
 
+        Rows are written through a connection opened by the thread which
+        writes first. Call :meth:`flush` from that thread after the last row
+        to write the remaining rows and commit, before :meth:`finalize`.
         """
         if not options:
             options = {}
@@ -252,6 +1048,27 @@ class SQLDataTarget(base.DataTarget):
         self.truncate = truncate
         self.add_id_key = add_id_key
 
+        if bulk not in _bulk_methods:
+            raise ValueError("Unknown SQL bulk insert method '%s'" % bulk)
+        if commit not in ("batch", "all"):
+            raise ValueError("Unknown SQL commit mode '%s'" % commit)
+        if mode not in ("insert", "upsert"):
+            raise ValueError("Unknown SQL target mode '%s'" % mode)
+        if mode == "upsert" and not keys:
+            raise ValueError("Upsert mode requires keys")
+        if upsert_method not in _upsert_methods:
+            raise ValueError("Unknown SQL upsert method '%s'" % upsert_method)
+        self.bulk = bulk
+        self.commit_size = commit_size
+        self.writers = writers
+        self.commit = commit
+        self.partition_field = partition_field
+        self.mode = mode
+        self.keys = keys
+        self.upsert_method = upsert_method
+        self.staging_table = None
+        self.merge_table = None
+
         self.table = None
         self.fields = fields
 
@@ -280,16 +1097,147 @@ class SQLDataTarget(base.DataTarget):
         else:
             self.table = self.context.table(self.table_name)
 
-        if self.truncate:
-            self.table.delete().execute()
+        # Table is truncated in the transaction which moves staged rows
+        if self.truncate and self.commit != "all":
+            self.context.execute(self.table.delete())
 
         if not self.fields:
             self.fields = fields_from_table(self.table)
 
         self.field_names = self.fields.names()
 
+        if self.mode == "upsert":
+            for key in self.keys:
+                if key not in self.field_names:
+                    raise ValueError("Upsert key '%s' is not a field" % key)
+
+        self._writer_threads = None
+        self._writer_failure = None
+        self._discard = False
+        if self.commit == "all":
+            self.staging_table = self._create_staging_table()
+        if self.writers > 1 or self.commit == "all":
+            self._writer_targets = self._create_writer_targets()
+            if self.partition_field:
+                self._partition_index = self.field_names.index(self.partition_field)
+        else:
+            self._writer_targets = None
+
         self.insert_command = self.table.insert()
         self._buffer = []
+        self._write_connection = None
+        self._own_connection = False
+        self._transaction = None
+        self._uncommitted = 0
+        self._statements = {}
+
+        dialect = self.context.metadata.bind.dialect
+        self.bulk_method = self._bulk_method(dialect)
+        if self.mode == "upsert":
+            self.upsert_method = self._upsert_method(dialect)
+            if self.upsert_method == "staging" and not self._writer_targets:
+                self.merge_table = self._create_staging_table()
+
+        # Values passed to the driver directly are converted as SQLAlchemy
+        # would convert them
+        self._processors = []
+        for name in self.field_names:
+            column_type = self.table.c[name].type.dialect_impl(dialect)
+            self._processors.append(column_type.bind_processor(dialect))
+        if not any(self._processors):
+            self._processors = None
+
+        # Context connection was opened by this thread, rows are written by
+        # connection of the writing thread
+        if self.context.should_close:
+            self.context.close()
+
+    def _create_staging_table(self):
+        """Create a table with the same columns as the target table, for
+        rows which are not committed to the target table yet. Staged rows
+        are numbered in order of insertion by the `_staging_row` column, in
+        the upsert mode the latest row of each key is merged."""
+        name = "%s_staging_%s" % (self.table.name, uuid.uuid4().hex[:8])
+        columns = [sqlalchemy.Column(column.name, column.type)
+                        for column in self.table.columns]
+        columns.append(sqlalchemy.Column(_staging_row_column, sqlalchemy.Integer,
+                                         primary_key=True))
+        if self.mode == "upsert":
+            columns.append(sqlalchemy.Index(name + "_keys", *self.keys))
+        table = sqlalchemy.Table(name, self.context.metadata, *columns,
+                                 schema=self.schema)
+        table.create()
+        return table
+
+    def _create_writer_targets(self):
+        """Create target for each concurrent writer."""
+        if self.staging_table is not None:
+            table_name = self.staging_table.name
+        else:
+            table_name = self.table_name
+
+        targets = []
+        # Staged rows are merged when they are moved to the target table
+        if self.staging_table is not None:
+            upsert = {}
+        else:
+            upsert = {"mode": self.mode, "keys": self.keys,
+                      "upsert_method": self.upsert_method}
+
+        for i in range(self.writers):
+            target = SQLDataTarget(connection=self.connection, url=self.url,
+                                   table=table_name, schema=self.schema,
+                                   fields=self.fields, bulk=self.bulk,
+                                   buffer_size=self.buffer_size,
+                                   commit_size=self.commit_size, **upsert)
+            target.initialize()
+            targets.append(target)
+        return targets
+
+    def _bulk_method(self, dialect):
+        """Return bulk insert method for `dialect`."""
+        method = self.bulk
+        if self.mode == "upsert":
+            if method == "auto":
+                method = "multirow"
+            elif method not in ("executemany", "multirow"):
+                raise ValueError("Bulk insert method '%s' does not support "
+                                 "upsert" % method)
+        elif method == "auto":
+            if dialect.driver == "psycopg2":
+                method = "copy"
+            elif dialect.name == "sqlite":
+                method = "multirow"
+            elif dialect.paramstyle in _placeholders:
+                method = "executemany"
+            else:
+                method = "dicts"
+
+        if method == "copy" and dialect.driver != "psycopg2":
+            raise ValueError("COPY bulk insert requires psycopg2 driver")
+        if method == "load_data" and dialect.name != "mysql":
+            raise ValueError("LOAD DATA bulk insert requires MySQL database")
+        if method in ("executemany", "multirow") \
+                and dialect.paramstyle not in _placeholders:
+            raise ValueError("Bulk insert method '%s' is not supported by "
+                             "parameter style '%s'" % (method, dialect.paramstyle))
+        return method
+
+    def _upsert_method(self, dialect):
+        """Return upsert method for `dialect`."""
+        method = self.upsert_method
+        if method != "auto":
+            return method
+
+        if dialect.name == "sqlite":
+            if dialect.dbapi.sqlite_version_info >= (3, 24, 0):
+                return "on_conflict"
+        elif dialect.name == "postgresql":
+            if (dialect.server_version_info or (0, )) >= (9, 5):
+                return "on_conflict"
+        elif dialect.name == "mysql":
+            return "on_duplicate_key"
+        return "staging"
 
     def _create_table(self):
         """Create a table."""
@@ -299,6 +1247,9 @@ class SQLDataTarget(base.DataTarget):
 
         table = self.context.table(self.table_name, autoload=False)
 
+        # Cached reflection of a replaced table would be stale
+        self.context.forget_table(self.table_name)
+
         if table.exists():
             if self.replace:
                 table = self.context.table(self.table_name, autoload=False)
@@ -329,28 +1280,440 @@ class SQLDataTarget(base.DataTarget):
             col = sqlalchemy.schema.Column(field.name, concrete_type)
             table.append_column(col)
 
+        if self.mode == "upsert":
+            table.append_constraint(sqlalchemy.schema.UniqueConstraint(*self.keys))
+
         table.create()
 
         return table
 
 
     def finalize(self):
-        """Closes the stream, flushes buffered data"""
+        """Closes the stream, flushes buffered data. Staged rows which were
+        not moved to the target table by :meth:`flush` are discarded."""
 
-        self._flush()
-        self.context.close()
+        try:
+            if self.staging_table is not None:
+                self._buffer = []
+                self._finish_writers(discard=True)
+            else:
+                self.flush()
+        finally:
+            self._drop_staging_table()
+            if self.merge_table is not None:
+                self.merge_table.drop(checkfirst=True)
+                self.merge_table = None
+            self.context.close()
 
     def append(self, obj):
         if type(obj) == dict:
-            record = obj
-        else:
-            record = dict(zip(self.field_names, obj))
+            obj = [obj.get(name) for name in self.field_names]
 
-        self._buffer.append(record)
+        self._buffer.append(obj)
         if len(self._buffer) >= self.buffer_size:
             self._flush()
 
+    def append_many(self, rows):
+        """Insert list of `rows` (lists or tuples) at once."""
+        self._flush()
+        if self._writer_targets:
+            self._submit(rows)
+        else:
+            self._write(rows)
+
+    def flush(self):
+        """Insert buffered rows, commit the transaction and close the
+        connection opened for writing. With concurrent writers or staged
+        commit waits for the writers and moves the staged rows to the target
+        table."""
+        self._flush()
+        if self._writer_targets:
+            self._finish_writers()
+            if self.staging_table is not None:
+                self._move_staged_rows()
+
+        if self._transaction:
+            self._commit()
+        if self._write_connection and self._own_connection:
+            self._write_connection.close()
+        self._write_connection = None
+
     def _flush(self):
         if len(self._buffer) > 0:
-            self.context.connection.execute(self.insert_command, self._buffer)
+            rows = self._buffer
             self._buffer = []
+            if self._writer_targets:
+                self._submit(rows)
+            else:
+                self._write(rows)
+
+    def _submit(self, rows):
+        """Pass `rows` to the concurrent writers."""
+        if self._writer_threads is None:
+            self._start_writers()
+
+        if self.partition_field:
+            index = self._partition_index
+            count = len(self._writer_queues)
+            parts = [[] for queue in self._writer_queues]
+            for row in rows:
+                parts[hash(row[index]) % count].append(row)
+            for queue, part in zip(self._writer_queues, parts):
+                if part:
+                    self._put(queue, part)
+        else:
+            self._put(self._writer_queues[0], rows)
+
+    def _put(self, queue, item):
+        while True:
+            self._check_writers()
+            try:
+                queue.put(item, timeout=0.1)
+                return
+            except Queue.Full:
+                pass
+
+    def _check_writers(self):
+        failure = self._writer_failure
+        if failure:
+            raise failure[0], failure[1], failure[2]
+
+    def _start_writers(self):
+        count = len(self._writer_targets)
+        if self.partition_field:
+            self._writer_queues = [Queue.Queue(2) for i in range(count)]
+            queues = self._writer_queues
+        else:
+            self._writer_queues = [Queue.Queue(2 * count)]
+            queues = self._writer_queues * count
+
+        def write(target, queue):
+            # Connection is opened, committed and closed by this thread
+            try:
+                while not self._writer_failure and not self._discard:
+                    try:
+                        rows = queue.get(timeout=0.1)
+                    except Queue.Empty:
+                        continue
+                    if rows is None:
+                        target.flush()
+                        return
+                    target.append_many(rows)
+            except Exception:
+                self._writer_failure = sys.exc_info()
+            target._abort()
+
+        self._writer_threads = []
+        for i, (target, queue) in enumerate(zip(self._writer_targets, queues)):
+            thread = threading.Thread(target=write, args=(target, queue),
+                                      name="brewery-sql-writer-%d" % i)
+            thread.daemon = True
+            thread.start()
+            self._writer_threads.append(thread)
+
+    def _finish_writers(self, discard=False):
+        """Wait for the writers to insert all submitted rows. If `discard` is
+        ``True`` writers stop without committing pending rows."""
+        if self._writer_threads is not None:
+            if discard:
+                self._discard = True
+            else:
+                # End of rows for each writer
+                count = 1 if self.partition_field else len(self._writer_threads)
+                for queue in self._writer_queues:
+                    for i in range(count):
+                        while not self._writer_failure:
+                            try:
+                                queue.put(None, timeout=0.1)
+                                break
+                            except Queue.Full:
+                                pass
+            for thread in self._writer_threads:
+                thread.join()
+            self._writer_threads = None
+
+        targets = self._writer_targets or []
+        self._writer_targets = None
+        for target in targets:
+            target.finalize()
+        if not discard:
+            self._check_writers()
+
+    def _abort(self):
+        """Roll back pending rows and close the connection opened for
+        writing."""
+        self._buffer = []
+        if self._transaction:
+            self._transaction.rollback()
+            self._transaction = None
+            self._uncommitted = 0
+        if self._write_connection and self._own_connection:
+            self._write_connection.close()
+        self._write_connection = None
+
+    def _move_staged_rows(self):
+        """Move rows from the staging table to the target table in one
+        transaction."""
+        preparer = self.context.metadata.bind.dialect.identifier_preparer
+        if self.mode == "upsert":
+            statements = self._merge_statements(self.staging_table)
+        else:
+            columns = ", ".join(preparer.format_column(self.table.c[name])
+                                    for name in self.field_names)
+            statements = ["INSERT INTO %s (%s) SELECT %s FROM %s" % \
+                            (preparer.format_table(self.table), columns, columns,
+                             preparer.format_table(self.staging_table))]
+
+        connection = self._connection()
+        transaction = connection.begin()
+        try:
+            if self.truncate:
+                connection.execute(self.table.delete())
+            for statement in statements:
+                connection.execute(statement)
+            transaction.commit()
+        except:
+            transaction.rollback()
+            raise
+        self._drop_staging_table()
+
+    def _drop_staging_table(self):
+        if self.staging_table is not None:
+            table = self.staging_table
+            self.staging_table = None
+            table.drop(checkfirst=True)
+
+    def _connection(self):
+        if self._write_connection is None:
+            connection = self.context.connection
+            if self.context.should_close \
+                    or not isinstance(connection, sqlalchemy.engine.base.Connection):
+                # Engine or connection of another thread
+                connection = self.context.metadata.bind.connect()
+                self._own_connection = True
+            else:
+                self._own_connection = False
+            self._write_connection = connection
+        return self._write_connection
+
+    def _commit(self):
+        self._transaction.commit()
+        self._transaction = None
+        self._uncommitted = 0
+
+    def _write(self, rows):
+        """Insert `rows` with the bulk method, in a transaction."""
+        if not rows:
+            return
+
+        connection = self._connection()
+        if self._transaction is None:
+            self._transaction = connection.begin()
+
+        try:
+            if self.bulk_method == "dicts":
+                names = self.field_names
+                records = [dict(zip(names, row)) for row in rows]
+                connection.execute(self.insert_command, records)
+            else:
+                cursor = connection.connection.cursor()
+                try:
+                    if self.mode == "upsert":
+                        self._upsert(connection, cursor, rows)
+                    elif self.bulk_method == "copy":
+                        self._copy(cursor, rows)
+                    elif self.bulk_method == "load_data":
+                        self._load_data(cursor, rows)
+                    else:
+                        self._execute_many(cursor, rows)
+                finally:
+                    cursor.close()
+        except:
+            self._transaction.rollback()
+            self._transaction = None
+            self._uncommitted = 0
+            raise
+
+        self._uncommitted += len(rows)
+        if not self.commit_size or self._uncommitted >= self.commit_size:
+            self._commit()
+
+    def _insert_statement(self, row_count, table=None):
+        """Return ``INSERT`` statement with `row_count` rows of parameters
+        into `table`, default is the target table. In the upsert mode the
+        statement updates existing rows of the target table."""
+        table = table if table is not None else self.table
+        statement = self._statements.get((table.name, row_count))
+        if statement is None:
+            preparer = self.context.metadata.bind.dialect.identifier_preparer
+            placeholder = _placeholders[self.context.metadata.bind.dialect.paramstyle]
+            columns = ", ".join(preparer.format_column(table.c[name])
+                                    for name in self.field_names)
+            values = "(%s)" % ", ".join([placeholder] * len(self.field_names))
+            statement = "INSERT INTO %s (%s) VALUES %s" % \
+                            (preparer.format_table(table), columns,
+                             ", ".join([values] * row_count))
+            if table is self.table and self.mode == "upsert" \
+                    and self.upsert_method != "staging":
+                statement += " " + self._conflict_clause()
+            self._statements[(table.name, row_count)] = statement
+        return statement
+
+    def _conflict_clause(self):
+        """Return ``ON CONFLICT`` or ``ON DUPLICATE KEY`` clause of the
+        upsert statement. Rows are updated only if a value changes."""
+        dialect = self.context.metadata.bind.dialect
+        preparer = dialect.identifier_preparer
+        quote = preparer.quote_identifier
+        values = [name for name in self.field_names if name not in self.keys]
+
+        if self.upsert_method == "on_duplicate_key":
+            # MySQL does not write rows which are not changed
+            if not values:
+                values = self.keys[:1]
+            return "ON DUPLICATE KEY UPDATE " + \
+                   ", ".join("%s = VALUES(%s)" % (quote(name), quote(name))
+                                for name in values)
+
+        keys = ", ".join(quote(name) for name in self.keys)
+        if not values:
+            return "ON CONFLICT (%s) DO NOTHING" % keys
+
+        table = preparer.format_table(self.table)
+        if dialect.name == "sqlite":
+            distinct = "IS NOT"
+        else:
+            distinct = "IS DISTINCT FROM"
+        assignments = ", ".join("%s = excluded.%s" % (quote(name), quote(name))
+                                    for name in values)
+        changed = " OR ".join("%s.%s %s excluded.%s" % (table, quote(name),
+                                                       distinct, quote(name))
+                                    for name in values)
+        return "ON CONFLICT (%s) DO UPDATE SET %s WHERE %s" % \
+                    (keys, assignments, changed)
+
+    def _merge_statements(self, source):
+        """Return statements updating and inserting rows of the target table
+        from the `source` table. Only the latest row of each key is merged."""
+        preparer = self.context.metadata.bind.dialect.identifier_preparer
+        quote = preparer.quote_identifier
+        table = preparer.format_table(self.table)
+        source = preparer.format_table(source)
+        values = [name for name in self.field_names if name not in self.keys]
+
+        row = quote(_staging_row_column)
+        latest = "s.%s = (SELECT MAX(l.%s) FROM %s l WHERE %s)" % \
+                    (row, row, source,
+                     " AND ".join("l.%s = s.%s" % (quote(key), quote(key))
+                                    for key in self.keys))
+        exists = " AND ".join("s.%s = %s.%s" % (quote(key), table, quote(key))
+                                for key in self.keys)
+        match = "%s AND %s" % (exists, latest)
+        statements = []
+        if values:
+            assignments = ", ".join("%s = (SELECT s.%s FROM %s s WHERE %s)" %
+                                        (quote(name), quote(name), source, match)
+                                    for name in values)
+            # Null-safe comparison, rows without changes are not updated
+            changed = " OR ".join("CASE WHEN s.%s = %s.%s OR (s.%s IS NULL AND "
+                                  "%s.%s IS NULL) THEN 0 ELSE 1 END = 1" %
+                                  (quote(name), table, quote(name),
+                                   quote(name), table, quote(name))
+                                    for name in values)
+            statements.append("UPDATE %s SET %s WHERE EXISTS (SELECT 1 FROM %s s "
+                              "WHERE %s AND (%s))" % (table, assignments, source,
+                                                      match, changed))
+
+        columns = ", ".join(quote(name) for name in self.field_names)
+        selection = ", ".join("s.%s" % quote(name) for name in self.field_names)
+        statements.append("INSERT INTO %s (%s) SELECT %s FROM %s s WHERE %s "
+                          "AND NOT EXISTS (SELECT 1 FROM %s WHERE %s)" %
+                          (table, columns, selection, source, latest, table,
+                           exists))
+        return statements
+
+    def _unique_rows(self, rows):
+        """Return `rows` with the last row for each key."""
+        indexes = [self.field_names.index(key) for key in self.keys]
+        latest = {}
+        for i, row in enumerate(rows):
+            latest[tuple(row[index] for index in indexes)] = i
+        if len(latest) == len(rows):
+            return rows
+        return [rows[i] for i in sorted(latest.values())]
+
+    def _upsert(self, connection, cursor, rows):
+        rows = self._unique_rows(rows)
+        if self.upsert_method != "staging":
+            self._execute_many(cursor, rows)
+            return
+
+        self._execute_many(cursor, rows, self.merge_table)
+        for statement in self._merge_statements(self.merge_table):
+            cursor.execute(statement)
+        cursor.execute("DELETE FROM %s" % self.context.metadata.bind.dialect \
+                            .identifier_preparer.format_table(self.merge_table))
+
+    def _driver_rows(self, rows):
+        """Return `rows` with values converted for the driver."""
+        processors = self._processors
+        if not processors:
+            return rows
+        result = []
+        for row in rows:
+            result.append([process(value) if process else value
+                                for process, value in zip(processors, row)])
+        return result
+
+    def _execute_many(self, cursor, rows, table=None):
+        rows = self._driver_rows(rows)
+        if self.bulk_method == "executemany":
+            cursor.executemany(self._insert_statement(1, table), rows)
+            return
+
+        # multirow: as many rows in one statement as the parameter limit
+        # of the database allows
+        dialect = self.context.metadata.bind.dialect
+        limit = 10000
+        if dialect.name == "sqlite":
+            limit = 999
+            if dialect.dbapi.sqlite_version_info >= (3, 32, 0):
+                limit = 32766
+        size = max(1, limit // max(1, len(self.field_names)))
+        for start in range(0, len(rows), size):
+            chunk = rows[start:start + size]
+            values = [value for row in chunk for value in row]
+            cursor.execute(self._insert_statement(len(chunk), table), values)
+
+    def _copy_data(self, rows, true, false):
+        lines = []
+        for row in rows:
+            lines.append("\t".join([_copy_text(value, true, false)
+                                        for value in row]))
+        lines.append("")
+        return "\n".join(lines)
+
+    def _copy(self, cursor, rows):
+        preparer = self.context.metadata.bind.dialect.identifier_preparer
+        columns = ", ".join(preparer.format_column(self.table.c[name])
+                                for name in self.field_names)
+        statement = "COPY %s (%s) FROM STDIN" % \
+                            (preparer.format_table(self.table), columns)
+        data = StringIO.StringIO(self._copy_data(rows, "t", "f"))
+        cursor.copy_expert(statement, data)
+
+    def _load_data(self, cursor, rows):
+        preparer = self.context.metadata.bind.dialect.identifier_preparer
+        columns = ", ".join(preparer.format_column(self.table.c[name])
+                                for name in self.field_names)
+        (fd, path) = tempfile.mkstemp(suffix=".tsv")
+        try:
+            with os.fdopen(fd, "wb") as handle:
+                handle.write(self._copy_data(rows, "1", "0"))
+            statement = "LOAD DATA LOCAL INFILE '%s' INTO TABLE %s " \
+                        "CHARACTER SET utf8 (%s)" % \
+                        (path.replace("\\", "\\\\").replace("'", "\\'"),
+                         preparer.format_table(self.table), columns)
+            cursor.execute(statement)
+        finally:
+            os.remove(path)
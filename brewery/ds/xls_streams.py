@@ -4,12 +4,9 @@
 import base
 import datetime
 from brewery.metadata import FieldList
+from brewery.utils import LazyModule
 
-try:
-    import xlrd
-except:
-    from brewery.utils import MissingPackage
-    xlrd = MissingPackage("xlrd", "Reading MS Excel XLS Files", "http://pypi.python.org/pypi/xlrd")
+xlrd = LazyModule("xlrd", "Reading MS Excel XLS Files", "http://pypi.python.org/pypi/xlrd")
 
 class XLSDataSource(base.DataSource):
     """Reading Microsoft Excel XLS Files
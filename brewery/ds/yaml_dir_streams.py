@@ -5,12 +5,10 @@ import base
 import string
 import os
 import shutil
+from brewery.utils import LazyModule
 
-try:
-    import yaml
-except:
-    from brewery.utils import MissingPackage
-    yaml = MissingPackage("PyYAML", "YAML directory data source/target", "http://pyyaml.org/")
+yaml = LazyModule("yaml", "YAML directory data source/target", "http://pyyaml.org/",
+                  package="PyYAML")
 
 class YamlDirectoryDataSource(base.DataSource):
     """docstring for ClassName
@@ -55,8 +53,8 @@ class YamlDirectoryDataSource(base.DataSource):
             if split[1] != self.extension:
                 pass
 
-            # Read yaml file
-            handle = open(os.path.join(self.path, base_name), "r")
+            # Read yaml file, compressed files are decompressed
+            handle, close = base.open_resource(os.path.join(self.path, base_name))
             record = yaml.load(handle)
             handle.close()
 
@@ -92,7 +90,8 @@ class YamlDirectoryDataTarget(base.DataTarget):
             * filename_template: template string used for creating file names. ``${key}`` is replaced
               with record value for ``key``. ``__index`` is used for auto-generated file index from
               `filename_start_index`. Default filename template is ``record_${__index}.yml`` which
-              results in filenames ``record_0.yml``, ``record_1.yml``, ...
+              results in filenames ``record_0.yml``, ``record_1.yml``, ... Files with
+              ``.gz``, ``.bz2``, ``.xz`` or ``.zst`` extension are compressed.
             * filename_start_index - first value of ``__index`` filename template value, by default 0
             * filename_field: if present, then filename is taken from that field.
             * truncate: remove all existing files in the directory. Default is ``False``.
@@ -129,7 +128,7 @@ class YamlDirectoryDataTarget(base.DataTarget):
         base_name = self.template.substitute(__index=self.index, **record)
         path = os.path.join(self.path, base_name)
 
-        handle = open(path, "w")
+        handle, close = base.open_resource(path, "w")
         yaml.safe_dump(record, stream=handle, encoding=None, default_flow_style=False)
         handle.close()
 
@@ -0,0 +1,380 @@
+# -*- coding: utf-8 -*-
+"""Execution plans of streams.
+
+:meth:`brewery.streams.Stream.explain` describes how a stream would be run
+without processing any data: order of the nodes, execution backend (thread or
+worker of the cooperative scheduler) of each node, fields passed through each
+pipe, whether a node is streaming or blocking (consumes whole input before it
+produces output), estimated number of rows and memory, and notes such as
+operations pushed down to the data sources.
+
+Fields are propagated by initializing all nodes except target nodes, so the
+sources are opened (a CSV header is read, a database table is reflected), but
+no rows are read and nothing is written.
+
+With ``analyze=True`` the stream is run and the same plan is annotated with
+the actual metrics: rows passed, time spent in initialization, run and
+finalization, peak memory and number of spills.
+
+Estimates are rough: number of rows is known only for some sources (lists,
+local CSV files) and is propagated through the nodes with
+:meth:`brewery.nodes.Node.estimated_rows`. Memory is estimated from the number
+of rows and approximate size of a row based on the field storage types.
+"""
+
+from brewery.nodes.base import TargetNode, SourceNode
+from brewery.memory import format_memory_size
+
+__all__ = [
+    "StreamPlan",
+    "NodePlan",
+    "PipePlan",
+    "explain_stream",
+    "estimate_row_size"
+]
+
+# Approximate size of a value of given storage type in bytes (python object
+# and its share of the row list)
+_value_sizes = {
+    "integer": 32,
+    "float": 32,
+    "boolean": 16,
+    "date": 56,
+    "string": 80,
+    "text": 200,
+}
+_unknown_value_size = 80
+_row_overhead = 72
+
+def estimate_row_size(fields):
+    """Return approximate size of a row with `fields` in bytes."""
+    size = _row_overhead
+    for field in fields:
+        size += _value_sizes.get(field.storage_type, _unknown_value_size)
+    return size
+
+class PipePlan(object):
+    """Plan of a pipe between two nodes.
+
+    :Attributes:
+        * `source` - name of the source node
+        * `target` - name of the target node
+        * `fields` - list of field names passed through the pipe, ``None`` if
+          not known
+        * `estimated_rows` - estimated number of rows, ``None`` if not known
+        * `estimated_memory` - estimated size of the pipe buffers in bytes
+        * `actual_rows` - number of rows passed (analyzed plans only)
+    """
+    def __init__(self, source, target):
+        self.source = source
+        self.target = target
+        self.fields = None
+        self.estimated_rows = None
+        self.estimated_memory = None
+        self.actual_rows = None
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+class NodePlan(object):
+    """Plan of a node.
+
+    :Attributes:
+        * `name` - name of the node in the stream
+        * `type` - node type identifier
+        * `role` - ``source``, ``target`` or ``node``
+        * `mode` - ``streaming`` or ``blocking``
+        * `backend` - ``thread`` or ``worker N`` for the cooperative scheduler
+        * `inputs`, `outputs` - names of the source and target nodes
+        * `fields` - list of output field names (input field names for target
+          nodes), ``None`` if not known
+        * `estimated_rows` - estimated number of output rows (input rows for
+          target nodes)
+        * `estimated_memory` - estimated memory held by the node in bytes
+        * `spillable` - ``True`` if the node spills data to disk when memory
+          limit is exceeded
+        * `notes` - list of notes, such as pushdowns or initialization errors
+        * `actual` - dictionary of actual metrics (analyzed plans only):
+          ``rows_in``, ``rows_out``, ``initialize_time``, ``run_time``,
+          ``finalize_time``, ``memory_peak``, ``spills``
+    """
+    def __init__(self, name, node):
+        self.name = name
+        self.type = node.identifier()
+        if isinstance(node, SourceNode):
+            self.role = "source"
+        elif isinstance(node, TargetNode):
+            self.role = "target"
+        else:
+            self.role = "node"
+        if node.blocking and not node.pushed_down:
+            self.mode = "blocking"
+        else:
+            self.mode = "streaming"
+        self.spillable = node.spillable
+        self.backend = None
+        self.inputs = []
+        self.outputs = []
+        self.fields = None
+        self.estimated_rows = None
+        self.estimated_memory = None
+        self.notes = []
+        self.actual = None
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+class StreamPlan(object):
+    """Execution plan of a stream, see :func:`explain_stream`.
+
+    :Attributes:
+        * `nodes` - list of :class:`NodePlan` in the order of execution
+        * `pipes` - list of :class:`PipePlan`
+        * `scheduler` - name of the scheduler
+        * `workers` - number of cooperative scheduler workers
+        * `analyzed` - ``True`` if the plan contains actual metrics
+        * `stats` - stream statistics (analyzed plans only)
+    """
+    def __init__(self, scheduler="threads", workers=None):
+        self.nodes = []
+        self.pipes = []
+        self.scheduler = scheduler
+        self.workers = workers
+        self.analyzed = False
+        self.stats = None
+
+    def node(self, name):
+        """Return plan of node with `name`."""
+        for node in self.nodes:
+            if node.name == name:
+                return node
+        raise KeyError("No node with name '%s' in the plan" % name)
+
+    def to_dict(self):
+        """Return the plan as a dictionary suitable for JSON."""
+        return {
+            "scheduler": self.scheduler,
+            "workers": self.workers,
+            "analyzed": self.analyzed,
+            "stats": self.stats,
+            "nodes": [node.to_dict() for node in self.nodes],
+            "pipes": [pipe.to_dict() for pipe in self.pipes]
+        }
+
+    def format(self):
+        """Return human readable plan."""
+        lines = []
+        title = "stream plan (scheduler: %s" % self.scheduler
+        if self.scheduler == "cooperative":
+            title += ", %d workers" % self.workers
+        title += ")"
+        if self.analyzed:
+            title += ", analyzed"
+        lines.append(title)
+        lines.append("")
+
+        header = "%-20s %-16s %-9s %-9s %10s %10s" % ("node", "type", "mode",
+                                    "backend", "est.rows", "est.memory")
+        if self.analyzed:
+            header += " %10s %10s %10s %6s" % ("rows", "time", "peak", "spills")
+        lines.append(header)
+
+        for node in self.nodes:
+            line = "%-20.20s %-16.16s %-9s %-9s %10s %10s" % \
+                        (node.name, node.type, node.mode, node.backend,
+                         _format_rows(node.estimated_rows),
+                         _format_memory(node.estimated_memory))
+            if self.analyzed and node.actual:
+                actual = node.actual
+                rows = actual["rows_in"] if node.role == "target" \
+                                         else actual["rows_out"]
+                time = sum(actual.get(key) or 0 for key in
+                           ("initialize_time", "run_time", "finalize_time"))
+                line += " %10s %10.3f %10s %6d" % (_format_rows(rows), time,
+                                    _format_memory(actual["memory_peak"]),
+                                    actual["spills"])
+            lines.append(line)
+
+            if node.inputs:
+                lines.append("    inputs: %s" % ", ".join(node.inputs))
+            if node.fields is not None:
+                label = "input fields" if node.role == "target" else "fields"
+                lines.append("    %s: %s" % (label, ", ".join(node.fields)))
+            for note in node.notes:
+                lines.append("    note: %s" % note)
+
+        if self.pipes:
+            lines.append("")
+            lines.append("pipes:")
+            for pipe in self.pipes:
+                line = "    %s -> %s: %s rows, buffer %s" % \
+                            (pipe.source, pipe.target,
+                             _format_rows(pipe.estimated_rows),
+                             _format_memory(pipe.estimated_memory))
+                if self.analyzed:
+                    line += ", actual %s rows" % _format_rows(pipe.actual_rows)
+                lines.append(line)
+
+        return "\n".join(lines)
+
+    def __str__(self):
+        return self.format()
+
+def _format_rows(rows):
+    return "?" if rows is None else str(rows)
+
+def _format_memory(size):
+    return "?" if size is None else format_memory_size(size)
+
+def explain_stream(stream, analyze=False, initialize=True, **options):
+    """Return :class:`StreamPlan` of `stream`.
+
+    :Parameters:
+        * `stream` - the stream to be explained
+        * `analyze` - if ``True``, then the stream is run and the plan contains
+          actual metrics of the run
+        * `initialize` - if ``True`` (default), then non-target nodes are
+          initialized and finalized to propagate fields. Ignored when
+          `analyze` is ``True``.
+        * `options` - run options, see :meth:`brewery.streams.Stream.run`
+    """
+    from brewery.streams import _run_options
+
+    options = _run_options(options)
+    sorted_nodes = stream.sorted_nodes()
+
+    if analyze:
+        stream.run(**options)
+    else:
+        stream._prepare_run(**options)
+        stream._plan(sorted_nodes)
+        stream._create_pipes(sorted_nodes)
+        if initialize:
+            failures = _initialize_nodes(stream, sorted_nodes)
+        else:
+            failures = {}
+
+    plan = StreamPlan(options["scheduler"], options["workers"])
+
+    # Backend of each node, the same assignment as CooperativeScheduler does
+    count = max(1, min(options["workers"], len(sorted_nodes)))
+    for i, node in enumerate(sorted_nodes):
+        node_plan = NodePlan(stream.node_name(node), node)
+        if options["scheduler"] == "cooperative":
+            node_plan.backend = "worker %d" % (i * count // len(sorted_nodes))
+        else:
+            node_plan.backend = "thread"
+        plan.nodes.append(node_plan)
+
+    node_plans = dict(zip(sorted_nodes, plan.nodes))
+
+    pipe_plans = []
+    for pipe in stream.pipes:
+        (source, target) = stream.pipe_ends[pipe]
+        if target is None:
+            continue
+        pipe_plan = PipePlan(stream.node_name(source), stream.node_name(target))
+        if pipe.fields is not None:
+            pipe_plan.fields = pipe.fields.names()
+        if analyze:
+            pipe_plan.actual_rows = pipe.rows_sent
+        plan.pipes.append(pipe_plan)
+        pipe_plans.append((pipe, pipe_plan))
+
+    # Estimates are propagated in the order of execution
+    out_rows = {}
+    for node in sorted_nodes:
+        node_plan = node_plans[node]
+        node_plan.inputs = [stream.node_name(n) for n in stream.node_sources(node)]
+        node_plan.outputs = [stream.node_name(n) for n in stream.node_targets(node)]
+
+        if node.inputs and node.inputs[0].fields is not None \
+                and isinstance(node, TargetNode):
+            node_plan.fields = node.inputs[0].fields.names()
+        elif node.outputs and node.outputs[0].fields is not None:
+            node_plan.fields = node.outputs[0].fields.names()
+
+        input_rows = [out_rows.get(n) for n in stream.node_sources(node)]
+        try:
+            rows = node.estimated_rows(input_rows)
+        except Exception as e:
+            node_plan.notes.append("unable to estimate rows: %s" % e)
+            rows = None
+        out_rows[node] = rows
+        node_plan.estimated_rows = rows
+
+        # Blocking and spillable nodes hold their input in memory
+        if node.pushed_down:
+            node_plan.estimated_memory = 0
+        elif node.blocking or node.spillable:
+            sizes = [_pipe_size(pipe, rows) for pipe, rows
+                                            in zip(node.inputs, input_rows)]
+            if sizes and None not in sizes:
+                node_plan.estimated_memory = sum(sizes)
+        else:
+            node_plan.estimated_memory = 0
+
+        if node.spillable and not node.pushed_down:
+            node_plan.notes.append("spills to disk when memory limit is exceeded")
+
+        try:
+            node_plan.notes += node.plan_notes()
+        except Exception as e:
+            node_plan.notes.append("unable to explain node: %s" % e)
+
+        if not analyze and node in failures:
+            node_plan.notes.append("initialization failed: %s" % failures[node])
+
+    for pipe, pipe_plan in pipe_plans:
+        rows = out_rows.get(stream.pipe_ends[pipe][0])
+        pipe_plan.estimated_rows = rows
+        if rows is not None:
+            # Staging and ready buffer, see Pipe._account_memory()
+            buffered = min(rows, pipe.buffer_size)
+            pipe_plan.estimated_memory = _pipe_size(pipe, 2 * buffered)
+
+    if analyze:
+        plan.analyzed = True
+        plan.stats = stream.stats
+        for node in sorted_nodes:
+            _add_actual(stream, node, node_plans[node])
+
+    return plan
+
+def _pipe_size(pipe, rows):
+    """Return estimated size of `rows` passing through `pipe`."""
+    if rows is None or pipe.fields is None:
+        return None
+    return rows * estimate_row_size(pipe.fields)
+
+def _initialize_nodes(stream, sorted_nodes):
+    """Initialize and finalize all nodes except target nodes to propagate
+    fields. Returns dictionary of failed nodes and their exceptions."""
+    from brewery.streams import _call_nodes
+
+    nodes = [node for node in sorted_nodes if not isinstance(node, TargetNode)]
+    (times, failures) = _call_nodes(nodes, stream._initialize_node,
+                                    stream.node_sources, stream._init_workers)
+    failed = dict((node, exc_info[1]) for node, exc_info in failures)
+
+    initialized = [node for node in nodes if node in times and node not in failed]
+    (times, failures) = _call_nodes(initialized, stream._finalize_node,
+                                    workers=stream._init_workers)
+    for node, exc_info in failures:
+        stream.logger.warn("finalization of node %s failed: %s"
+                           % (stream.node_name(node), exc_info[1]))
+
+    return failed
+
+def _add_actual(stream, node, node_plan):
+    stats = stream.stats["nodes"].get(node_plan.name, {})
+    actual = {
+        "rows_in": sum(pipe.rows_sent for pipe in node.inputs),
+        "rows_out": node.outputs[0].rows_sent if node.outputs else None,
+        "initialize_time": stats.get("initialize_time"),
+        "run_time": stats.get("run_time"),
+        "finalize_time": stats.get("finalize_time"),
+        "memory_peak": node.memory.peak if node.memory else 0,
+        "spills": node.memory.spills if node.memory else 0
+    }
+    node_plan.actual = actual
@@ -1,4 +1,4 @@
-from collections import OrderedDict
+from collections import OrderedDict, deque
 from brewery.utils import get_logger
 
 class Graph(object):
@@ -16,6 +16,12 @@ class Graph(object):
         self.nodes = OrderedDict()
         self.connections = set()
 
+        # Indexes: node -> list of names, node -> list of target/source nodes
+        self._node_names = {}
+        self._targets = {}
+        self._sources = {}
+        self._sorted_nodes = None
+
         self.logger = get_logger()
 
         self._name_sequence = 1
@@ -35,7 +41,7 @@ class Graph(object):
         """Generates unique name for a node"""
         while 1:
             name = "node" + str(self._name_sequence)
-            if name not in self.nodes.keys():
+            if name not in self.nodes:
                 break
             self._name_sequence += 1
 
@@ -53,6 +59,10 @@ class Graph(object):
             raise KeyError("Node with name %s already exists" % name)
 
         self.nodes[name] = node
+        self._node_names.setdefault(node, []).append(name)
+        self._targets.setdefault(node, [])
+        self._sources.setdefault(node, [])
+        self._sorted_nodes = None
 
         return name
 
@@ -62,7 +72,7 @@ class Graph(object):
         if not node:
             raise ValueError("No node provided")
 
-        names = [key for key,value in self.nodes.items() if value==node]
+        names = self._node_names.get(node, [])
 
         if len(names) == 1:
             return names[0]
@@ -82,13 +92,14 @@ class Graph(object):
 
         if not name:
             raise ValueError("No node name provided for rename")
-        if name in self.nodes():
+        if name in self.nodes:
             raise ValueError("Node with name '%s' already exists" % name)
 
         old_name = self.node_name(node)
 
         del self.nodes[old_name]
         self.nodes[name] = node
+        self._node_names[node] = [name]
 
     def coalesce_node(self, reference):
         """Coalesce node reference: `reference` should be either a node name
@@ -96,7 +107,7 @@ class Graph(object):
 
         if isinstance(reference, basestring):
             return self.nodes[reference]
-        elif reference in self.nodes.values():
+        elif reference in self._node_names:
             return reference
         else:
             raise ValueError("Unable to find node '%s'" % reference)
@@ -114,26 +125,53 @@ class Graph(object):
 
         del self.nodes[name]
 
-        remove = [c for c in self.connections if c[0] == node or c[1] == node]
+        names = self._node_names[node]
+        names.remove(name)
+        if names:
+            # The same node is still in the graph under another name
+            self._sorted_nodes = None
+            return
+
+        del self._node_names[node]
 
-        for connection in remove:
-            self.connections.remove(connection)
+        for target in self._targets.pop(node):
+            self.connections.discard((node, target))
+            self._sources[target].remove(node)
+        for source in self._sources.pop(node):
+            self.connections.discard((source, node))
+            self._targets[source].remove(node)
+
+        self._sorted_nodes = None
 
     def connect(self, source, target):
         """Connects source node and target node. Nodes can be provided as
         objects or names."""
         connection = (self.coalesce_node(source), self.coalesce_node(target))
+        if connection in self.connections:
+            return
+
         self.connections.add(connection)
+        self._targets[connection[0]].append(connection[1])
+        self._sources[connection[1]].append(connection[0])
+        self._sorted_nodes = None
 
     def remove_connection(self, source, target):
         """Remove connection between source and target nodes, if exists."""
 
         connection = (self.coalesce_node(source), self.coalesce_node(target))
-        self.connections.discard(connection)
+        if connection not in self.connections:
+            return
+
+        self.connections.remove(connection)
+        self._targets[connection[0]].remove(connection[1])
+        self._sources[connection[1]].remove(connection[0])
+        self._sorted_nodes = None
 
     def sorted_nodes(self):
         """
-        Return topologically sorted nodes.
+        Return topologically sorted nodes. Nodes without dependencies keep
+        the order in which they were added. The order is cached until the
+        graph is changed.
 
         Algorithm::
 
@@ -151,62 +189,43 @@ class Graph(object):
             else
                 return proposed topologically sorted order: L
         """
-        def is_source(node, connections):
-            for connection in connections:
-                if node == connection[1]:
-                    return False
-            return True
 
-        def source_connections(node, connections):
-            conns = set()
-            for connection in connections:
-                if node == connection[0]:
-                    conns.add(connection)
-            return conns
+        if self._sorted_nodes is None:
+            self._sorted_nodes = self._sort_nodes()
 
-        nodes = set(self.nodes.values())
-        connections = self.connections.copy()
-        sorted_nodes = []
+        return list(self._sorted_nodes)
 
-        # Find source nodes:
-        source_nodes = set([n for n in nodes if is_source(n, connections)])
+    def _sort_nodes(self):
+        nodes = self._node_names.keys()
+        order = dict((node, i) for i, node in enumerate(self.nodes.values()))
+        nodes.sort(key=order.get)
+
+        # Number of incoming edges of each node
+        incoming = dict((node, len(self._sources[node])) for node in nodes)
+        source_nodes = deque(node for node in nodes if not incoming[node])
+        sorted_nodes = []
 
-        # while S is non-empty do
         while source_nodes:
-            # remove a node n from S
-            node = source_nodes.pop()
-            # insert n into L
+            node = source_nodes.popleft()
             sorted_nodes.append(node)
 
-            # for each node m with an edge e from n to m do
-            s_connections = source_connections(node, connections)
-            for connection in s_connections:
-                #     remove edge e from the graph
-                m = connection[1]
-                connections.remove(connection)
-                #     if m has no other incoming edges then
-                #         insert m into S
-                if is_source(m, connections):
-                    source_nodes.add(m)
-
-        # if graph has edges then
-        #     output error message (graph has at least one cycle)
-        # else
-        #     output message (proposed topologically sorted order: L)
+            for target in self._targets[node]:
+                incoming[target] -= 1
+                if not incoming[target]:
+                    source_nodes.append(target)
 
-        if connections:
-            raise Exception("Steram has at least one cycle (%d connections left of %d)" % (len(connections), len(self.connections)))
+        if len(sorted_nodes) < len(nodes):
+            left = sum(incoming.values())
+            raise Exception("Steram has at least one cycle (%d connections left of %d)" % (left, len(self.connections)))
 
         return sorted_nodes
 
     def node_targets(self, node):
         """Return nodes that `node` passes data into."""
         node = self.coalesce_node(node)
-        nodes =[conn[1] for conn in self.connections if conn[0] == node]
-        return nodes
+        return list(self._targets[node])
 
     def node_sources(self, node):
         """Return nodes that provide data for `node`."""
         node = self.coalesce_node(node)
-        nodes =[conn[0] for conn in self.connections if conn[1] == node]
-        return nodes
+        return list(self._sources[node])
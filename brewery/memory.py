@@ -0,0 +1,540 @@
+# -*- coding: utf-8 -*-
+"""Memory budget and approximate memory accounting of streams.
+
+Blocking nodes (such as aggregation, distinct or merge) and pipe buffers keep
+rows in memory. A :class:`MemoryBudget` collects approximate memory usage of
+each node and pipe of a stream through :class:`MemoryAccount` objects. When
+the budget limit is reached, nodes that are able to spill their data to disk
+are asked to do so. If the limit can not be met, :class:`MemoryBudgetExceeded`
+is raised with the name of the offending node.
+
+Nodes keep their data in spill-capable containers :class:`SpillableDict` and
+:class:`SpillableList` which do the accounting and spilling for them.
+
+Memory sizes are approximations based on ``sys.getsizeof()`` of sampled
+objects, not exact process memory.
+"""
+
+import threading
+import tempfile
+import cPickle as pickle
+import shelve
+import shutil
+import sys
+import os
+import re
+from brewery.common import StreamError
+from brewery.utils import get_logger
+
+__all__ = [
+    "MemoryBudget",
+    "MemoryAccount",
+    "MemoryBudgetExceeded",
+    "SpillableDict",
+    "SpillableList",
+    "SizeEstimator",
+    "estimate_size",
+    "parse_memory_size",
+    "format_memory_size"
+]
+
+# Account changes are sent to the budget in chunks of this size, so nodes do
+# not have to lock the budget for every row.
+ACCOUNT_GRANULARITY = 64 * 1024
+
+# Every n-th item added to a spillable container is measured, the rest uses
+# the running average.
+SIZE_SAMPLE_INTERVAL = 64
+
+class MemoryBudgetExceeded(StreamError):
+    """Exception raised when memory budget of a stream can not be met even
+    after spill-capable nodes spilled their data.
+
+    Attributes:
+        * `owner`: name of the node (or pipe) that requested the memory
+        * `limit`: memory limit in bytes
+        * `usage`: list of tuples (`name`, `bytes`) of the largest consumers
+    """
+    def __init__(self, message=None, owner=None, limit=None, usage=None):
+        super(MemoryBudgetExceeded, self).__init__(message)
+        self.owner = owner
+        self.limit = limit
+        self.usage = usage or []
+
+class MemoryBudget(object):
+    """Memory budget shared by nodes and pipes of one or more streams."""
+
+    def __init__(self, limit=None):
+        """Creates a memory budget.
+
+        :Parameters:
+            * `limit` - maximal approximate memory in bytes that nodes and pipes
+              might use. If ``None``, then memory is only accounted.
+
+        One budget might be shared by several streams to run them safely at
+        the same time.
+        """
+        super(MemoryBudget, self).__init__()
+        self.limit = limit
+        self.accounts = []
+        self.used = 0
+        self.peak = 0
+
+        self.logger = get_logger()
+        self._lock = threading.Lock()
+
+    def account(self, name, spillable=False):
+        """Create a new memory account with `name` (usually name of a node or
+        a pipe). `spillable` is ``True`` if the owner of the account is able
+        to move its data to disk."""
+        account = MemoryAccount(self, name, spillable)
+        with self._lock:
+            self.accounts.append(account)
+        return account
+
+    def remove_account(self, account):
+        """Remove `account` from the budget and release all its memory."""
+        with self._lock:
+            if account in self.accounts:
+                self.accounts.remove(account)
+                self.used -= account.used
+
+    def _update(self, account, delta):
+        """Change memory used by `account` by `delta` bytes. Returns ``True``
+        when the account should spill."""
+
+        with self._lock:
+            account.used += delta
+            self.used += delta
+            self.peak = max(self.peak, self.used)
+
+            if delta <= 0 or self.limit is None or self.used <= self.limit:
+                return account.spill_requested
+
+            excess = self.used - self.limit
+
+            # Ask spill-capable accounts to spill, largest first
+            candidates = [a for a in self.accounts
+                                if a.spillable and a.used > 0]
+            candidates.sort(key=lambda a: a.used, reverse=True)
+
+            releasable = 0
+            for candidate in candidates:
+                if releasable >= excess:
+                    break
+                if not candidate.spill_requested:
+                    self.logger.debug("memory budget exceeded, asking '%s' to "
+                                      "spill %s" % (candidate.name,
+                                      format_memory_size(candidate.used)))
+                candidate.spill_requested = True
+                releasable += candidate.used
+
+            if releasable < excess:
+                usage = self._usage()
+                raise MemoryBudgetExceeded("memory budget of %s exceeded by "
+                                "node '%s' (uses %s, stream uses %s). "
+                                "Largest consumers: %s"
+                                % (format_memory_size(self.limit),
+                                   account.name,
+                                   format_memory_size(account.used),
+                                   format_memory_size(self.used),
+                                   _format_usage(usage[:5])),
+                                owner=account.name, limit=self.limit,
+                                usage=usage)
+
+            return account.spill_requested
+
+    def _usage(self):
+        usage = [(a.name, a.used) for a in self.accounts]
+        usage.sort(key=lambda item: item[1], reverse=True)
+        return usage
+
+    def usage(self):
+        """Return list of tuples (`name`, `bytes`) for all accounts sorted
+        by used memory, largest first."""
+        with self._lock:
+            return self._usage()
+
+    def report(self):
+        """Return text report of memory usage of the budget accounts."""
+        lines = ["memory used: %s, peak: %s, limit: %s"
+                    % (format_memory_size(self.used),
+                       format_memory_size(self.peak),
+                       format_memory_size(self.limit) if self.limit else "none")]
+        with self._lock:
+            for account in self.accounts:
+                lines.append("    %s: %s (peak %s%s)"
+                             % (account.name,
+                                format_memory_size(account.used),
+                                format_memory_size(account.peak),
+                                ", spilled %d times" % account.spills
+                                        if account.spills else ""))
+        return "\n".join(lines)
+
+class MemoryAccount(object):
+    """Approximate memory usage of a single node or pipe.
+
+    :Attributes:
+        * `name`: name of the account owner
+        * `spillable`: ``True`` if owner can spill data to disk
+        * `used`: bytes accounted in the budget
+        * `peak`: peak of used bytes
+        * `spills`: number of spills done by the owner
+        * `spill_requested`: ``True`` if the budget asks owner to spill
+    """
+
+    def __init__(self, budget, name, spillable=False):
+        self.budget = budget
+        self.name = name
+        self.spillable = spillable
+        self.used = 0
+        self.peak = 0
+        self.spills = 0
+        self.spill_requested = False
+
+        self._pending = 0
+
+    def allocate(self, size):
+        """Account `size` more bytes. Returns ``True`` when the owner should
+        spill its data. Raises `MemoryBudgetExceeded` when the budget can not
+        be met."""
+        self._pending += size
+        if self._pending < ACCOUNT_GRANULARITY:
+            return self.spill_requested
+        return self.commit()
+
+    def release(self, size):
+        """Release `size` bytes."""
+        self._pending -= size
+        if self._pending > -ACCOUNT_GRANULARITY:
+            return
+        self.commit()
+
+    def set(self, size):
+        """Set used memory of the account to `size` bytes."""
+        self._pending = size - self.used
+        return self.commit()
+
+    def commit(self):
+        """Send all pending changes to the budget."""
+        delta = self._pending
+        self._pending = 0
+        result = self.budget._update(self, delta)
+        self.peak = max(self.peak, self.used)
+        return result
+
+    def spilled(self, size):
+        """Notify the account that owner spilled `size` bytes to disk."""
+        self.spills += 1
+        self.spill_requested = False
+        self._pending -= size
+        self.commit()
+
+    def clear(self):
+        """Release all memory of the account."""
+        self.spill_requested = False
+        self.set(0)
+
+class SizeEstimator(object):
+    """Running average of sizes of items added to a container. Only some of
+    the items are measured."""
+    def __init__(self):
+        self.count = 0
+        self.average = 0
+
+    def size(self, *objects):
+        self.count += 1
+        if self.count <= 8 or self.count % SIZE_SAMPLE_INTERVAL == 0:
+            size = sum(estimate_size(obj) for obj in objects)
+            samples = min(self.count, 100)
+            self.average += (size - self.average) / float(samples)
+        return int(self.average)
+
+class SpillableDict(object):
+    """Dictionary that moves its items to a disk-based store when memory
+    budget is exceeded. Keys have to be picklable and values have to be
+    picklable objects. Values read from the dictionary have to be assigned
+    back after modification, as values are copies after spill.
+
+    Spilled items are stored in a ``shelve`` in a temporary directory which
+    is removed on :meth:`close`. Items are stored in buckets by hash of their
+    keys and keys are compared by equality, as in a dictionary.
+
+    An `ordered` dictionary iterates over items in order of insertion of
+    their keys. The keys are kept in a :class:`SpillableList` accounted and
+    spilled together with the items.
+    """
+
+    def __init__(self, account=None, ordered=False):
+        """Creates a spillable dictionary. Memory is accounted in `account`
+        (:class:`MemoryAccount`). If there is no account, then the dictionary
+        behaves as ordinary in-memory dictionary."""
+        self.account = account
+        self._data = {}
+        self._disk = None
+        self._disk_dir = None
+        self._count = 0
+        # (key, spilled) of the last key looked up on the disk - values are
+        # usually read before they are assigned
+        self._last_lookup = None
+        self._size = 0
+        self._estimator = SizeEstimator()
+        if ordered:
+            self._order = SpillableList()
+            self._key_estimator = SizeEstimator()
+        else:
+            self._order = None
+
+    def __len__(self):
+        return self._count
+
+    def _disk_index(self, key):
+        """Return tuple (`bucket`, `index`) of `key` in the disk store.
+        `index` is ``None`` if the key was not spilled."""
+        disk_key = _disk_key(key)
+        if not self._disk.has_key(disk_key):
+            return ([], None)
+        bucket = self._disk[disk_key]
+        for i, (spilled_key, value) in enumerate(bucket):
+            if spilled_key == key:
+                return (bucket, i)
+        return (bucket, None)
+
+    def _spilled_key(self, key):
+        """``True`` if `key` is in the disk store."""
+        if self._last_lookup is not None and self._last_lookup[0] == key:
+            return self._last_lookup[1]
+        return self._disk_index(key)[1] is not None
+
+    def __contains__(self, key):
+        if key in self._data:
+            return True
+        if self._disk is not None:
+            spilled = self._disk_index(key)[1] is not None
+            self._last_lookup = (key, spilled)
+            return spilled
+        return False
+
+    def __getitem__(self, key):
+        try:
+            return self._data[key]
+        except KeyError:
+            if self._disk is not None:
+                (bucket, index) = self._disk_index(key)
+                self._last_lookup = (key, index is not None)
+                if index is not None:
+                    return bucket[index][1]
+            raise
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        if key in self._data:
+            self._data[key] = value
+            return
+
+        self._data[key] = value
+        new = self._disk is None or not self._spilled_key(key)
+        if new:
+            self._count += 1
+            if self._order is not None:
+                self._order.append(key)
+
+        if self.account:
+            size = self._estimator.size(key, value)
+            if new and self._order is not None:
+                size += self._key_estimator.size(key)
+            self._size += size
+            if self.account.allocate(size):
+                self.spill()
+
+    def keys(self):
+        if self._order is not None:
+            return list(self._order)
+        return [key for key, value in self.iteritems()]
+
+    def iteritems(self):
+        """Iterate over (`key`, `value`) pairs. Items that were spilled are
+        read from the disk."""
+        if self._order is not None:
+            for key in self._order:
+                yield (key, self[key])
+            return
+
+        for item in self._data.iteritems():
+            yield item
+
+        if self._disk is not None:
+            for disk_key in self._disk.keys():
+                for key, value in self._disk[disk_key]:
+                    if key not in self._data:
+                        yield (key, value)
+
+    def items(self):
+        return list(self.iteritems())
+
+    def spilled(self):
+        """``True`` if any data were spilled to disk."""
+        return self._disk is not None
+
+    def spill(self):
+        """Move all items from memory to the disk store."""
+        if self._disk is None:
+            self._disk_dir = tempfile.mkdtemp(prefix="brewery-spill-")
+            path = os.path.join(self._disk_dir, "dict")
+            self._disk = shelve.open(path, flag="n",
+                                     protocol=pickle.HIGHEST_PROTOCOL)
+
+        for key, value in self._data.iteritems():
+            (bucket, index) = self._disk_index(key)
+            if index is None:
+                bucket.append((key, value))
+            else:
+                bucket[index] = (key, value)
+            self._disk[_disk_key(key)] = bucket
+
+        self._disk.sync()
+        self._data = {}
+        self._last_lookup = None
+        if self._order is not None:
+            self._order.spill()
+
+        if self.account:
+            self.account.spilled(self._size)
+        self._size = 0
+
+    def close(self):
+        """Release memory and remove spilled data."""
+        self._data = {}
+        self._last_lookup = None
+        if self._order is not None:
+            self._order.close()
+        if self._disk is not None:
+            self._disk.close()
+            self._disk = None
+            shutil.rmtree(self._disk_dir, ignore_errors=True)
+        if self.account:
+            self.account.release(self._size)
+            self.account.commit()
+        self._size = 0
+
+class SpillableList(object):
+    """List-like container for appending rows that moves rows to a temporary
+    file when memory budget is exceeded. Order of items is preserved when
+    iterating. Items have to be picklable."""
+
+    def __init__(self, account=None):
+        """Creates a spillable list. Memory is accounted in `account`
+        (:class:`MemoryAccount`)."""
+        self.account = account
+        self._data = []
+        self._file = None
+        self._disk_count = 0
+        self._size = 0
+        self._estimator = SizeEstimator()
+
+    def __len__(self):
+        return self._disk_count + len(self._data)
+
+    def append(self, item):
+        self._data.append(item)
+        if self.account:
+            size = self._estimator.size(item)
+            self._size += size
+            if self.account.allocate(size):
+                self.spill()
+
+    def __iter__(self):
+        if self._file is not None:
+            self._file.flush()
+            self._file.seek(0)
+            unpickler = pickle.Unpickler(self._file)
+            for i in xrange(self._disk_count):
+                yield unpickler.load()
+            self._file.seek(0, os.SEEK_END)
+
+        for item in self._data:
+            yield item
+
+    def spilled(self):
+        """``True`` if any data were spilled to disk."""
+        return self._file is not None
+
+    def spill(self):
+        """Append all items in memory to the temporary file."""
+        if self._file is None:
+            self._file = tempfile.TemporaryFile(prefix="brewery-spill-")
+
+        pickler = pickle.Pickler(self._file, pickle.HIGHEST_PROTOCOL)
+        for item in self._data:
+            pickler.dump(item)
+            # Do not remember references, rows are independent
+            pickler.clear_memo()
+        self._disk_count += len(self._data)
+        self._data = []
+
+        if self.account:
+            self.account.spilled(self._size)
+        self._size = 0
+
+    def close(self):
+        """Release memory and remove spilled data."""
+        self._data = []
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self.account:
+            self.account.release(self._size)
+            self.account.commit()
+        self._size = 0
+
+def _disk_key(key):
+    # Equal keys have equal hashes, spilled data live only in this process
+    return "%x" % (hash(key) & 0xffffffffffffffff)
+
+def estimate_size(obj, depth=3):
+    """Return approximate size of `obj` in bytes including its items up to
+    `depth` levels of nested containers."""
+    size = sys.getsizeof(obj)
+    if depth <= 0:
+        return size
+
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(estimate_size(item, depth - 1) for item in obj)
+    elif isinstance(obj, dict):
+        size += sum(estimate_size(key, depth - 1) + estimate_size(value, depth - 1)
+                        for key, value in obj.iteritems())
+    elif hasattr(obj, "__dict__"):
+        size += estimate_size(obj.__dict__, depth - 1)
+
+    return size
+
+_size_units = {"": 1, "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3, "t": 1024 ** 4}
+
+def parse_memory_size(value):
+    """Parse memory size such as ``512M``, ``2G``, ``100kb`` or ``1000``
+    (bytes) into number of bytes."""
+    if isinstance(value, (int, long)):
+        return value
+
+    match = re.match(r"^\s*(\d+(?:\.\d+)?)\s*([kmgt]?)b?\s*$", str(value), re.I)
+    if not match:
+        raise ValueError("Invalid memory size '%s'" % value)
+    number, unit = match.groups()
+    return int(float(number) * _size_units[unit.lower()])
+
+def format_memory_size(size):
+    """Return human readable memory size."""
+    for unit in ["B", "kB", "MB", "GB"]:
+        if abs(size) < 1024:
+            return ("%d %s" if unit == "B" else "%.1f %s") % (size, unit)
+        size /= 1024.0
+    return "%.1f TB" % size
+
+def _format_usage(usage):
+    return ", ".join("%s: %s" % (name, format_memory_size(size))
+                        for name, size in usage)
@@ -36,6 +36,7 @@ __all__ = [
     "CSVSourceNode",
     "YamlDirectorySourceNode",
     "ESSourceNode",
+    "SQLSourceNode",
     
     # Target nodes    
     "RowListTargetNode",
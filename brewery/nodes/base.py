@@ -8,6 +8,7 @@ __all__ = (
     "create_node",
     "node_dictionary",
     "node_catalogue",
+    "load_node_plugins",
     "get_node_info",
     "NodeFinished",
     "Node",
@@ -19,11 +20,23 @@ __all__ = (
 # FIXME: temporary dictionary to record displayed warnings about __node_info__
 _node_info_warnings = set()
 
+# Catalogue of available nodes, created on first use and reset whenever a new
+# node class is defined (see _NodeMeta)
+_node_catalogue = None
+_node_plugins_loaded = False
+
+# Entry point group of node extensions
+NODE_ENTRY_POINT = "brewery.nodes"
+
 def create_node(identifier, *args, **kwargs):
     """Creates a node of type specified by `identifier`. Options are passed to
-    the node initializer"""
+    the node initializer. Node extensions registered as entry points are
+    loaded if there is no such node."""
 
     d = node_dictionary()
+    if identifier not in d and load_node_plugins():
+        d = node_dictionary()
+
     node_class = d[identifier]
     node = node_class(*args, **kwargs)
     return node
@@ -33,19 +46,8 @@ def node_dictionary():
     value. This will be depreciated soon in favour of
     :func:`node_catalogue()`"""
 
-    classes = node_subclasses(Node)
-    dictionary = {}
-
-    for c in classes:
-        try:
-            name = c.identifier()
-            dictionary[name] = c
-        except AttributeError:
-            # If node does not provide identifier, we consider it to be
-            # private or abstract class
-            pass
-
-    return dictionary
+    catalogue = _get_node_catalogue()
+    return dict((name, info["factory"]) for name, info in catalogue.items())
 
 def node_catalogue():
     """Returns a dictionary of information about all available nodes. Keys are
@@ -53,8 +55,27 @@ def node_catalogue():
     all the keys from the node's `node_info` dictionary plus keys: `factory`
     with node class, `type` (if not provided) is set to one of ``source``,
     ``processing`` or ``target``.
+
+    The catalogue is created only once and cached until a new node class is
+    defined.
     """
 
+    catalogue = _get_node_catalogue()
+    return dict((name, dict(info)) for name, info in catalogue.items())
+
+def _get_node_catalogue():
+    """Returns the cached node catalogue, creates it if necessary. The
+    catalogue should not be modified."""
+    global _node_catalogue
+
+    catalogue = _node_catalogue
+    if catalogue is None:
+        catalogue = _create_node_catalogue()
+        _node_catalogue = catalogue
+
+    return catalogue
+
+def _create_node_catalogue():
     classes = node_subclasses(Node)
 
     catalogue = {}
@@ -89,6 +110,37 @@ def node_catalogue():
 
     return catalogue
 
+def load_node_plugins():
+    """Imports node extensions registered as ``brewery.nodes`` entry points
+    of installed packages. Each entry point should refer to a module (or an
+    object in a module) which defines node classes. Extensions are loaded only
+    once, on first call. Returns ``True`` if extensions were loaded by this
+    call.
+
+    Requires `setuptools` (`pkg_resources`), nothing is loaded if it is not
+    installed.
+    """
+    global _node_plugins_loaded
+
+    if _node_plugins_loaded:
+        return False
+    _node_plugins_loaded = True
+
+    try:
+        import pkg_resources
+    except ImportError:
+        return False
+
+    logger = utils.get_logger()
+    for entry_point in pkg_resources.iter_entry_points(NODE_ENTRY_POINT):
+        try:
+            entry_point.load()
+        except Exception as e:
+            logger.warn("unable to load node extension '%s': %s"
+                        % (entry_point.name, e))
+
+    return True
+
 def node_subclasses(root, abstract = False):
     """Get all subclasses of node.
 
@@ -161,11 +213,37 @@ class NodeFinished(Exception):
     requires no more data."""
     pass
 
+class _NodeMeta(type):
+    """Node metaclass: resets the cached node catalogue when a node class is
+    defined."""
+
+    def __init__(cls, name, bases, attributes):
+        super(_NodeMeta, cls).__init__(name, bases, attributes)
+
+        global _node_catalogue
+        _node_catalogue = None
+
 class Node(object):
     """Base class for procesing node
 
     .. abstract_node
     """
+
+    __metaclass__ = _NodeMeta
+
+    # Set to ``True`` in nodes that are able to move their data to disk when
+    # memory budget of the stream is exceeded.
+    spillable = False
+
+    # Set to ``True`` in nodes that consume whole input before they produce
+    # output (used in execution plans, see Stream.explain())
+    blocking = False
+
+    # Set to ``True`` by the stream planner when operation of the node is
+    # performed by its source node (see brewery.planner). Such node is not
+    # initialized and it passes rows unchanged.
+    pushed_down = False
+
     def __init__(self):
         """Creates a new data processing node.
 
@@ -173,6 +251,8 @@ class Node(object):
             * `inputs`: input pipes
             * `outputs`: output pipes
             * `description`: custom node annotation
+            * `memory`: :class:`brewery.memory.MemoryAccount` where the node
+              reports memory it uses, set by the stream. Might be ``None``.
         """
 
         super(Node, self).__init__()
@@ -180,6 +260,7 @@ class Node(object):
         self.outputs = []
         self._active_outputs = []
         self.description = None
+        self.memory = None
 
         # Experimental: dictionary to be used to retype output fields
         # Currently used only in CSV source node.
@@ -266,6 +347,18 @@ class Node(object):
         if not active_outputs:
             raise NodeFinished
 
+    def put_many(self, rows):
+        """Put list of rows into all output pipes. Faster than calling
+        :meth:`put` for each row. Raises `NodeFinished` as :meth:`put`."""
+        active_outputs = 0
+        for output in self.outputs:
+            if not output.closed():
+                output.put_many(rows)
+                active_outputs += 1
+
+        if not active_outputs:
+            raise NodeFinished
+
     def put_record(self, obj):
         """Put record into all output pipes. Convenience method. Not recommended to be used.
 
@@ -299,6 +392,28 @@ class Node(object):
 
         return self.input.fields
 
+    def estimated_rows(self, input_rows):
+        """Return estimated number of rows passed to the output by the node, used in execution
+        plans (see :meth:`brewery.streams.Stream.explain`). `input_rows` is a list of estimates
+        for the input pipes, ``None`` for unknown. Returns ``None`` if the number can not be
+        estimated.
+
+        Default implementation returns sum of the inputs, which is upper bound for nodes that
+        filter rows. Source nodes should override this method if they can tell number of rows
+        without reading the data."""
+
+        if not input_rows or None in input_rows:
+            return None
+        return sum(input_rows)
+
+    def plan_notes(self):
+        """Return list of notes about the node shown in execution plans, such as operations
+        pushed down to a data source. Called after the node is initialized (if it was).
+        Default implementation returns a note for pushed down nodes."""
+        if self.pushed_down:
+            return ["performed by the source node"]
+        return []
+
     @property
     def output_field_names(self):
         """Convenience method for gettin names of fields generated by the node. For more information
@@ -377,6 +492,12 @@ class SourceNode(Node):
     def __init__(self):
         super(SourceNode, self).__init__()
 
+    # Filter, field projection and aggregation performed by the data source,
+    # set by push_*() methods of nodes supporting pushdown
+    pushed_predicate = None
+    pushed_fields = None
+    pushed_aggregation = None
+
     @property
     def output_fields(self):
         raise NotImplementedError("SourceNode subclasses should implement output_fields")
@@ -384,6 +505,41 @@ class SourceNode(Node):
     def add_input(self, pipe):
         raise Exception("Should not add input pipe to a source node")
 
+    def push_predicate(self, predicate):
+        """Ask the node to read only rows matching `predicate` (a
+        :class:`brewery.planner.Predicate`). ``None`` removes the predicate. Returns ``True`` if
+        the node is going to filter the rows. Called by the stream planner before the node is
+        initialized. Default implementation does not support filtering."""
+        return False
+
+    def push_fields(self, keep_fields=None, drop_fields=None):
+        """Ask the node to read only `keep_fields` or to skip `drop_fields`. ``None`` for both
+        removes the projection. Returns ``True`` if the node is going to read only the requested
+        fields. Called by the stream planner before the node is initialized. Default
+        implementation does not support field projection."""
+        return False
+
+    def push_aggregation(self, aggregation):
+        """Ask the node to read rows aggregated according to `aggregation` (a
+        :class:`brewery.planner.Aggregation`), ``None`` removes the aggregation. Returns ``True``
+        if the node is going to aggregate the rows. Called by the stream planner before the node
+        is initialized. Default implementation does not support aggregation."""
+        return False
+
+    def plan_notes(self):
+        notes = super(SourceNode, self).plan_notes()
+        if self.pushed_predicate is not None:
+            notes.append("pushed down filter: %s" % self.pushed_predicate)
+        if self.pushed_fields:
+            (keep, drop) = self.pushed_fields
+            if keep:
+                notes.append("pushed down fields: %s" % ", ".join(keep))
+            else:
+                notes.append("pushed down dropped fields: %s" % ", ".join(drop))
+        if self.pushed_aggregation is not None:
+            notes.append("pushed down aggregation: %s" % self.pushed_aggregation)
+        return notes
+
 class TargetNode(Node):
     """Abstract class for all target nodes
 
@@ -4,6 +4,7 @@ from __future__ import absolute_import
 from .base import Node, Stack
 from ..dq.field_statistics import FieldStatistics
 from ..metadata import FieldMap, FieldList, Field
+from ..memory import SpillableDict, SizeEstimator
 import logging
 import itertools
 import random
@@ -62,15 +63,36 @@ class SampleNode(Node):
         if method == "percent" and ((size>100) or (size<0)):
             raise ValueError, "Sample size must be between 0 and 100 with 'percent' method."
 
+    @property
+    def blocking(self):
+        # Random sample is known only after all input is read
+        return self.method == "random"
+
+    def estimated_rows(self, input_rows):
+        rows = super(SampleNode, self).estimated_rows(input_rows)
+        if self.method == "percent":
+            return int(rows * self.size / 100.) if rows is not None else None
+        elif rows is None:
+            return self.size
+        else:
+            return min(rows, self.size)
 
     def run(self):
         pipe = self.input
         count = 0
 
+        # Stack is limited by sample size, its memory is only accounted
+        if self.stack is not None and self.memory:
+            estimator = SizeEstimator()
+        else:
+            estimator = None
+
         for row in pipe.rows():
             logging.debug("sampling row %d" % count)
             if self.method == "random":
                 uniform = random.random()
+                if estimator and len(self.stack.heap) < self.stack.depth:
+                    self.memory.allocate(estimator.size(row))
                 self.stack.push(key = uniform, value = row)
             elif self.method == "percent":
                 if random.random() < float(self.size)/100.:
@@ -118,6 +140,9 @@ class MergeNode(Node):
     details adding information to the master. By default master is the first input.
     Joins are specified as list of tuples: (`input_tag`, `master_input_key`, `other_input_key`).
 
+    Details are cached in memory before master is read. The caches are moved to disk when
+    memory budget of the stream is exceeded.
+
     Following configuration code shows how to add region and category details:
 
     .. code-block:: python
@@ -188,6 +213,8 @@ class MergeNode(Node):
 
     """
 
+    spillable = True
+
     node_info = {
         "label" : "Merge Node",
         "description" : "Merge two or more streams",
@@ -229,6 +256,12 @@ class MergeNode(Node):
 
         self._output_fields = []
 
+    def estimated_rows(self, input_rows):
+        # Inner join: at most one output row for each master row
+        if self.master < len(input_rows):
+            return input_rows[self.master]
+        return None
+
     def initialize(self):
         pass
         # Check joins and normalize them first
@@ -273,7 +306,7 @@ class MergeNode(Node):
         # Prepare storage for input data
         self._input_rows = {}
         for (tag, pipe) in enumerate(self.inputs):
-            self._input_rows[tag] = {}
+            self._input_rows[tag] = SpillableDict(self.memory)
 
         # Create map filters
 
@@ -308,6 +341,13 @@ class MergeNode(Node):
 
     def run(self):
         """Only inner join is implemented"""
+        try:
+            self._join()
+        finally:
+            for detail in self._input_rows.values():
+                detail.close()
+
+    def _join(self):
         # First, read details, then master. )
         for (tag, pipe) in self.detail_inputs:
             detail = self._input_rows[tag]
@@ -369,7 +409,12 @@ class DistinctNode(Node):
     `distinct_fields` to `organisaion` and `month`, sed `discard` to ``True``. Running this node
     should give no records on output if there are no duplicates.
 
+    Keys of seen records are moved to disk when memory budget of the stream is exceeded.
+
     """
+
+    spillable = True
+
     node_info = {
         "label" : "Distinct Node",
         "description" : "Pass only distinct records (discard duplicates) or pass only duplicates",
@@ -420,7 +465,6 @@ class DistinctNode(Node):
 
     def run(self):
         pipe = self.input
-        self.distinct_values = set()
 
         # Just copy input to output if there are no distinct keys
         # FIXME: should issue a warning?
@@ -429,12 +473,20 @@ class DistinctNode(Node):
                 self.put(row)
             return
 
+        # Seen keys are kept as dictionary keys, so they can be spilled
+        self.distinct_values = SpillableDict(self.memory)
+        try:
+            self._distinct(pipe)
+        finally:
+            self.distinct_values.close()
+
+    def _distinct(self, pipe):
         for row in pipe.rows():
             # Construct key tuple from distinct fields
             key_tuple = tuple(self.row_filter(row))
 
             if key_tuple not in self.distinct_values:
-                self.distinct_values.add(key_tuple)
+                self.distinct_values[key_tuple] = True
                 if not self.discard:
                     self.put(row)
             else:
@@ -444,32 +496,70 @@ class DistinctNode(Node):
                     self.put(row)
 
 class Aggregate(object):
-    """Structure holding aggregate information (should be replaced by named tuples in Python 3)"""
+    """Structure holding aggregate information (should be replaced by named tuples in Python 3).
+    Empty values are ignored, as in SQL aggregate functions."""
     def __init__(self):
         self.count = 0
-        self.sum = 0
-        self.min = 0
-        self.max = 0
+        self.sum = None
+        self.min = None
+        self.max = None
         self.average = None
 
     def aggregate_value(self, value):
+        if value is None:
+            return
+        if self.count:
+            self.sum += value
+            self.min = min(self.min, value)
+            self.max = max(self.max, value)
+        else:
+            self.sum = self.min = self.max = value
         self.count += 1
-        self.sum += value
-        self.min = min(self.min, value)
-        self.max = max(self.max, value)
 
     def finalize(self):
         if self.count:
-            self.average = self.sum / self.count
+            self.average = self.sum / float(self.count)
         else:
             self.average = None
+
+def aggregate_fields(input_fields, keys, measures, record_count_field="record_count"):
+    """Return fields of aggregation of `input_fields` grouped by `keys`: key fields, then
+    `<measure>_sum`, `<measure>_min`, `<measure>_max` and `<measure>_average` for each measure
+    and `record_count_field`. Used by the :class:`AggregateNode` and by data sources the
+    aggregation is pushed down to."""
+    # FIXME: use storage types based on aggregated field type
+    fields = FieldList()
+
+    if keys:
+        for field in input_fields.fields(keys):
+            fields.append(field)
+
+    for field in measures:
+        fields.append(Field(field + "_sum", storage_type = "float", analytical_type = "range"))
+        fields.append(Field(field + "_min", storage_type = "float", analytical_type = "range"))
+        fields.append(Field(field + "_max", storage_type = "float", analytical_type = "range"))
+        fields.append(Field(field + "_average", storage_type = "float", analytical_type = "range"))
+    fields.append(Field(record_count_field, storage_type = "integer", analytical_type = "range"))
+
+    return fields
 class KeyAggregate(object):
     def __init__(self):
         self.count = 0
         self.field_aggregates = {}
 
 class AggregateNode(Node):
-    """Aggregate"""
+    """Aggregate
+
+    Aggregates are kept in memory until the input is consumed. They are moved to disk when
+    memory budget of the stream is exceeded.
+
+    When the node directly follows a SQL source, the aggregation is performed by the database
+    with a ``GROUP BY`` query (see :mod:`brewery.planner`). Output rows are then ordered by the
+    keys instead of the order in which the keys were first seen.
+    """
+
+    spillable = True
+    blocking = True
 
     node_info = {
         "label" : "Aggregate Node",
@@ -517,26 +607,22 @@ class AggregateNode(Node):
 
     @property
     def output_fields(self):
-        # FIXME: use storage types based on aggregated field type
-        fields = FieldList()
-
-        if self.key_fields:
-            for field in  self.input_fields.fields(self.key_fields):
-                fields.append(field)
-
-        for field in self.measures:
-            fields.append(Field(field + "_sum", storage_type = "float", analytical_type = "range"))
-            fields.append(Field(field + "_min", storage_type = "float", analytical_type = "range"))
-            fields.append(Field(field + "_max", storage_type = "float", analytical_type = "range"))
-            fields.append(Field(field + "_average", storage_type = "float", analytical_type = "range"))
-        fields.append(Field(self.record_count_field, storage_type = "integer", analytical_type = "range"))
-
-        return fields
+        if self.pushed_down:
+            # Rows are aggregated by the source
+            return self.input_fields
+        return aggregate_fields(self.input_fields, self.key_fields, self.measures,
+                                self.record_count_field)
 
     def run(self):
+        # Keys are kept in order of their first row, spilled with aggregates
+        self.aggregates = SpillableDict(self.memory, ordered=True)
+        try:
+            self._aggregate()
+        finally:
+            self.aggregates.close()
+
+    def _aggregate(self):
         pipe = self.input
-        self.aggregates = {}
-        self.keys = []
         self.counts = {}
 
         key_selectors = self.input_fields.selectors(self.key_fields)
@@ -547,12 +633,9 @@ class AggregateNode(Node):
             key = tuple(itertools.compress(row, key_selectors))
             # Create new aggregate record for key if it does not exist
             #
-            if key not in self.keys:
-                self.keys.append(key)
+            key_aggregate = self.aggregates.get(key)
+            if key_aggregate is None:
                 key_aggregate = KeyAggregate()
-                self.aggregates[key] = key_aggregate
-            else:
-                key_aggregate = self.aggregates[key]
 
             # Create aggregations for each field to be aggregated
             #
@@ -567,11 +650,13 @@ class AggregateNode(Node):
 
                 aggregate.aggregate_value(value)
 
+            # Store the aggregate back - it might be a copy read from disk
+            self.aggregates[key] = key_aggregate
+
         # Pass results to output
-        for key in self.keys:
+        for key, key_aggregate in self.aggregates.iteritems():
             row = list(key[:])
 
-            key_aggregate = self.aggregates[key]
             for i in measure_indexes:
                 aggregate = key_aggregate.field_aggregates[i]
                 aggregate.finalize()
@@ -800,6 +885,8 @@ class AuditNode(Node):
           to None if there are more distinct values than `distinct_threshold`.
     """
 
+    blocking = True
+
     node_info = {
         "icon" : "data_audit_node",
         "label" : "Data Audit",
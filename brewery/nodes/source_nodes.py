@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
 from .base import SourceNode
+from ..ds.base import estimate_line_count
 from ..ds.csv_streams import CSVDataSource
 from ..ds.elasticsearch_streams import ESDataSource
 from ..ds.gdocs_streams import GoogleSpreadsheetDataSource
@@ -9,6 +10,12 @@ from ..ds.sql_streams import SQLDataSource
 from ..ds.xls_streams import XLSDataSource
 from ..ds.yaml_dir_streams import YamlDirectoryDataSource
 
+def _pushed_fields(keep_fields, drop_fields):
+    """Return tuple (`keep_fields`, `drop_fields`) or ``None`` if neither is set."""
+    if keep_fields or drop_fields:
+        return (keep_fields, drop_fields)
+    return None
+
 class RowListSourceNode(SourceNode):
     """Source node that feeds rows (list/tuple of values) from a list (or any other iterable)
     object."""
@@ -41,6 +48,12 @@ class RowListSourceNode(SourceNode):
             raise ValueError("Fields are not initialized")
         return self.fields
 
+    def estimated_rows(self, input_rows):
+        try:
+            return len(self.list)
+        except TypeError:
+            return None
+
     def run(self):
         for row in self.list:
             self.put(row)
@@ -79,6 +92,12 @@ class RecordListSourceNode(SourceNode):
             raise ValueError("Fields are not initialized")
         return self.fields
 
+    def estimated_rows(self, input_rows):
+        try:
+            return len(self.list)
+        except TypeError:
+            return None
+
     def run(self):
         for record in self.list:
             self.put(record)
@@ -110,6 +129,30 @@ class StreamSourceNode(SourceNode):
         super(StreamSourceNode, self).__init__()
         self.stream = stream
 
+    def push_predicate(self, predicate):
+        push = getattr(self.stream, "push_predicate", None)
+        if push and push(predicate):
+            self.pushed_predicate = predicate
+            return True
+        self.pushed_predicate = None
+        return False
+
+    def push_fields(self, keep_fields=None, drop_fields=None):
+        push = getattr(self.stream, "push_fields", None)
+        if push and push(keep_fields, drop_fields):
+            self.pushed_fields = _pushed_fields(keep_fields, drop_fields)
+            return True
+        self.pushed_fields = None
+        return False
+
+    def push_aggregation(self, aggregation):
+        push = getattr(self.stream, "push_aggregation", None)
+        if push and push(aggregation):
+            self.pushed_aggregation = aggregation
+            return True
+        self.pushed_aggregation = None
+        return False
+
     def initialize(self):
         # if self.stream_type not in data_sources:
         #     raise ValueError("No data source of type '%s'" % stream_type)
@@ -176,6 +219,30 @@ class CSVSourceNode(SourceNode):
             {
                  "name": "quotechar",
                  "description": "character used for quoting string values, default is double quote"
+            },
+            {
+                 "name": "processes",
+                 "description": "number of processes parsing a local file in parallel, default is 1"
+            },
+            {
+                 "name": "ordered",
+                 "description": "keep file order of rows parsed in parallel",
+                 "type": "flag",
+                 "default": "True"
+            },
+            {
+                 "name": "mapped",
+                 "description": "memory map a local file instead of reading it",
+                 "type": "flag",
+                 "default": "False"
+            },
+            {
+                 "name": "keep_fields",
+                 "description": "fields to be read, values of other columns are not converted"
+            },
+            {
+                 "name": "compression",
+                 "description": "gzip, bz2, xz or zstd, by default given by the file extension"
             }
         ]
     }
@@ -198,11 +265,17 @@ class CSVSourceNode(SourceNode):
 
         return self._output_fields
 
+    def push_fields(self, keep_fields=None, drop_fields=None):
+        self.pushed_fields = _pushed_fields(keep_fields, drop_fields)
+        return True
+
     def initialize(self):
         self.stream = CSVDataSource(self.resource, *self.args, **self.kwargs)
 
         if self.fields:
             self.stream.fields = self.fields
+        if self.pushed_fields:
+            self.stream.push_fields(*self.pushed_fields)
 
         self.stream.initialize()
 
@@ -210,9 +283,19 @@ class CSVSourceNode(SourceNode):
         self._output_fields = self.stream.fields.copy()
         self._output_fields.retype(self._retype_dictionary)
 
+    def estimated_rows(self, input_rows):
+        lines = estimate_line_count(self.resource)
+        if lines is None:
+            return None
+
+        skip = self.kwargs.get("skip_rows") or 0
+        if self.kwargs.get("read_header", True):
+            skip += 1
+        return max(0, lines - skip)
+
     def run(self):
-        for row in self.stream.rows():
-            self.put(row)
+        for rows in self.stream.batches():
+            self.put_many(rows)
 
     def finalize(self):
         self.stream.finalize()
@@ -467,12 +550,12 @@ class GoogleSpreadsheetSourceNode(SourceNode):
 
 
 class SQLSourceNode(SourceNode):
-    """Source node that reads from a sql table.
+    """Source node that reads from a sql table or a statement.
     """
     node_info = {
         "label" : "SQL Source",
         "icon": "sql_source_node",
-        "description" : "Read data from a sql table.",
+        "description" : "Read data from a sql table or statement.",
         "attributes" : [
             {
                  "name": "uri",
@@ -482,6 +565,43 @@ class SQLSourceNode(SourceNode):
                  "name": "table",
                  "description": "table name",
             },
+            {
+                 "name": "statement",
+                 "description": "SQL statement to be read instead of a table",
+            },
+            {
+                 "name": "params",
+                 "description": "dictionary of statement parameters",
+            },
+            {
+                 "name": "cache",
+                 "description": "cache statement results locally: ``True`` or "
+                                "path to a cache directory"
+            },
+            {
+                 "name": "cache_ttl",
+                 "description": "seconds a cached statement result is valid"
+            },
+            {
+                 "name": "partition_column",
+                 "description": "column used to split the table into partitions "
+                                "read concurrently"
+            },
+            {
+                 "name": "partitions",
+                 "description": "number of partitions (database connections), "
+                                "default is 1"
+            },
+            {
+                 "name": "partition_method",
+                 "description": "``range`` (numeric or date ranges) or ``hash`` "
+                                "(integer column modulo number of partitions)"
+            },
+            {
+                 "name": "ordered",
+                 "description": "pass partitions in order instead of as rows "
+                                "are read"
+            }
         ]
     }
     def __init__(self, *args, **kwargs):
@@ -491,6 +611,32 @@ class SQLSourceNode(SourceNode):
         self.stream = None
         self._fields = None
 
+    def _reads_statement(self):
+        """Returns ``True`` if the source reads a statement, not a table.
+        Statements are not changed by pushdowns."""
+        if self.kwargs.get("statement") is not None:
+            return True
+        # Statement is the fourth positional argument of the data source
+        return len(self.args) > 3 and self.args[3] is not None
+
+    def push_predicate(self, predicate):
+        if self._reads_statement():
+            return False
+        self.pushed_predicate = predicate
+        return True
+
+    def push_fields(self, keep_fields=None, drop_fields=None):
+        if self._reads_statement():
+            return False
+        self.pushed_fields = _pushed_fields(keep_fields, drop_fields)
+        return True
+
+    def push_aggregation(self, aggregation):
+        if self._reads_statement():
+            return False
+        self.pushed_aggregation = aggregation
+        return True
+
     @property
     def output_fields(self):
         if not self.stream:
@@ -513,6 +659,12 @@ class SQLSourceNode(SourceNode):
 
     def initialize(self):
         self.stream = SQLDataSource(*self.args, **self.kwargs)
+        self.stream.push_predicate(self.pushed_predicate)
+        if self.pushed_fields:
+            self.stream.push_fields(*self.pushed_fields)
+        else:
+            self.stream.push_fields(None, None)
+        self.stream.push_aggregation(self.pushed_aggregation)
         self.stream.initialize()
         self._fields = self.stream.fields
 
@@ -4,6 +4,7 @@ from __future__ import absolute_import
 from .base import TargetNode
 from ..ds.csv_streams import CSVDataTarget
 from ..ds.sql_streams import SQLDataTarget
+from ..memory import SpillableList
 import sys
 
 class StreamTargetNode(TargetNode):
@@ -123,6 +124,10 @@ class CSVTargetNode(TargetNode):
         * resource: target object - might be a filename or file-like object
         * write_headers: write field names as headers into output file
         * truncate: remove data from file before writing, default: True
+        * buffer_size: size of output buffer in bytes, default is 64 kB
+        * compression: ``gzip``, ``bz2``, ``xz`` or ``zstd``, by default given by
+          the file extension
+        * compress_threads: number of blocks compressed concurrently, default 1
 
     """
     node_info = {
@@ -140,6 +145,18 @@ class CSVTargetNode(TargetNode):
             {
                  "name": "truncate",
                  "description": "If set to ``True`` all data from file are removed. Default ``True``"
+            },
+            {
+                 "name": "buffer_size",
+                 "description": "Size of output buffer in bytes, default is 64 kB"
+            },
+            {
+                 "name": "compression",
+                 "description": "gzip, bz2, xz or zstd, by default given by the file extension"
+            },
+            {
+                 "name": "compress_threads",
+                 "description": "Number of blocks compressed concurrently, default 1"
             }
         ]
     }
@@ -158,8 +175,8 @@ class CSVTargetNode(TargetNode):
         self.stream.initialize()
 
     def run(self):
-        for row in self.input.rows():
-            self.stream.append(row)
+        for rows in self.input.batches():
+            self.stream.append_many(rows)
 
     def finalize(self):
         self.stream.finalize()
@@ -309,8 +326,14 @@ class FormattedPrinterNode(TargetNode):
 
 class PrettyPrinterNode(TargetNode):
     """Target node that will pretty print output as a table.
+
+    All rows are collected before printing to get column widths. Rows are moved to a temporary
+    file when memory budget of the stream is exceeded.
     """
 
+    spillable = True
+    blocking = True
+
     node_info = {
         "label" : "Pretty Printer",
         "icong": "formatted_printer_node",
@@ -378,8 +401,13 @@ class PrettyPrinterNode(TargetNode):
 
     def run(self):
 
-        rows = []
+        rows = SpillableList(self.memory)
+        try:
+            self._print(rows)
+        finally:
+            rows.close()
 
+    def _print(self, rows):
         for row in self.input.rows():
             rows.append(row)
             self._update_widths(row)
@@ -460,6 +488,44 @@ class SQLTableTargetNode(TargetNode):
                               "inserted using multi-insert statement. "
                               "Default is 1000"
             },
+            {
+                "name": "bulk",
+                "description": "bulk insert method: ``executemany``, "
+                               "``multirow``, ``copy`` (PostgreSQL), "
+                               "``load_data`` (MySQL) or ``dicts``. Default "
+                               "is ``auto`` - the fastest for the database"
+            },
+            {
+                "name": "commit_size",
+                "description": "number of rows inserted in one transaction, "
+                               "default is one transaction per buffer"
+            },
+            {
+                "name": "writers",
+                "description": "number of connections inserting buffers "
+                               "concurrently, default is 1"
+            },
+            {
+                "name": "commit",
+                "description": "``batch`` - writers commit as they insert, "
+                               "``all`` - rows are inserted into a staging "
+                               "table and moved to the target table in one "
+                               "transaction when all rows are written"
+            },
+            {
+                "name": "partition_field",
+                "description": "rows with the same value of the field are "
+                               "inserted by the same writer"
+            },
+            {
+                "name": "mode",
+                "description": "``insert`` (default) or ``upsert`` - update "
+                               "existing rows with the same keys"
+            },
+            {
+                "name": "keys",
+                "description": "key fields of the ``upsert`` mode"
+            },
             {
                  "name": "options",
                  "description": "other SQLAlchemy connect() options"
@@ -497,6 +563,8 @@ class SQLTableTargetNode(TargetNode):
     def run(self):
         for row in self.input.rows():
             self.stream.append(row)
+        # Commit in the thread that wrote the rows
+        self.stream.flush()
 
     def finalize(self):
         """Flush remaining records and close the connection if necessary"""
@@ -0,0 +1,615 @@
+# -*- coding: utf-8 -*-
+"""Stream plan rewriting: predicate, projection and aggregation pushdown.
+
+Selection and field map nodes that directly follow a source node are usually
+cheaper to perform in the data source: a database filters rows in the
+``WHERE`` clause and reads only requested columns, MongoDB does the same with
+a query and a projection. :func:`optimize_stream` looks for such chains::
+
+    source -> select -> ... -> select -> field map or aggregate
+
+and asks the source node to perform them:
+
+* filters of :class:`SetSelectNode`, :class:`FunctionSelectNode` with simple
+  comparisons and :class:`SelectNode` with simple conditions are converted
+  into a backend independent :class:`Predicate` and passed to the source node
+  with ``push_predicate()``. Selection nodes whose filter was accepted by the
+  source pass rows unchanged (see `Node.pushed_down`).
+* fields kept or dropped by the :class:`FieldMapNode` are passed to the
+  source node with ``push_fields()``. The field map node is still run, as it
+  might rename fields. Key and measure fields of an :class:`AggregateNode`
+  which is not pushed down are passed the same way.
+* :class:`AggregateNode` that follows the source (directly or after pushed
+  down selections) is passed to the source node as an :class:`Aggregation`
+  with ``push_aggregation()``. A SQL source reads aggregated rows with a
+  ``GROUP BY`` query, the aggregate node passes them unchanged.
+
+Supported conditions are comparisons (``==``, ``!=``, ``<``, ``<=``, ``>``,
+``>=``) of a field with a constant, ``in`` and ``not in`` with a collection of
+constants, ``is None`` and ``is not None``, combined with ``and``, ``or`` and
+``not``. Anything else is not pushed down and the node filters rows in Python
+as before.
+
+Predicates preserve the Python semantics of comparisons with ``None``: in
+Python 2 ``None`` is less than any value, therefore ``amount < 10`` is
+translated to ``amount < 10 OR amount IS NULL``.
+
+Functions of :class:`FunctionSelectNode` and callable conditions of
+:class:`SelectNode` are inspected by calling them once with placeholder
+values, the functions should have no side effects.
+"""
+
+import ast
+import inspect
+import datetime
+import decimal
+from brewery.nodes import SourceNode, SelectNode, FunctionSelectNode, \
+                          SetSelectNode, FieldMapNode, AggregateNode
+from brewery.nodes.record_nodes import aggregate_fields
+from brewery.utils import get_logger
+
+__all__ = [
+    "Predicate",
+    "Comparison",
+    "And",
+    "Or",
+    "Aggregation",
+    "node_predicate",
+    "expression_predicate",
+    "optimize_stream",
+    "clear_pushdowns"
+]
+
+_negated_operators = {
+    "==": "!=", "!=": "==",
+    "<": ">=", ">=": "<",
+    ">": "<=", "<=": ">",
+    "in": "not in", "not in": "in"
+}
+
+_constant_types = (basestring, bool, int, long, float, decimal.Decimal,
+                   datetime.date, datetime.time, datetime.timedelta)
+
+class Predicate(object):
+    """Backend independent row filter."""
+
+    def negate(self):
+        """Return negated predicate."""
+        raise NotImplementedError
+
+    def fields(self):
+        """Return set of names of fields used by the predicate."""
+        raise NotImplementedError
+
+    def sql_clause(self, columns):
+        """Return SQLAlchemy clause of the predicate. `columns` is a mapping
+        of field names and table columns, such as ``table.c``."""
+        raise NotImplementedError
+
+    def mongo_query(self):
+        """Return MongoDB query document of the predicate."""
+        raise NotImplementedError
+
+class Comparison(Predicate):
+    """Comparison of a field with a constant value.
+
+    :Attributes:
+        * `field` - field name
+        * `operator` - one of ``==``, ``!=``, ``<``, ``<=``, ``>``, ``>=``,
+          ``in`` and ``not in``
+        * `value` - constant value, list of values for ``in`` and ``not in``
+    """
+    def __init__(self, field, operator, value):
+        if operator not in _negated_operators:
+            raise ValueError("Unsupported comparison operator '%s'" % operator)
+        if operator in ("in", "not in"):
+            value = list(value)
+        self.field = field
+        self.operator = operator
+        self.value = value
+
+    def negate(self):
+        # Python 2 orders None before any value, so the negation of a
+        # comparison is the opposite comparison even for None
+        return Comparison(self.field, _negated_operators[self.operator], self.value)
+
+    def fields(self):
+        return set([self.field])
+
+    def sql_clause(self, columns):
+        from brewery.ds.sql_streams import sqlalchemy
+
+        column = columns[self.field]
+        op = self.operator
+        value = self.value
+
+        if op in ("in", "not in"):
+            values = [v for v in value if v is not None]
+            has_null = len(values) != len(value)
+            if op == "in":
+                clauses = [column.in_(values)] if values else []
+                if has_null:
+                    clauses.append(column == None)
+                if not clauses:
+                    return sqlalchemy.sql.expression.false()
+                return sqlalchemy.or_(*clauses)
+            else:
+                if has_null:
+                    clauses = [column != None]
+                    if values:
+                        clauses.append(~column.in_(values))
+                    return sqlalchemy.and_(*clauses)
+                if not values:
+                    return sqlalchemy.sql.expression.true()
+                return sqlalchemy.or_(~column.in_(values), column == None)
+
+        if value is None:
+            return column == None if op == "==" else column != None
+
+        if op == "==":
+            return column == value
+        elif op == ">":
+            return column > value
+        elif op == ">=":
+            return column >= value
+        elif op == "<":
+            return sqlalchemy.or_(column < value, column == None)
+        elif op == "<=":
+            return sqlalchemy.or_(column <= value, column == None)
+        else:
+            return sqlalchemy.or_(column != value, column == None)
+
+    def mongo_query(self):
+        op = self.operator
+        if op == "==":
+            return {self.field: self.value}
+        elif op == "in":
+            return {self.field: {"$in": self.value}}
+        elif op == "not in":
+            return {self.field: {"$nin": self.value}}
+        elif op == "!=":
+            return {self.field: {"$ne": self.value}}
+        elif op in (">", ">="):
+            return {self.field: {"$gt" if op == ">" else "$gte": self.value}}
+        else:
+            # Missing values and nulls are less than anything
+            mongo_op = "$lt" if op == "<" else "$lte"
+            return {"$or": [{self.field: {mongo_op: self.value}},
+                            {self.field: None}]}
+
+    def __eq__(self, other):
+        return isinstance(other, Comparison) and self.field == other.field \
+                and self.operator == other.operator and self.value == other.value
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __str__(self):
+        if self.operator in ("in", "not in"):
+            value = "(%s)" % ", ".join(repr(v) for v in self.value)
+        else:
+            value = repr(self.value)
+        return "%s %s %s" % (self.field, self.operator, value)
+
+    def __repr__(self):
+        return "Comparison(%r, %r, %r)" % (self.field, self.operator, self.value)
+
+class _Compound(Predicate):
+    operator = None
+
+    def __init__(self, predicates):
+        self.predicates = list(predicates)
+
+    def fields(self):
+        fields = set()
+        for predicate in self.predicates:
+            fields |= predicate.fields()
+        return fields
+
+    def __eq__(self, other):
+        return type(self) == type(other) and self.predicates == other.predicates
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __str__(self):
+        parts = []
+        for predicate in self.predicates:
+            if isinstance(predicate, _Compound):
+                parts.append("(%s)" % predicate)
+            else:
+                parts.append(str(predicate))
+        return (" %s " % self.operator).join(parts)
+
+class And(_Compound):
+    """Conjunction of predicates."""
+    operator = "and"
+
+    def negate(self):
+        return Or(p.negate() for p in self.predicates)
+
+    def sql_clause(self, columns):
+        from brewery.ds.sql_streams import sqlalchemy
+        return sqlalchemy.and_(*[p.sql_clause(columns) for p in self.predicates])
+
+    def mongo_query(self):
+        return {"$and": [p.mongo_query() for p in self.predicates]}
+
+class Or(_Compound):
+    """Disjunction of predicates."""
+    operator = "or"
+
+    def negate(self):
+        return And(p.negate() for p in self.predicates)
+
+    def sql_clause(self, columns):
+        from brewery.ds.sql_streams import sqlalchemy
+        return sqlalchemy.or_(*[p.sql_clause(columns) for p in self.predicates])
+
+    def mongo_query(self):
+        return {"$or": [p.mongo_query() for p in self.predicates]}
+
+class Aggregation(object):
+    """Backend independent aggregation of :class:`AggregateNode`.
+
+    :Attributes:
+        * `keys` - list of names of fields the rows are grouped by
+        * `measures` - list of names of aggregated fields
+        * `record_count_field` - name of the record count field
+    """
+    def __init__(self, keys, measures, record_count_field="record_count"):
+        self.keys = list(keys or [])
+        self.measures = list(measures or [])
+        self.record_count_field = record_count_field
+
+    def output_fields(self, fields):
+        """Return fields of the aggregation of `fields`, the same as fields
+        of the :class:`AggregateNode`."""
+        return aggregate_fields(fields, self.keys, self.measures,
+                                self.record_count_field)
+
+    def sql_statement(self, columns):
+        """Return SQLAlchemy ``SELECT ... GROUP BY`` statement. `columns` is
+        a mapping of field names and table columns, such as ``table.c``.
+        Rows are ordered by the keys."""
+        from brewery.ds.sql_streams import sqlalchemy
+        func = sqlalchemy.sql.expression.func
+
+        keys = [columns[key] for key in self.keys]
+        selection = list(keys)
+        for measure in self.measures:
+            column = columns[measure]
+            selection += [func.sum(column).label(measure + "_sum"),
+                          func.min(column).label(measure + "_min"),
+                          func.max(column).label(measure + "_max"),
+                          func.avg(column).label(measure + "_average")]
+        count = func.count().label(self.record_count_field)
+        selection.append(count)
+
+        statement = sqlalchemy.sql.expression.select(selection)
+        if keys:
+            statement = statement.group_by(*keys).order_by(*keys)
+        else:
+            # Aggregation of no rows has no output rows
+            statement = statement.having(func.count() > 0)
+        return statement
+
+    def __str__(self):
+        measures = ", ".join(self.measures) or "(none)"
+        if self.keys:
+            return "%s by %s" % (measures, ", ".join(self.keys))
+        return measures
+
+def _is_constant(value):
+    return value is None or isinstance(value, _constant_types)
+
+def _comparison(field, operator, value):
+    """Return comparison of `field` with `value` or ``None`` if it can not be
+    pushed down."""
+    if operator in ("in", "not in"):
+        if not isinstance(value, (list, tuple, set, frozenset)) \
+                or not all(_is_constant(v) for v in value):
+            return None
+    elif not _is_constant(value):
+        return None
+    elif value is None and operator not in ("==", "!="):
+        return None
+    return Comparison(field, operator, value)
+
+class _NotTraceable(Exception):
+    pass
+
+class _Traced(object):
+    """Result of a comparison of a placeholder, it can not be used as a
+    boolean value - `and`, `or`, `not` and `in` are not traceable."""
+    def __init__(self, predicate):
+        self.predicate = predicate
+
+    def __nonzero__(self):
+        raise _NotTraceable()
+
+class _Placeholder(object):
+    """Placeholder of a field value passed to traced functions."""
+    def __init__(self, name):
+        self.name = name
+
+    def _compare(self, operator, other):
+        if isinstance(other, (_Placeholder, _Traced)):
+            raise _NotTraceable()
+        comparison = _comparison(self.name, operator, other)
+        if comparison is None:
+            raise _NotTraceable()
+        return _Traced(comparison)
+
+    def __eq__(self, other):
+        return self._compare("==", other)
+
+    def __ne__(self, other):
+        return self._compare("!=", other)
+
+    def __lt__(self, other):
+        return self._compare("<", other)
+
+    def __le__(self, other):
+        return self._compare("<=", other)
+
+    def __gt__(self, other):
+        return self._compare(">", other)
+
+    def __ge__(self, other):
+        return self._compare(">=", other)
+
+    def __nonzero__(self):
+        raise _NotTraceable()
+
+    __hash__ = object.__hash__
+
+def _trace(function, *args, **kwargs):
+    """Call `function` with placeholders and return resulting predicate or
+    ``None`` if the function is not a simple comparison."""
+    try:
+        result = function(*args, **kwargs)
+    except Exception:
+        return None
+
+    if isinstance(result, _Traced):
+        return result.predicate
+    return None
+
+def expression_predicate(expression):
+    """Return predicate of python `expression` string where names are field
+    names, or ``None`` if the expression is not supported."""
+    try:
+        tree = ast.parse(expression.strip(), mode="eval")
+    except SyntaxError:
+        return None
+    return _ast_predicate(tree.body)
+
+_ast_operators = {
+    ast.Eq: "==", ast.NotEq: "!=", ast.Lt: "<", ast.LtE: "<=",
+    ast.Gt: ">", ast.GtE: ">=", ast.In: "in", ast.NotIn: "not in",
+    ast.Is: "==", ast.IsNot: "!="
+}
+
+_ast_reflected = {"<": ">", "<=": ">=", ">": "<", ">=": "<=", "==": "==", "!=": "!="}
+
+_no_value = object()
+
+def _ast_constant(node):
+    """Return value of constant expression `node` or `_no_value`."""
+    if isinstance(node, ast.Num):
+        return node.n
+    elif isinstance(node, ast.Str):
+        return node.s
+    elif isinstance(node, ast.Name) and node.id in ("None", "True", "False"):
+        return {"None": None, "True": True, "False": False}[node.id]
+    elif isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub) \
+            and isinstance(node.operand, ast.Num):
+        return -node.operand.n
+    elif isinstance(node, (ast.Tuple, ast.List, ast.Set)):
+        values = [_ast_constant(item) for item in node.elts]
+        if _no_value in values:
+            return _no_value
+        return values
+    return _no_value
+
+def _ast_field(node):
+    if isinstance(node, ast.Name) and node.id not in ("None", "True", "False"):
+        return node.id
+    return None
+
+def _ast_predicate(node):
+    if isinstance(node, ast.BoolOp):
+        predicates = [_ast_predicate(value) for value in node.values]
+        if None in predicates:
+            return None
+        if isinstance(node.op, ast.And):
+            return And(predicates)
+        return Or(predicates)
+
+    elif isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+        predicate = _ast_predicate(node.operand)
+        return predicate.negate() if predicate else None
+
+    elif isinstance(node, ast.Compare):
+        predicates = []
+        left = node.left
+        for op, right in zip(node.ops, node.comparators):
+            operator = _ast_operators.get(type(op))
+            if operator is None:
+                return None
+
+            field = _ast_field(left)
+            value = _ast_constant(right)
+            if field is None or value is _no_value:
+                # constant <op> field
+                if operator in ("in", "not in"):
+                    return None
+                field = _ast_field(right)
+                value = _ast_constant(left)
+                operator = _ast_reflected[operator]
+
+            if field is None or value is _no_value:
+                return None
+            if isinstance(op, (ast.Is, ast.IsNot)) and value is not None:
+                return None
+
+            predicate = _comparison(field, operator, value)
+            if predicate is None:
+                return None
+            predicates.append(predicate)
+            left = right
+
+        if len(predicates) == 1:
+            return predicates[0]
+        return And(predicates)
+
+    return None
+
+def node_predicate(node):
+    """Return predicate equivalent to the filter of selection `node` or
+    ``None`` if the node is not a selection or its condition is not
+    supported."""
+
+    if isinstance(node, SetSelectNode):
+        if node.field is None or node.value_set is None:
+            return None
+        predicate = _comparison(node.field, "in", list(node.value_set))
+
+    elif isinstance(node, FunctionSelectNode):
+        if not node.function or not node.fields:
+            return None
+        args = [_Placeholder(name) for name in node.fields]
+        predicate = _trace(node.function, *args, **node.kwargs)
+
+    elif isinstance(node, SelectNode):
+        # Records matching the condition are passed regardless of the
+        # discard flag, see SelectNode.run()
+        if isinstance(node.condition, basestring):
+            predicate = expression_predicate(node.condition)
+        elif callable(node.condition):
+            try:
+                spec = inspect.getargspec(node.condition)
+            except TypeError:
+                return None
+            if spec.varargs:
+                return None
+            kwargs = dict((name, _Placeholder(name)) for name in spec.args)
+            predicate = _trace(node.condition, **kwargs)
+        else:
+            return None
+        return predicate
+
+    else:
+        return None
+
+    if predicate is not None and node.discard:
+        predicate = predicate.negate()
+    return predicate
+
+def clear_pushdowns(nodes):
+    """Remove pushdowns from `nodes`, so they are run as configured."""
+    for node in nodes:
+        node.pushed_down = False
+        if isinstance(node, SourceNode):
+            node.push_predicate(None)
+            node.push_fields(None, None)
+            node.push_aggregation(None)
+
+def optimize_stream(stream):
+    """Push filters and field projections of nodes following source nodes of
+    `stream` into the sources. Previous pushdowns are cleared. Returns list of
+    tuples (`source`, `node`) of nodes whose operation was pushed into
+    `source`."""
+
+    logger = get_logger()
+    nodes = stream.sorted_nodes()
+    clear_pushdowns(nodes)
+
+    pushed = []
+    for source in nodes:
+        if not isinstance(source, SourceNode):
+            continue
+        pushed += _push_chain(stream, source, logger)
+
+    return pushed
+
+def _single_target(stream, node):
+    targets = stream.node_targets(node)
+    if len(targets) == 1 and len(stream.node_sources(targets[0])) == 1:
+        return targets[0]
+    return None
+
+def _push_chain(stream, source, logger):
+    selects = []
+    predicates = []
+    # Fields used by selections evaluated in Python, None means all fields
+    needed = set()
+
+    node = _single_target(stream, source)
+    while isinstance(node, (SelectNode, FunctionSelectNode, SetSelectNode)):
+        predicate = node_predicate(node)
+        if predicate is not None:
+            selects.append(node)
+            predicates.append(predicate)
+        elif needed is not None:
+            if isinstance(node, SetSelectNode):
+                needed.add(node.field)
+            elif isinstance(node, FunctionSelectNode) and node.fields:
+                needed |= set(node.fields)
+            else:
+                needed = None
+        node = _single_target(stream, node)
+
+    pushed = []
+    source_name = stream.node_name(source)
+
+    filtered = True
+    if predicates:
+        predicate = predicates[0] if len(predicates) == 1 else And(predicates)
+        if source.push_predicate(predicate):
+            logger.debug("filter '%s' pushed down to source %s"
+                         % (predicate, source_name))
+            for select in selects:
+                select.pushed_down = True
+                pushed.append((source, select))
+        else:
+            filtered = False
+            # Selections are evaluated in Python and need their fields
+            if needed is not None:
+                for predicate in predicates:
+                    needed |= set(predicate.fields())
+
+    # Aggregation is pushed only if all preceding filters are
+    if isinstance(node, AggregateNode) and filtered and needed == set():
+        aggregation = Aggregation(node.key_fields, node.measures,
+                                  node.record_count_field)
+        if source.push_aggregation(aggregation):
+            logger.debug("aggregation of %s pushed down to source %s"
+                         % (stream.node_name(node), source_name))
+            node.pushed_down = True
+            pushed.append((source, node))
+
+    # Aggregation performed by the node needs only key and measure fields
+    if isinstance(node, AggregateNode) and not node.pushed_down \
+            and needed is not None and (node.key_fields or node.measures):
+        keep = set(node.key_fields) | set(node.measures) | needed
+        if source.push_fields(keep_fields=sorted(keep)):
+            logger.debug("fields of %s pushed down to source %s"
+                         % (stream.node_name(node), source_name))
+            pushed.append((source, node))
+
+    if isinstance(node, FieldMapNode) and needed is not None \
+            and (node.kept_fields or node.dropped_fields):
+        if node.kept_fields:
+            keep = set(node.kept_fields) | needed
+            accepted = source.push_fields(keep_fields=sorted(keep))
+        else:
+            drop = set(node.dropped_fields) - needed
+            accepted = source.push_fields(drop_fields=sorted(drop))
+        if accepted:
+            logger.debug("fields of %s pushed down to source %s"
+                         % (stream.node_name(node), source_name))
+            pushed.append((source, node))
+
+    return pushed
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+"""Per-node profiling of running streams.
+
+Standard profilers see only the thread they were started in. Streams run
+every node in a separate thread, therefore the main thread just waits in
+``thread.join()``. The :class:`StreamProfiler` profiles each node thread
+separately, either with ``cProfile`` or with a low-overhead sampling profiler
+(or both).
+"""
+
+import cProfile
+import pstats
+import threading
+import thread
+import time
+import sys
+import os
+import re
+import StringIO
+from brewery.utils import get_logger
+
+__all__ = [
+    "StreamProfiler"
+]
+
+profiling_methods = ("all", "cprofile", "sample")
+
+class StreamProfiler(object):
+    """Collects profiling information for each node of a stream."""
+
+    def __init__(self, method="all", sample_interval=0.005):
+        """Creates a stream profiler.
+
+        :Parameters:
+            * `method` - ``cprofile`` - profile each node thread with
+              ``cProfile``, ``sample`` - periodically sample stacks of node
+              threads, ``all`` (default) - use both methods
+            * `sample_interval` - time in seconds between two stack samples.
+              Default is 5 ms.
+
+        Node names are registered with :meth:`add_node` before the stream is
+        run. Nodes are run through :meth:`run_node` from within their
+        threads.
+        """
+
+        if method not in profiling_methods:
+            raise ValueError("Unknown profiling method '%s'. Use one of: %s"
+                                % (method, ", ".join(profiling_methods)))
+
+        super(StreamProfiler, self).__init__()
+
+        self.method = method
+        self.sample_interval = sample_interval
+        self.logger = get_logger()
+
+        self.names = {}
+        self.profiles = {}
+        self.stacks = {}
+        self.run_times = {}
+
+        self._node_threads = {}
+        self._lock = threading.Lock()
+        self._sampler = None
+        self._stopped = threading.Event()
+
+    @property
+    def uses_cprofile(self):
+        return self.method in ("all", "cprofile")
+
+    @property
+    def uses_sampling(self):
+        return self.method in ("all", "sample")
+
+    def add_node(self, node, name):
+        """Register `node` with `name`. Name is used in reports and as base
+        of report file names."""
+        self.names[node] = name
+
+    def start(self):
+        """Start the sampler thread, if sampling is requested."""
+        if not self.uses_sampling:
+            return
+
+        self._stopped.clear()
+        self._sampler = threading.Thread(target=self._sample,
+                                         name="brewery-profiler-sampler")
+        self._sampler.daemon = True
+        self._sampler.start()
+
+    def stop(self):
+        """Stop the sampler thread."""
+        if self._sampler:
+            self._stopped.set()
+            self._sampler.join()
+            self._sampler = None
+
+    def run_node(self, node):
+        """Run `node` under the profiler. Should be called from the thread
+        that runs the node."""
+
+        ident = thread.get_ident()
+
+        with self._lock:
+            self._node_threads[ident] = node
+            self.stacks.setdefault(node, {})
+
+        start = time.time()
+        try:
+            if self.uses_cprofile:
+                profile = cProfile.Profile()
+                self.profiles[node] = profile
+                profile.runcall(node.run)
+            else:
+                node.run()
+        finally:
+            self.run_times[node] = time.time() - start
+            with self._lock:
+                del self._node_threads[ident]
+
+    def _sample(self):
+        """Sampler thread loop: collect stacks of all running node threads."""
+        while not self._stopped.is_set():
+            frames = sys._current_frames()
+            with self._lock:
+                threads = self._node_threads.items()
+
+            for ident, node in threads:
+                frame = frames.get(ident)
+                if frame is None:
+                    continue
+                stack = self._collapse_frame(frame)
+                if stack:
+                    counts = self.stacks[node]
+                    counts[stack] = counts.get(stack, 0) + 1
+
+            del frames
+            self._stopped.wait(self.sample_interval)
+
+    def _collapse_frame(self, frame):
+        """Return stack of `frame` as a string of semicolon separated frame
+        labels, from the outermost frame to the innermost one. Frames of the
+        stream runner (including the profiler itself) are not included."""
+        labels = []
+
+        while frame is not None:
+            code = frame.f_code
+            if code in _runner_codes:
+                break
+            labels.append("%s (%s:%d)" % (code.co_name,
+                                          os.path.basename(code.co_filename),
+                                          code.co_firstlineno))
+            frame = frame.f_back
+
+        labels.reverse()
+        return ";".join(label.replace(";", ",") for label in labels)
+
+    def stats(self, node):
+        """Return `pstats.Stats` object for `node` or ``None`` if the node
+        was not profiled with ``cProfile``."""
+        profile = self.profiles.get(node)
+        if not profile:
+            return None
+        return pstats.Stats(profile)
+
+    def report(self, node, sort="cumulative", limit=40):
+        """Return text report of the ``cProfile`` statistics for `node`."""
+        stats = self.stats(node)
+        if not stats:
+            return ""
+
+        output = StringIO.StringIO()
+        stats.stream = output
+        stats.sort_stats(sort).print_stats(limit)
+        return output.getvalue()
+
+    def collapsed_stacks(self, node, root=None):
+        """Return sampled stacks of `node` in the collapsed format used by
+        flame graph tools (such as ``flamegraph.pl``): one line per unique
+        stack with frames separated by semicolons and followed by the sample
+        count. If `root` is specified, then it is prepended to each stack as
+        the outermost frame."""
+
+        lines = []
+        for stack, count in sorted(self.stacks.get(node, {}).items()):
+            if root:
+                stack = root + ";" + stack
+            lines.append("%s %d" % (stack, count))
+        return lines
+
+    def summary(self):
+        """Return list of tuples (`name`, `run time`, `profiled time`,
+        `samples`) for every profiled node. `profiled time` is total time
+        spent in functions as measured by ``cProfile`` and is ``None`` if
+        ``cProfile`` was not used."""
+        result = []
+        for node, name in self.names.items():
+            if node not in self.run_times:
+                continue
+            stats = self.stats(node)
+            total = stats.total_tt if stats else None
+            samples = sum(self.stacks.get(node, {}).values())
+            result.append( (name, self.run_times[node], total, samples) )
+
+        result.sort(key=lambda item: item[1], reverse=True)
+        return result
+
+    def write_reports(self, directory):
+        """Write profiling reports into `directory`. For each node there is:
+
+        * ``NAME.txt`` - text report of the ``cProfile`` statistics
+        * ``NAME.prof`` - ``cProfile`` statistics for use with `pstats` or
+          other profile viewers
+        * ``NAME.folded`` - collapsed stacks for flame graphs
+
+        Stacks of all nodes are also written into ``stream.folded``, where the
+        outermost frame of each stack is the node name.
+
+        Returns list of written file paths.
+        """
+
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        paths = []
+        all_stacks = []
+
+        for node, name in self.names.items():
+            if node not in self.run_times:
+                continue
+            base_name = os.path.join(directory, _safe_file_name(name))
+
+            stats = self.stats(node)
+            if stats:
+                path = base_name + ".txt"
+                with open(path, "w") as handle:
+                    handle.write(self.report(node))
+                paths.append(path)
+
+                path = base_name + ".prof"
+                stats.dump_stats(path)
+                paths.append(path)
+
+            if self.uses_sampling:
+                path = base_name + ".folded"
+                lines = self.collapsed_stacks(node)
+                _write_lines(path, lines)
+                paths.append(path)
+
+                all_stacks += self.collapsed_stacks(node, root=name)
+
+        if self.uses_sampling:
+            path = os.path.join(directory, "stream.folded")
+            _write_lines(path, all_stacks)
+            paths.append(path)
+
+        return paths
+
+# Code of functions that call Node.run() - stack collapsing stops there
+_runner_codes = (StreamProfiler.run_node.__func__.__code__,
+                 cProfile.Profile.runcall.__func__.__code__)
+
+def _safe_file_name(name):
+    return re.sub(r"[^\w.-]", "_", name)
+
+def _write_lines(path, lines):
+    with open(path, "w") as handle:
+        for line in lines:
+            handle.write(line)
+            handle.write("\n")
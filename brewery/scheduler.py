@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""Cooperative M:N scheduler for running stream nodes.
+
+By default every node of a stream is run in its own thread. Large streams
+create many threads which are mostly idle, waiting for their pipes. The
+:class:`CooperativeScheduler` runs nodes as coroutines (greenlets) on a small
+pool of worker threads instead. A node that waits for an empty or full
+:class:`CooperativePipe` yields to the scheduler of its worker and the worker
+runs another node that is ready.
+
+Nodes do not have to be changed - waiting happens inside the pipe methods
+``put()`` and ``rows()``. Nodes are assigned to workers statically, a node
+always runs in the same worker thread. Pipes between nodes of different
+workers wake the waiting node through the scheduler of its worker.
+
+Requires the `greenlet` package.
+"""
+
+import threading
+import collections
+import time
+from brewery.streams import Pipe
+from brewery.utils import get_logger
+
+try:
+    import greenlet
+except ImportError:
+    from brewery.utils import MissingPackage
+    greenlet = MissingPackage("greenlet", "cooperative stream scheduler",
+                              "http://pypi.python.org/pypi/greenlet")
+
+__all__ = [
+    "CooperativeScheduler",
+    "CooperativePipe"
+]
+
+# Waiter of the task currently running in a worker thread
+_local = threading.local()
+
+class _ThreadWaiter(object):
+    """Waiter for code that is not run by the scheduler, such as a stream
+    iterator consuming rows in the caller's thread."""
+    def __init__(self):
+        self.event = threading.Event()
+
+    def wait(self):
+        self.event.wait()
+        self.event.clear()
+
+    def wake(self):
+        self.event.set()
+
+class _TaskWaiter(object):
+    """Waiter for a task run by a worker: waiting switches to the worker's
+    hub, waking schedules the task in its worker."""
+    def __init__(self, worker, task):
+        self.worker = worker
+        self.task = task
+
+    def wait(self):
+        self.worker.hub.switch()
+
+    def wake(self):
+        self.worker.schedule(self.task)
+
+def current_waiter():
+    """Return waiter for the code being executed: task waiter within a
+    scheduled node, otherwise thread waiter."""
+    waiter = getattr(_local, "waiter", None)
+    if waiter is None:
+        waiter = _ThreadWaiter()
+        _local.waiter = waiter
+    return waiter
+
+class CooperativePipe(Pipe):
+    """Pipe for nodes run by the :class:`CooperativeScheduler`. Instead of
+    blocking the thread, waiting node yields to the scheduler. The pipe
+    mutex is held only while the pipe state is being changed, never while
+    waiting."""
+
+    def __init__(self, buffer_size=1000):
+        super(CooperativePipe, self).__init__(buffer_size)
+        self._sender = None
+        self._receiver = None
+
+    def _flush(self, close=False):
+        self._account_memory()
+
+        while True:
+            with self.mutex:
+                if self._closed:
+                    self.sender_waiting = False
+                    return
+
+                if not self.staging_buffer or self.is_consumed():
+                    self.sender_waiting = False
+                    if self.staging_buffer:
+                        self.rows_sent += len(self.staging_buffer)
+                        self.last_activity = time.time()
+                        self._ready_buffer = self.staging_buffer
+                        self.staging_buffer = []
+                    self._closed = close
+                    receiver = self._receiver
+                    self._receiver = None
+                    break
+
+                waiter = current_waiter()
+                self._sender = waiter
+                self.sender_waiting = True
+
+            waiter.wait()
+
+        if receiver:
+            receiver.wake()
+
+    def batches(self):
+        while True:
+            with self.mutex:
+                rows = self._ready_buffer
+                closed = self._closed
+                if rows:
+                    self.receiver_waiting = False
+                    self._ready_buffer = None
+                    self.last_activity = time.time()
+                    sender = self._sender
+                    self._sender = None
+                elif not closed:
+                    waiter = current_waiter()
+                    self._receiver = waiter
+                    self.receiver_waiting = True
+                else:
+                    self.receiver_waiting = False
+
+            if rows:
+                if sender:
+                    sender.wake()
+                yield rows
+            elif closed:
+                break
+            else:
+                waiter.wait()
+
+    def done_receiving(self):
+        self.abort()
+
+    def abort(self):
+        with self.mutex:
+            self._closed = True
+            waiters = [self._sender, self._receiver]
+            self._sender = None
+            self._receiver = None
+
+        for waiter in waiters:
+            if waiter:
+                waiter.wake()
+
+class _Worker(threading.Thread):
+    """Worker thread running tasks as greenlets."""
+
+    def __init__(self, tasks, name):
+        super(_Worker, self).__init__(name=name)
+        self.daemon = True
+        self.tasks = tasks
+        self.hub = None
+
+        self._ready = collections.deque()
+        self._scheduled = set()
+        self._condition = threading.Condition(threading.Lock())
+
+    def schedule(self, task):
+        """Schedule `task` to be run by the worker. Might be called from any
+        thread."""
+        with self._condition:
+            if task not in self._scheduled:
+                self._scheduled.add(task)
+                self._ready.append(task)
+                self._condition.notify()
+
+    def run(self):
+        self.hub = greenlet.getcurrent()
+
+        for task in self.tasks:
+            task.greenlet = greenlet.greenlet(task.run)
+            task.waiter = _TaskWaiter(self, task)
+            self.schedule(task)
+
+        active = len(self.tasks)
+        while active:
+            with self._condition:
+                while not self._ready:
+                    self._condition.wait()
+                task = self._ready.popleft()
+                self._scheduled.discard(task)
+
+            if task.greenlet.dead:
+                continue
+
+            _local.waiter = task.waiter
+            try:
+                task.greenlet.switch()
+            finally:
+                _local.waiter = None
+
+            if task.greenlet.dead:
+                active -= 1
+
+class CooperativeScheduler(object):
+    """Runs tasks (usually wrapped stream nodes) on a pool of worker
+    threads."""
+
+    def __init__(self, tasks, workers=4):
+        """Creates a scheduler.
+
+        :Parameters:
+            * `tasks` - list of tasks to be run. Task is an object with a
+              `run()` method. Tasks are assigned to the workers in contiguous
+              blocks, therefore neighbouring tasks (such as nodes in
+              topological order) usually share a worker.
+            * `workers` - number of worker threads, default is 4
+
+        Each task gets `greenlet` attribute when it is started.
+        """
+        super(CooperativeScheduler, self).__init__()
+
+        self.tasks = tasks
+        self.logger = get_logger()
+
+        count = max(1, min(workers, len(tasks)))
+        self.workers = []
+        for i in range(count):
+            start = i * len(tasks) // count
+            end = (i + 1) * len(tasks) // count
+            worker = _Worker(tasks[start:end], "brewery-worker-%d" % i)
+            self.workers.append(worker)
+
+    def start(self):
+        """Start worker threads."""
+        self.logger.debug("starting %d workers for %d tasks"
+                          % (len(self.workers), len(self.tasks)))
+        for worker in self.workers:
+            worker.start()
+
+    def join(self):
+        """Wait until all tasks are finished."""
+        for worker in self.workers:
+            while worker.is_alive():
+                # Join with timeout to keep the main thread responsive
+                worker.join(1.0)
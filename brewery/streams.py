@@ -1,12 +1,20 @@
 # -*- coding: utf-8 -*-
 
 import threading
+import time
 import sys
-from brewery.nodes.base import node_dictionary, TargetNode, NodeFinished
+import collections
+import Queue
+from brewery.nodes.base import node_dictionary, create_node, TargetNode, NodeFinished
 from brewery.utils import get_logger
 from brewery.nodes import *
 from brewery.common import *
 from .graph import *
+from .profiling import StreamProfiler
+from .watchdog import StreamWatchdog
+from .memory import MemoryBudget, MemoryBudgetExceeded, parse_memory_size, \
+                    estimate_size
+from .planner import optimize_stream, clear_pushdowns
 
 __all__ = [
     "Stream",
@@ -36,6 +44,11 @@ class SimpleDataPipe(object):
     def rows(self):
         return self.buffer
 
+    def batches(self):
+        """Get all rows in one list."""
+        if self.buffer:
+            yield self.buffer
+
     def records(self):
         """Get data objects from pipe as records (dict objects). This is convenience method with
         performance costs. Nodes are recommended to process rows instead."""
@@ -54,6 +67,11 @@ class SimpleDataPipe(object):
     def put(self, obj):
         self.buffer.append(obj)
 
+    def put_many(self, rows):
+        """Put list of rows into the pipe."""
+        for row in rows:
+            self.put(row)
+
     def done_receiving(self):
         self._closed = True
         pass
@@ -98,6 +116,16 @@ class Pipe(SimpleDataPipe):
         self._done_receiving = False
         self._closed = False
 
+        # Progress tracking (used by the stream watchdog). Updated once per
+        # buffer, not per row.
+        self.rows_sent = 0
+        self.last_activity = time.time()
+        self.sender_waiting = False
+        self.receiver_waiting = False
+
+        # Memory account (brewery.memory.MemoryAccount) set by the stream
+        self.memory = None
+
         # Taken from Python Queue implementation:
 
         # mutex must beheld whenever the queue is mutating.  All methods
@@ -128,12 +156,39 @@ class Pipe(SimpleDataPipe):
 
         if self.is_full():
             self._flush()
+
+    def put_many(self, rows):
+        """Put list of rows into the pipe. Buffers are sent as they are
+        filled, as with :meth:`put`. Rows are discarded when the pipe is
+        closed by the receiver."""
+        start = 0
+        count = len(rows)
+        while start < count:
+            if self._closed:
+                # Receiver does not want more rows, staged rows will not be
+                # sent either
+                self.staging_buffer = []
+                return
+            end = start + self.buffer_size - len(self.staging_buffer)
+            self.staging_buffer.extend(rows[start:end])
+            start = end
+            if self.is_full():
+                self._flush()
+
     def _note(self, note):
         # print note
         pass
 
+    def _account_memory(self):
+        if self.memory and self.staging_buffer:
+            # Pipe holds at most two buffers: ready and staging one
+            row_size = estimate_size(self.staging_buffer[0])
+            self.memory.set(2 * row_size * len(self.staging_buffer))
+
     def _flush(self, close=False):
         self._note("P flushing: close? %s closed? %s" % (close, self._closed))
+        self._account_memory()
+
         self._note("P _nf acq?")
         self.not_full.acquire()
         if self._closed:
@@ -151,10 +206,14 @@ class Pipe(SimpleDataPipe):
 
         try:
             self._note("P _not_full wait ...")
+            self.sender_waiting = True
             while not self.is_consumed() and not self._closed:
                 self.not_full.wait()
+            self.sender_waiting = False
             self._note("P _not_full got <")
             if not self._closed:
+                self.rows_sent += len(self.staging_buffer)
+                self.last_activity = time.time()
                 self._ready_buffer = self.staging_buffer
                 self.staging_buffer = []
                 self._closed = close
@@ -169,33 +228,46 @@ class Pipe(SimpleDataPipe):
         """Get data object from pipe. If there is no buffer ready, wait until source object sends
         some data."""
 
-        done_sending = False
-        while not done_sending:
+        for batch in self.batches():
+            for row in batch:
+                yield row
+
+    def batches(self):
+        """Get buffers of data objects (lists of rows) as they are sent by the source object.
+        Waits until there is a buffer ready."""
+
+        while True:
             self._note("C _not_empty acq?")
             self.not_empty.acquire()
             try:
                 self._note("C _not_empty wait ...")
+                self.receiver_waiting = True
                 while not self._ready_buffer and not self._closed:
                     self.not_empty.wait()
+                self.receiver_waiting = False
                 self._note("C _not_empty got <")
 
-                if self._ready_buffer:
-                    rows = self._ready_buffer
+                rows = self._ready_buffer
+                if rows:
                     self._ready_buffer = None
+                    self.last_activity = time.time()
                     self._note("C _not_full notify >")
                     self.not_full.notify()
-
-                    for row in rows:
-                        yield row
                 else:
                     self._note("C no buffer")
 
-
-                done_sending = self._closed
+                closed = self._closed
             finally:
                 self._note("_not_empty rel!")
                 self.not_empty.release()
 
+            # Rows are passed without holding the mutex, so the sender can
+            # prepare next buffer in the meantime
+            if rows:
+                yield rows
+            elif closed:
+                break
+
     def closed(self):
         """Return ``True`` if pipe is closed - not sending or not receiving data any more."""
         return self._closed
@@ -216,6 +288,22 @@ class Pipe(SimpleDataPipe):
 
         self._note("C not_empty rel! r")
 
+    def abort(self):
+        """Close the pipe from both sides and wake up all threads waiting
+        for the pipe. Used when a stream is being stopped."""
+        self.not_empty.acquire()
+        try:
+            self._closed = True
+            self.not_full.notify_all()
+            self.not_empty.notify_all()
+        finally:
+            self.not_empty.release()
+
+    def ready_count(self):
+        """Return number of rows in the buffer waiting to be received."""
+        ready = self._ready_buffer
+        return len(ready) if ready else 0
+
 class Stream(Graph):
     """Data processing stream"""
     def __init__(self, nodes=None, connections=None):
@@ -231,6 +319,19 @@ class Stream(Graph):
         self.logger = get_logger()
 
         self.exceptions = []
+        self.profiler = None
+        self.stall_report = None
+        self._stall_timeout = None
+        self._abort_on_stall = False
+        self._scheduler = "threads"
+        self._workers = None
+        self.pipes = []
+        self.pipe_ends = {}
+        self.memory = None
+        self._memory_accounts = []
+        self._init_workers = 8
+        self._optimize = False
+        self.stats = {"nodes": {}}
 
     def fork(self):
         """Creates a construction fork of the stream. Used for constructing streams in functional
@@ -273,8 +374,6 @@ class Stream(Graph):
         from a dictionary that was created from a JSON file, for example.
         """
 
-        node_dict = node_dictionary()
-
         # FIXME: use either node type identifier or fully initialized node, not
         #        node class (Warning: might break some existing code,
         #        depreciate it first
@@ -293,14 +392,13 @@ class Stream(Graph):
                     raise Exception("Node dictionary has no 'type' key")
                 node_type = obj["type"]
 
-                if node_type in node_dict:
-                    node_class = node_dict[node_type]
-                    node_instance = node_class()
-
-                    node_instance.configure(obj)
-                else:
+                try:
+                    node_instance = create_node(node_type)
+                except KeyError:
                     raise Exception("No node class of type '%s'" % node_type)
 
+                node_instance.configure(obj)
+
             self.add(node_instance, name)
 
         if connections:
@@ -366,7 +464,37 @@ class Stream(Graph):
         self.logger.info("initializing stream")
         self.logger.debug("sorting nodes")
         sorted_nodes = self.sorted_nodes()
+        self._plan(sorted_nodes)
+        self._create_pipes(sorted_nodes)
+
+        # Initialize nodes and fields. Node is initialized when all its source
+        # nodes are initialized and their output fields are known.
+        start = time.time()
+        (times, failures) = _call_nodes(sorted_nodes, self._initialize_node,
+                                        self.node_sources, self._init_workers,
+                                        stop_on_error=True)
+        self.stats["initialize_time"] = time.time() - start
+        for node, elapsed in times.items():
+            self._node_stats(node)["initialize_time"] = elapsed
+
+        if failures:
+            exc_info = failures[0][1]
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    def _plan(self, sorted_nodes):
+        """Push operations of nodes into their sources if optimization is enabled, otherwise
+        remove previous pushdowns."""
+        if self._optimize:
+            for (source, node) in optimize_stream(self):
+                self.logger.info("operation of node %s is pushed down to source %s"
+                                 % (self.node_name(node), self.node_name(source)))
+        else:
+            clear_pushdowns(sorted_nodes)
+
+    def _create_pipes(self, sorted_nodes):
+        """Connect nodes with new pipes and create their memory accounts."""
         self.pipes = []
+        self.pipe_ends = {}
 
         self.logger.debug("flushing pipes")
         for node in sorted_nodes:
@@ -380,29 +508,63 @@ class Stream(Graph):
             targets = self.node_targets(node)
             for target in targets:
                 self.logger.debug("  connecting with %s" % (target))
-                pipe = Pipe()
+                pipe = self._create_pipe()
                 node.add_output(pipe)
                 target.add_input(pipe)
                 self.pipes.append(pipe)
+                self.pipe_ends[pipe] = (node, target)
 
-        # Initialize fields
-        for node in sorted_nodes:
-            self.logger.debug("initializing node of type %s" % node.__class__)
-            self.logger.debug("  node has %d inputs and %d outputs"
-                                % (len(node.inputs), len(node.outputs)))
+        self._create_memory_accounts(sorted_nodes)
+
+    def _initialize_node(self, node):
+        self.logger.debug("initializing node of type %s" % node.__class__)
+        self.logger.debug("  node has %d inputs and %d outputs"
+                            % (len(node.inputs), len(node.outputs)))
+        if node.pushed_down:
+            self.logger.debug("  node is pushed down, ignoring initialization")
+        else:
             node.initialize()
 
-            # Ignore target nodes
-            if isinstance(node, TargetNode):
-                self.logger.debug("  node is target, ignoring creation of output pipes")
-                continue
+        # Ignore target nodes
+        if isinstance(node, TargetNode):
+            self.logger.debug("  node is target, ignoring creation of output pipes")
+            return
 
-            fields = node.output_fields
-            self.logger.debug("  node output fields: %s" % fields.names())
-            for output_pipe in node.outputs:
-                output_pipe.fields = fields
+        fields = node.output_fields
+        self.logger.debug("  node output fields: %s" % fields.names())
+        for output_pipe in node.outputs:
+            output_pipe.fields = fields
 
-    def run(self):
+    def _node_stats(self, node):
+        """Return statistics dictionary of `node`."""
+        return self.stats["nodes"].setdefault(self.node_name(node), {})
+
+    def _create_memory_accounts(self, sorted_nodes):
+        """Create memory accounts for nodes and pipes in the stream memory
+        budget. Accounts of previous run are removed."""
+
+        if not self.memory:
+            self.memory = MemoryBudget()
+
+        for account in self._memory_accounts:
+            self.memory.remove_account(account)
+        self._memory_accounts = []
+
+        for node in sorted_nodes:
+            account = self.memory.account(self.node_name(node),
+                                          spillable=node.spillable)
+            node.memory = account
+            self._memory_accounts.append(account)
+
+        for pipe in self.pipes:
+            (source, target) = self.pipe_ends[pipe]
+            name = "%s -> %s" % (self.node_name(source), self.node_name(target))
+            pipe.memory = self.memory.account(name)
+            self._memory_accounts.append(pipe.memory)
+
+    def run(self, profile=False, stall_timeout=None, abort_on_stall=False,
+            memory_limit=None, scheduler="threads", workers=4, init_workers=8,
+            optimize=False):
         """Run all nodes in the stream.
 
         Each node is being wrapped and run in a separate thread.
@@ -410,7 +572,48 @@ class Stream(Graph):
         When an exception occurs, the stream is stopped and all catched exceptions are stored in
         attribute `exceptions`.
 
+        If `profile` is ``True``, then each node thread is profiled separately and the collected
+        information is available in the `profiler` attribute as a
+        :class:`brewery.profiling.StreamProfiler` object. `profile` might be also name of the
+        profiling method: ``cprofile`` or ``sample`` (low-overhead stack sampling). ``True`` uses
+        both.
+
+        If `stall_timeout` is set, then the stream is watched by a
+        :class:`brewery.watchdog.StreamWatchdog`. When no data move through the stream pipes for
+        `stall_timeout` seconds, a report with node states, pipe buffers, cycles of waiting nodes
+        and thread stacks is logged and stored in `stall_report`. If `abort_on_stall` is ``True``,
+        then the stalled stream is aborted and `StreamStallError` is raised.
+
+        `memory_limit` is approximate memory budget for rows held by nodes and pipes of the
+        stream: number of bytes, a string such as ``512M`` or a shared
+        :class:`brewery.memory.MemoryBudget` object (for running more streams within one budget).
+        When the budget is exceeded, spill-capable nodes move their data to disk. If that is not
+        sufficient, `MemoryBudgetExceeded` is raised naming the offending node. Memory is
+        accounted in the `memory` attribute even without a limit.
+
+        `scheduler` is ``threads`` (default) - each node is run in its own thread, or
+        ``cooperative`` - nodes are run as coroutines on a pool of `workers` threads
+        (see :mod:`brewery.scheduler`, requires the `greenlet` package). Cooperative scheduler is
+        suitable for streams with many nodes, most of them waiting for data. Profiling is not
+        available with the cooperative scheduler.
+
+        Nodes are initialized and finalized by a pool of `init_workers` threads (default is 8),
+        so that slow initializations - such as opening database connections or reading a whole
+        workbook - are not performed one after another. A node is initialized after all its
+        source nodes and finalized after all its target nodes. Use ``init_workers=1`` to
+        initialize and finalize nodes serially. Time spent by each node in initialization, run
+        and finalization is stored in the `stats` attribute: a dictionary with keys
+        ``initialize_time``, ``run_time``, ``finalize_time`` (whole stream, in seconds) and
+        ``nodes`` - dictionary of node names and their times.
+
+        If `optimize` is ``True``, then filters, field projections and aggregations of nodes that
+        follow a SQL, MongoDB or CSV source are performed by the source (see
+        :mod:`brewery.planner`). Pushed down comparisons follow semantics of the database - type
+        coercion, collation and ``NULL`` handling might differ from Python. Default is
+        ``False`` - all nodes are run as they are.
         """
+        self._prepare_run(profile, stall_timeout, abort_on_stall, memory_limit,
+                          scheduler, workers, init_workers, optimize)
         self._initialize()
 
         # FIXME: do better exception handling here: what if both will raise exception?
@@ -419,19 +622,219 @@ class Stream(Graph):
         finally:
             self._finalize()
 
+    def _prepare_run(self, profile, stall_timeout, abort_on_stall, memory_limit,
+                     scheduler, workers, init_workers, optimize=False):
+        """Set up run options, see :meth:`run` for more information."""
+        if scheduler not in ("threads", "cooperative"):
+            raise StreamError("Unknown stream scheduler '%s'" % scheduler)
+        if scheduler == "cooperative" and profile:
+            raise StreamError("Profiling is not available with cooperative scheduler")
+
+        self._scheduler = scheduler
+        self._workers = workers
+        self._init_workers = init_workers
+        self._optimize = optimize
+        self.stats = {"nodes": {}}
+
+        if isinstance(memory_limit, MemoryBudget):
+            self.memory = memory_limit
+        elif memory_limit:
+            self.memory = MemoryBudget(parse_memory_size(memory_limit))
+        elif not self.memory or self.memory.limit:
+            self.memory = MemoryBudget()
+
+        self.stall_report = None
+        self._stall_timeout = stall_timeout
+        self._abort_on_stall = abort_on_stall
+
+        if profile:
+            method = profile if isinstance(profile, basestring) else "all"
+            self.profiler = StreamProfiler(method)
+        else:
+            self.profiler = None
+
+    def explain(self, analyze=False, **options):
+        """Return execution plan of the stream as a :class:`brewery.explain.StreamPlan` object:
+        order of nodes, execution backend of each node, fields passed through each pipe,
+        streaming or blocking nodes, estimated rows and memory and notes such as pushdowns.
+        Print the plan or use its ``to_dict()`` method.
+
+        Nodes, except target nodes, are initialized and finalized to propagate the fields, no
+        data are processed. If `analyze` is ``True``, then the stream is run and the plan is
+        annotated with actual number of rows, times, memory peaks and spills.
+
+        `options` are the same as options of :meth:`run`, `initialize` option might be set to
+        ``False`` to explain the stream without initializing any node.
+        """
+        from .explain import explain_stream
+        return explain_stream(self, analyze=analyze, **options)
+
+    def iter_batches(self, node, batch_size=1000, **options):
+        """Run the stream in background and iterate over output of `node` (node or node
+        name) in batches - lists of at most `batch_size` rows - as they are produced. No target
+        node is needed. Output of `node` to its other targets, if there are any, is not affected.
+
+        The iterator is connected to the node with a pipe, therefore the stream does not run
+        ahead of the consumer by more than two batches. If the iteration is stopped (the
+        generator is closed or garbage collected) before all rows are consumed, the stream is
+        cancelled: all pipes are closed and nodes are stopped.
+
+        `options` are the same as options of :meth:`run`. Exception raised during the run is
+        raised from the iterator after all rows were passed.
+
+        Example::
+
+            for batch in stream.iter_batches("aggregate"):
+                write_rows(batch)
+        """
+
+        node = self.coalesce_node(node)
+        if isinstance(node, TargetNode):
+            raise StreamError("Can not iterate over output of target node '%s'"
+                              % self.node_name(node))
+
+        self._prepare_run(**_run_options(options))
+        self._initialize()
+
+        pipe = self._create_pipe(batch_size)
+        pipe.fields = node.output_fields
+        node.add_output(pipe)
+        self.pipes.append(pipe)
+        self.pipe_ends[pipe] = (node, None)
+        pipe.memory = self.memory.account("%s -> (iterator)" % self.node_name(node))
+        self._memory_accounts.append(pipe.memory)
+
+        runner = _StreamRunnerThread(self)
+        runner.start()
+
+        try:
+            for batch in pipe.batches():
+                yield batch
+        finally:
+            if not pipe.closed():
+                self.logger.info("stream iterator stopped, cancelling stream")
+                runner.cancelled = True
+                self.kill_threads()
+            runner.join()
+
+        if runner.exc_info:
+            raise runner.exc_info[0], runner.exc_info[1], runner.exc_info[2]
+
+    def iter_rows(self, node, batch_size=1000, **options):
+        """Run the stream in background and iterate over rows produced by `node`. See
+        :meth:`iter_batches` for more information."""
+
+        batches = self.iter_batches(node, batch_size, **options)
+        try:
+            for batch in batches:
+                for row in batch:
+                    yield row
+        finally:
+            batches.close()
+
     def _run(self):
         self.logger.info("running stream")
 
-        threads = []
         sorted_nodes = self.sorted_nodes()
+        start = time.time()
+
+        if self.profiler:
+            for node in sorted_nodes:
+                self.profiler.add_node(node, self.node_name(node))
+            self.profiler.start()
+
+        try:
+            self._run_threads(sorted_nodes)
+        finally:
+            self.stats["run_time"] = time.time() - start
+            if self.profiler:
+                self.profiler.stop()
+
+    def _run_threads(self, sorted_nodes):
+        if self._scheduler == "cooperative":
+            (threads, join) = self._start_tasks(sorted_nodes)
+        else:
+            (threads, join) = self._start_threads(sorted_nodes)
+
+        if self._stall_timeout:
+            watchdog = StreamWatchdog(self, threads, self._stall_timeout,
+                                      abort=self._abort_on_stall)
+            watchdog.start()
+        else:
+            watchdog = None
+
+        try:
+            join(threads)
+        finally:
+            for (thread, node) in threads:
+                if thread.run_time is not None:
+                    self._node_stats(node)["run_time"] = thread.run_time
+            if watchdog:
+                watchdog.stop()
+                watchdog.join()
+                self.stall_report = watchdog.report
+
+        if watchdog and watchdog.aborted:
+            self.logger.info("run aborted after stall")
+            raise StreamStallError("stream stalled and was aborted",
+                                   report=watchdog.report,
+                                   cycles=watchdog.cycles)
+
+        if self.exceptions:
+            self.logger.info("run finished with exception")
+            # Raising only first exception found
+            exception = self.exceptions[0]
+            if isinstance(exception.exception, MemoryBudgetExceeded):
+                raise exception.exception
+            raise exception
+        else:
+            self.logger.info("run finished sucessfully")
+
+    def _start_threads(self, sorted_nodes):
+        """Run each node in its own thread. Returns tuple (`threads`, `join`)
+        where `threads` is list of (`thread`, `node`) tuples and `join` is a
+        function that waits for the threads."""
+        threads = []
 
         self.logger.debug("launching threads")
         for node in sorted_nodes:
             self.logger.debug("launching thread for node %s" % node_label(node))
-            thread = _StreamNodeThread(node)
+            thread = _StreamNodeThread(node, self.profiler)
             thread.start()
             threads.append((thread, node))
 
+        return (threads, self._join_threads)
+
+    def _start_tasks(self, sorted_nodes):
+        """Run nodes as tasks of the cooperative scheduler. Returns tuple
+        (`tasks`, `join`), see :meth:`_start_threads`."""
+        from .scheduler import CooperativeScheduler
+
+        tasks = [_StreamNodeTask(node) for node in sorted_nodes]
+        scheduler = CooperativeScheduler(tasks, self._workers)
+
+        self.logger.debug("launching %d nodes on %d workers"
+                          % (len(tasks), len(scheduler.workers)))
+        scheduler.start()
+
+        def join(threads):
+            scheduler.join()
+            self.exceptions = []
+            for task in tasks:
+                if task.exception:
+                    self._add_thread_exception(task)
+
+        return ([(task, task.node) for task in tasks], join)
+
+    def _create_pipe(self, buffer_size=1000):
+        """Create a pipe suitable for the scheduler used to run the stream."""
+        if self._scheduler == "cooperative":
+            from .scheduler import CooperativePipe
+            return CooperativePipe(buffer_size)
+        else:
+            return Pipe(buffer_size)
+
+    def _join_threads(self, threads):
         self.exceptions = []
         for (thread, node) in threads:
             self.logger.debug("joining thread for %s" % node_label(node))
@@ -450,13 +853,6 @@ class Stream(Graph):
                     self.logger.info("node exception occured, trying to kill threads")
                     self.kill_threads()
 
-        if self.exceptions:
-            self.logger.info("run finished with exception")
-            # Raising only first exception found
-            raise self.exceptions[0]
-        else:
-            self.logger.info("run finished sucessfully")
-
     def _add_thread_exception(self, thread):
         """Create a StreamRuntimeError exception object and fill attributes with all necessary
         values.
@@ -494,34 +890,200 @@ class Stream(Graph):
 
 
     def kill_threads(self):
+        """Stop running nodes: close all pipes and wake up all nodes waiting
+        for them. Nodes waiting for input will see end of data, nodes sending
+        data will get `NodeFinished`."""
         self.logger.info("killing threads")
+        for pipe in self.pipes:
+            pipe.abort()
 
     def _finalize(self):
+        """Finalize all nodes in reverse dependency order: a node is finalized
+        after all its target nodes, independent nodes concurrently. All nodes
+        are finalized even if some of them fail, the first exception is raised
+        afterwards."""
         self.logger.info("finalizing nodes")
 
-        # FIXME: encapsulate finalization in exception handler, collect exceptions
-        for node in self.sorted_nodes():
-            self.logger.debug("finalizing node %s" % node_label(node))
-            node.finalize()
+        start = time.time()
+        nodes = list(reversed(self.sorted_nodes()))
+        (times, failures) = _call_nodes(nodes, self._finalize_node,
+                                        self.node_targets, self._init_workers,
+                                        call_after_failure=True)
+        self.stats["finalize_time"] = time.time() - start
+        for node, elapsed in times.items():
+            self._node_stats(node)["finalize_time"] = elapsed
+
+        # Release the memory of the stream in the budget, peaks are kept
+        for account in self._memory_accounts:
+            account.clear()
+
+        if failures:
+            exc_info = failures[0][1]
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    def _finalize_node(self, node):
+        self.logger.debug("finalizing node %s" % node_label(node))
+        node.finalize()
 
 def node_label(node):
     """Debug label for a node: node identifier with python object id."""
     return "%s(%s)" % (node.identifier() or str(type(node)), id(node))
 
-class _StreamNodeThread(threading.Thread):
-    def __init__(self, node):
-        """Creates a stream node thread.
+def _call_nodes(nodes, function, dependencies=None, workers=8, stop_on_error=False,
+                call_after_failure=False):
+    """Call `function(node)` for each node of `nodes` using a pool of at most `workers` threads.
+    If `dependencies` is specified, it is a function returning nodes that have to be finished
+    before `node` is called. Nodes are called in the order of the list, as they become ready.
+
+    Returns tuple (`times`, `failures`) where `times` is a dictionary of nodes and their call
+    durations and `failures` is a list of (`node`, `exc_info`) tuples. Nodes depending on a
+    failed node are not called, unless `call_after_failure` is ``True``. If `stop_on_error` is
+    ``True``, then no other node is called after a failure.
+    """
+
+    times = {}
+    failures = []
+
+    def call(node):
+        """Call the function, returns ``True`` on success."""
+        start = time.time()
+        try:
+            function(node)
+        except Exception:
+            failures.append((node, sys.exc_info()))
+            return False
+        finally:
+            times[node] = time.time() - start
+        return True
+
+    if workers <= 1 or len(nodes) <= 1:
+        failed = set()
+        for node in nodes:
+            if dependencies and not call_after_failure \
+                    and any(dep in failed for dep in dependencies(node)):
+                failed.add(node)
+                continue
+            if not call(node):
+                if stop_on_error:
+                    break
+                failed.add(node)
+        return (times, failures)
+
+    # Number of unfinished dependencies of each node and nodes waiting for it
+    waiting = {}
+    dependents = collections.defaultdict(list)
+    node_set = set(nodes)
+    for node in nodes:
+        deps = [dep for dep in dependencies(node) if dep in node_set] if dependencies else []
+        waiting[node] = len(deps)
+        for dep in deps:
+            dependents[dep].append(node)
+
+    order = dict((node, i) for i, node in enumerate(nodes))
+    ready = [node for node in nodes if not waiting[node]]
+    tasks = Queue.Queue()
+    finished = Queue.Queue()
+
+    def work():
+        while True:
+            node = tasks.get()
+            if node is None:
+                break
+            finished.put((node, call(node)))
+
+    threads = []
+    for i in range(min(workers, len(nodes))):
+        thread = threading.Thread(target=work, name="brewery-init-%d" % i)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    running = 0
+    try:
+        while True:
+            if not (stop_on_error and failures):
+                ready.sort(key=order.get)
+                for node in ready:
+                    tasks.put(node)
+                running += len(ready)
+                ready = []
+
+            if not running:
+                break
+
+            (node, success) = finished.get()
+            running -= 1
+
+            if not success and not call_after_failure:
+                # Dependent nodes are not called
+                continue
+
+            for dependent in dependents[node]:
+                waiting[dependent] -= 1
+                if not waiting[dependent]:
+                    ready.append(dependent)
+    finally:
+        for thread in threads:
+            tasks.put(None)
+        for thread in threads:
+            thread.join()
+
+    return (times, failures)
+
+def _run_options(options):
+    """Return complete `run()` options for `Stream._prepare_run()` from `options`
+    dictionary."""
+    result = {"profile": False, "stall_timeout": None, "abort_on_stall": False,
+              "memory_limit": None, "scheduler": "threads", "workers": 4,
+              "init_workers": 8, "optimize": False}
+    for key, value in options.items():
+        if key not in result:
+            raise TypeError("Unknown stream run option '%s'" % key)
+        result[key] = value
+    return result
+
+class _StreamRunnerThread(threading.Thread):
+    def __init__(self, stream):
+        """Creates a thread that runs whole initialized `stream` in background.
+
+        :Attributes:
+            * `exc_info`: exception information if the run failed
+            * `cancelled`: set to ``True`` when the consumer cancelled the run. Exceptions
+              are ignored then.
+        """
+        super(_StreamRunnerThread, self).__init__(name="brewery-stream-runner")
+        self.daemon = True
+        self.stream = stream
+        self.exc_info = None
+        self.cancelled = False
+
+    def run(self):
+        try:
+            try:
+                self.stream._run()
+            finally:
+                self.stream._finalize()
+        except Exception:
+            if not self.cancelled:
+                self.exc_info = sys.exc_info()
+
+class _NodeRunner(object):
+    def __init__(self, node, profiler=None):
+        """Creates a runner of a stream node.
 
         :Attributes:
             * `node`: a Node object
+            * `profiler`: optional StreamProfiler the node is run with
             * `exception`: attribute will contain exception if one occurs during run()
             * `traceback`: will contain traceback if exception occurs
 
         """
-        super(_StreamNodeThread, self).__init__()
+        super(_NodeRunner, self).__init__()
         self.node = node
+        self.profiler = profiler
         self.exception = None
         self.traceback = None
+        self.run_time = None
         self.logger = get_logger()
 
     def run(self):
@@ -529,8 +1091,14 @@ class _StreamNodeThread(threading.Thread):
 
         label = node_label(self.node)
         self.logger.debug("%s: start" % label)
+        start = time.time()
         try:
-            self.node.run()
+            if self.node.pushed_down:
+                self._pass_rows()
+            elif self.profiler:
+                self.profiler.run_node(self.node)
+            else:
+                self.node.run()
         except NodeFinished:
             self.logger.info("node %s finished" % label)
         except Exception as e:
@@ -550,8 +1118,31 @@ class _StreamNodeThread(threading.Thread):
         self.logger.debug("%s: stopping inputs" % label)
         for pipe in self.node.inputs:
             if not pipe.closed():
-                pipe.done_sending()
+                pipe.done_receiving()
         self.logger.debug("%s: stopped" % self)
+        self.run_time = time.time() - start
+
+    def _pass_rows(self):
+        """Pass input rows of a pushed down node unchanged."""
+        for row in self.node.input.rows():
+            self.node.put(row)
+
+class _StreamNodeThread(_NodeRunner, threading.Thread):
+    """Node run in its own thread."""
+    pass
+
+class _StreamNodeTask(_NodeRunner):
+    """Node run as a coroutine by the cooperative scheduler."""
+
+    greenlet = None
+    waiter = None
+
+    def is_alive(self):
+        return self.greenlet is None or not self.greenlet.dead
+
+    def frame(self):
+        """Return current frame of the suspended node or ``None``."""
+        return self.greenlet.gr_frame if self.greenlet else None
 
 class _StreamFork(object):
     """docstring for StreamFork"""
@@ -574,7 +1165,7 @@ class _StreamFork(object):
 
     def set_name(self, name):
         """Sets name of current node."""
-        self.stream.set_node_name(self.node, name)
+        self.stream.rename_node(self.node, name)
 
     def fork(self):
         """Forks current fork. Returns a new fork with same actual node as the fork being
@@ -13,6 +13,11 @@ from test_node_stream import *
 from test_data_quality import *
 from test_sql_streams import *
 from test_forks import *
+from test_memory import *
+from test_scheduler import *
+from test_async_streams import *
+from test_planner import *
+from test_compression import *
 
 test_cases = [FieldListCase,
               DataSourceUtilsTestCase,
@@ -25,7 +30,13 @@ test_cases = [FieldListCase,
               DataQualityTestCase,
               StreamConfigurationTestCase,
               SQLStreamsTestCase,
-              ForksTestCase
+              ForksTestCase,
+              MemoryBudgetTestCase,
+              StreamMemoryTestCase,
+              CooperativeSchedulerTestCase,
+              AsyncStreamsTestCase,
+              PlannerTestCase,
+              CompressionTestCase
                 ]
 
 def load_tests(loader, tests, pattern):
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import brewery
+import brewery.ds as ds
+import unittest
+import threading
+import time
+import os
+
+from brewery.streams import *
+from brewery.nodes import *
+from brewery.ds.async_streams import *
+
+TESTS_PATH = os.path.dirname(os.path.abspath(__file__))
+
+class PagedSource(AsyncDataSource):
+    """Source with slow requests, each returns one page of rows."""
+    def __init__(self, pages, page_size=10, delay=0.1, **kwargs):
+        super(PagedSource, self).__init__(**kwargs)
+        self.pages = pages
+        self.page_size = page_size
+        self.delay = delay
+        self.fields = brewery.FieldList(["i"])
+
+    def fetch(self, page):
+        time.sleep(self.delay)
+        if page == "fail":
+            raise Exception("Page is not available")
+        start = page * self.page_size
+        return [[i] for i in range(start, start + self.page_size)]
+
+    def requests(self):
+        for page in self.pages:
+            yield lambda page=page: self.fetch(page)
+
+class SlowTarget(AsyncDataTarget):
+    def __init__(self, delay=0.1, fail=False, **kwargs):
+        super(SlowTarget, self).__init__(**kwargs)
+        self.delay = delay
+        self.fail = fail
+        self.rows = []
+        self.lock = threading.Lock()
+
+    def write_batch(self, rows):
+        time.sleep(self.delay)
+        if self.fail:
+            raise Exception("Write failed")
+        with self.lock:
+            self.rows += rows
+
+class ListTarget(ds.DataTarget):
+    def __init__(self):
+        super(ListTarget, self).__init__()
+        self.rows = []
+        self.finalized = False
+
+    def append(self, obj):
+        self.rows.append(obj)
+
+    def finalize(self):
+        self.finalized = True
+
+class AsyncStreamsTestCase(unittest.TestCase):
+    def test_source(self):
+        source = PagedSource(range(0, 10), max_in_flight=5)
+        start = time.time()
+        rows = list(source.rows())
+        elapsed = time.time() - start
+
+        self.assertEqual([[i] for i in range(0, 100)], rows)
+        # 10 requests of 0.1 s, 5 at once
+        self.assertTrue(elapsed < 0.6)
+
+        records = list(PagedSource([1]).records())
+        self.assertEqual({"i": 10}, records[0])
+
+    def test_source_fail(self):
+        source = PagedSource([0, "fail", 2])
+        self.assertRaisesRegexp(Exception, "not available", list,
+                                source.rows())
+
+    def test_target(self):
+        target = SlowTarget(batch_size=10, max_in_flight=5)
+        target.fields = brewery.FieldList(["i"])
+        start = time.time()
+        for i in range(0, 95):
+            target.append([i])
+        target.append({"i": 95})
+        target.finalize()
+        elapsed = time.time() - start
+
+        self.assertEqual(range(0, 96), sorted(row[0] for row in target.rows))
+        self.assertTrue(elapsed < 0.6)
+
+    def test_target_fail(self):
+        target = SlowTarget(batch_size=10, fail=True)
+        future = target.append_many([[1]])
+        self.assertRaisesRegexp(Exception, "Write failed", future.result)
+        self.assertRaisesRegexp(Exception, "Write failed", target.flush)
+
+    def test_executor(self):
+        executor = IOExecutor(threads=2)
+        futures = [executor.submit(time.sleep, 0.1) for i in range(0, 4)]
+        for future in futures:
+            future.result()
+        self.assertEqual(2, len(executor.threads))
+        self.assertTrue(default_executor() is default_executor())
+
+    def test_adapters(self):
+        source = ds.CSVDataSource(os.path.join(TESTS_PATH, "data", "test.csv"),
+                                  read_header=True)
+        target = ListTarget()
+        nodes = {
+            "source": StreamSourceNode(AsyncSourceAdapter(source, batch_size=3)),
+            "target": StreamTargetNode(AsyncTargetAdapter(target, batch_size=3))
+        }
+        stream = Stream(nodes, [("source", "target")])
+        stream.run()
+
+        self.assertEqual(8, len(target.rows))
+        self.assertEqual(u"apple", target.rows[0][1])
+        self.assertTrue(target.finalized)
+
+    def test_cooperative(self):
+        # Four sources wait for their requests in one worker thread
+        nodes = {"merge": AppendNode(), "target": RowListTargetNode()}
+        connections = [("merge", "target")]
+        for i in range(0, 4):
+            name = "source%d" % i
+            nodes[name] = StreamSourceNode(PagedSource(range(0, 5),
+                                                       max_in_flight=5))
+            connections.append((name, "merge"))
+        stream = Stream(nodes, connections)
+
+        start = time.time()
+        stream.run(scheduler="cooperative", workers=1)
+        elapsed = time.time() - start
+
+        self.assertEqual(200, len(stream.node("target").rows))
+        self.assertTrue(elapsed < 1.0)
+
+if __name__ == '__main__':
+    unittest.main()
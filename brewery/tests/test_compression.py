@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import brewery
+import brewery.ds as ds
+import unittest
+import tempfile
+import shutil
+import gzip
+import bz2
+import os
+import StringIO
+
+from brewery.streams import *
+from brewery.nodes import *
+from brewery.ds.base import open_resource
+from brewery.ds.compression import *
+
+class CompressionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.data = "".join("%d,line %d\n" % (i, i) for i in range(0, 10000))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def test_method(self):
+        self.assertEqual("gzip", compression_method("data.csv.gz"))
+        self.assertEqual("bz2", compression_method("http://localhost/data.csv.bz2"))
+        self.assertEqual("zstd", compression_method("data.csv.zst"))
+        self.assertEqual(None, compression_method("data.csv"))
+        self.assertEqual(None, compression_method("data.csv.gz", "none"))
+        self.assertEqual("xz", compression_method(StringIO.StringIO(), "xz"))
+        self.assertRaises(ValueError, compression_method, "data.csv", "zip")
+
+    def test_read(self):
+        with gzip.open(self.path("data.gz"), "wb") as handle:
+            handle.write(self.data)
+        with open(self.path("data.bz2"), "wb") as handle:
+            handle.write(bz2.compress(self.data))
+
+        for name in ["data.gz", "data.bz2"]:
+            (handle, close) = open_resource(self.path(name), read_size=1000)
+            self.assertTrue(close)
+            self.assertEqual(self.data.splitlines(True), list(handle))
+            handle.close()
+
+            (handle, close) = open_resource(self.path(name), read_size=1000)
+            self.assertEqual("0,line 0\n", handle.readline())
+            self.assertEqual("1,line", handle.read(6))
+            self.assertEqual(self.data[15:], handle.read())
+            handle.close()
+
+        # File-like object with explicit compression, two members
+        raw = open(self.path("data.gz"), "rb").read()
+        (handle, close) = open_resource(StringIO.StringIO(raw * 2), compression="gzip")
+        self.assertEqual(self.data * 2, handle.read())
+
+    def test_write(self):
+        for threads in [1, 4]:
+            for method, extension in [("gzip", ".gz"), ("bz2", ".bz2")]:
+                path = self.path("data" + extension)
+                (handle, close) = open_resource(path, "w", compress_threads=threads)
+                for i in range(0, len(self.data), 5000):
+                    handle.write(self.data[i:i + 5000])
+                handle.close()
+
+                (handle, close) = open_resource(path)
+                self.assertEqual(self.data, handle.read())
+
+        # Blocks compressed in threads are gzip members
+        writer = CompressingWriter(open(self.path("blocks.gz"), "wb"), "gzip",
+                                   threads=3, block_size=10000)
+        writer.write(self.data)
+        writer.close()
+        with gzip.open(self.path("blocks.gz")) as handle:
+            self.assertEqual(self.data, handle.read())
+
+    def test_optional_methods(self):
+        modules = {"xz": brewery.ds.compression.backports,
+                   "zstd": brewery.ds.compression.zstandard}
+        for method, module in modules.items():
+            if not module.is_available():
+                continue
+            output = StringIO.StringIO()
+            writer = CompressingWriter(output, method, close_raw=False)
+            writer.write(self.data)
+            writer.close()
+            reader = DecompressingReader(StringIO.StringIO(output.getvalue()), method)
+            self.assertEqual(self.data, reader.read())
+
+    def test_csv(self):
+        path = self.path("data.csv.gz")
+        fields = brewery.FieldList([["id", "integer"], "name"])
+        nodes = {
+            "source": RowListSourceNode([[i, u"á%d" % i] for i in range(0, 1000)],
+                                        fields=fields),
+            "target": brewery.nodes.CSVTargetNode(path, compress_threads=2)
+        }
+        stream = Stream(nodes, [("source", "target")])
+        stream.run()
+
+        with gzip.open(path) as handle:
+            self.assertEqual("id,name\r\n", handle.readline())
+
+        source = ds.CSVDataSource(path, fields=fields, processes=2)
+        source.initialize()
+        rows = list(source.rows())
+        source.finalize()
+        self.assertEqual(1000, len(rows))
+        self.assertEqual([999, u"á999"], rows[-1])
+        self.assertEqual(None, ds.base.estimate_line_count(path))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,6 +3,12 @@
 
 import unittest
 import os
+import sys
+import subprocess
+import datetime
+import StringIO
+import tempfile
+import shutil
 import brewery.ds
 import brewery
 
@@ -24,6 +30,74 @@ class DataSourceUtilsTestCase(unittest.TestCase):
         self.assertEqual(ex_record, brewery.expand_record(record))
         self.assertEqual(record, brewery.collapse_record(ex_record))
 
+    def test_lazy_module(self):
+        module = brewery.utils.LazyModule("colorsys")
+        self.assertTrue(module.is_available())
+        self.assertEqual((0.0, 0.0, 1.0), module.rgb_to_hsv(1.0, 1.0, 1.0))
+
+        module = brewery.utils.LazyModule("no_such_package.module", "testing")
+        self.assertFalse(module.is_available())
+        self.assertRaisesRegexp(Exception, "'no_such_package' is not installed",
+                                getattr, module, "function")
+
+    def test_lazy_backends(self):
+        code = "import sys; import brewery.ds; " \
+               "print [m for m in ('sqlalchemy', 'xlrd', 'yaml') if m in sys.modules]"
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.path.dirname(os.path.dirname(TESTS_PATH))
+        output = subprocess.check_output([sys.executable, "-c", code], env=env)
+        self.assertEqual("[]", output.strip())
+
+    def test_estimate_line_count(self):
+        path = os.path.join(TESTS_PATH, "data", "test.csv")
+        self.assertEqual(9, brewery.ds.base.estimate_line_count(path))
+        estimate = brewery.ds.base.estimate_line_count(path, sample_size=100)
+        self.assertTrue(5 < estimate < 15)
+        self.assertEqual(None, brewery.ds.base.estimate_line_count("http://localhost/x.csv"))
+
+        node = brewery.nodes.CSVSourceNode(path)
+        self.assertEqual(8, node.estimated_rows([]))
+
+    def test_mapped_file(self):
+        path = os.path.join(TESTS_PATH, "data", "test.csv")
+        with open(path, "rb") as handle:
+            data = handle.read()
+
+        with brewery.ds.base.MappedFile(path) as handle:
+            self.assertEqual(data.splitlines(True), list(handle))
+            handle.seek(0)
+            self.assertEqual(data, handle.read())
+
+        with brewery.ds.base.MappedFile(path, 48, 100) as handle:
+            self.assertEqual(data[48:100].splitlines(True), list(handle))
+            handle.seek(2)
+            self.assertEqual(data[50:60], handle.read(10))
+            self.assertEqual(12, handle.tell())
+            self.assertEqual(data[60:100].splitlines(True)[0], handle.readline())
+
+        (handle, close) = brewery.ds.base.open_resource(path, mapped=True)
+        self.assertTrue(isinstance(handle, brewery.ds.base.MappedFile))
+        handle.close()
+
+        # Lines longer than the scanned block and lines across blocks
+        block_size = brewery.ds.base.mapped_block_size
+        brewery.ds.base.mapped_block_size = 7
+        try:
+            for start, end in [(0, None), (3, 101), (48, 100)]:
+                with brewery.ds.base.MappedFile(path, start, end) as handle:
+                    self.assertEqual(data[start:end].splitlines(True), list(handle))
+        finally:
+            brewery.ds.base.mapped_block_size = block_size
+
+        empty = os.path.join(TESTS_PATH, "data", "empty_mapped.csv")
+        open(empty, "wb").close()
+        try:
+            with brewery.ds.base.MappedFile(empty) as handle:
+                self.assertEqual("", handle.read())
+                self.assertEqual([], list(handle))
+        finally:
+            os.remove(empty)
+
 # class DataStoreTestCase(unittest.TestCase):
 #     def setUp(self):
 #         pass
@@ -45,12 +119,10 @@ class DataSourceTestCase(unittest.TestCase):
     output_dir = None
     @classmethod
     def setUpClass(cls):
-        DataSourceTestCase.output_dir = 'test_out'
-        if not os.path.exists(DataSourceTestCase.output_dir):
-            os.makedirs(DataSourceTestCase.output_dir)
+        DataSourceTestCase.output_dir = tempfile.mkdtemp()
     @classmethod
     def tearDownClass(cls):
-        pass
+        shutil.rmtree(DataSourceTestCase.output_dir)
         
     def setUp(self):
         self.data_dir = os.path.join(TESTS_PATH, 'data')
@@ -115,6 +187,161 @@ class DataSourceTestCase(unittest.TestCase):
         self.assertEqual(True, isinstance(self.rows[0][1], basestring))
         self.assertEqual(True, isinstance(self.rows[0][5], int))
     
+    def test_csv_typed_values(self):
+        data = "i,f,b,d,s\n" \
+               "1,1.5,yes,2012-01-31,a\n" \
+               ",,,,\n" \
+               "3,2,False,2012-02-01 10:20:30,c\n"
+        fields = [["i", "integer"], ["f", "float"], ["b", "boolean"],
+                  ["d", "date"], "s"]
+        expected = [
+            [1, 1.5, True, datetime.date(2012, 1, 31), u"a"],
+            [None, None, None, None, None],
+            [3, 2.0, False, datetime.datetime(2012, 2, 1, 10, 20, 30), u"c"]
+        ]
+
+        src = brewery.ds.CSVDataSource(StringIO.StringIO(data),
+                                       fields=brewery.FieldList(fields))
+        src.initialize()
+        self.assertEqual(expected, list(src.rows()))
+
+        src = brewery.ds.CSVDataSource(StringIO.StringIO(data),
+                                       fields=brewery.FieldList(fields))
+        src.initialize()
+        batches = list(src.batches(2))
+        self.assertEqual([2, 1], [len(batch) for batch in batches])
+        self.assertEqual(expected, batches[0] + batches[1])
+
+        # Row by row conversion
+        src = brewery.ds.CSVDataSource(StringIO.StringIO(data),
+                                       fields=brewery.FieldList(fields))
+        src.initialize()
+        self.assertEqual(expected, list(src.reader))
+
+    def test_csv_keep_fields(self):
+        data = "a,b,c,d\n1,x,2.5,y\n3,z\n"
+        fields = [["a", "integer"], "b", ["c", "float"], "d"]
+        src = brewery.ds.CSVDataSource(StringIO.StringIO(data),
+                                       fields=brewery.FieldList(fields),
+                                       keep_fields=["c", "a"])
+        src.initialize()
+        self.assertEqual(["a", "c"], src.fields.names())
+        self.assertEqual([[1, 2.5], [3, None]], list(src.rows()))
+
+        src = brewery.ds.CSVDataSource(StringIO.StringIO(data))
+        src.push_fields(drop_fields=["b"])
+        src.initialize()
+        self.assertEqual(["a", "c", "d"], src.fields.names())
+        self.assertEqual([[u"1", u"2.5", u"y"], [u"3", None, None]],
+                         list(src.rows()))
+
+    def test_csv_date_formats(self):
+        data = "d\n31.1.2012\n1.2.2012\n"
+        src = brewery.ds.CSVDataSource(StringIO.StringIO(data),
+                                       fields=brewery.FieldList([["d", "date"]]),
+                                       date_formats=[("%d.%m.%Y", False)])
+        src.initialize()
+        self.assertEqual([[datetime.date(2012, 1, 31)], [datetime.date(2012, 2, 1)]],
+                         list(src.rows()))
+
+        src = brewery.ds.CSVDataSource(StringIO.StringIO("d\n31/1/2012\n"),
+                                       fields=brewery.FieldList([["d", "date"]]))
+        src.initialize()
+        self.assertRaises(ValueError, list, src.rows())
+
+    def test_csv_encoding(self):
+        data = u"name,city\nJ\u00e1n,Ko\u0161ice\n".encode("cp1250")
+        src = brewery.ds.CSVDataSource(StringIO.StringIO(data), encoding="cp1250")
+        src.initialize()
+        self.assertEqual([[u"J\u00e1n", u"Ko\u0161ice"]], list(src.rows()))
+
+    def test_csv_parallel(self):
+        path = self.output_file("parallel.csv")
+        with open(path, "wb") as handle:
+            handle.write('id,"multi\nline ""name""",amount\r\n')
+            for i in range(0, 200):
+                if i % 7 == 0:
+                    name = '"row\n""%d""\n,"' % i
+                else:
+                    name = "row %d" % i
+                handle.write('%d,%s,%d.5\r\n' % (i, name, i))
+
+        fields = brewery.FieldList([["id", "integer"], "name", ["amount", "float"]])
+
+        src = brewery.ds.CSVDataSource(path, fields=fields)
+        src.initialize()
+        expected = list(src.rows())
+        src.finalize()
+        self.assertEqual(200, len(expected))
+        self.assertEqual(u'row\n"7"\n,', expected[7][1])
+
+        src = brewery.ds.CSVDataSource(path, fields=fields, processes=3,
+                                       range_size=50)
+        src.initialize()
+        ranges = src.ranges()
+        self.assertTrue(len(ranges) > 10)
+        self.assertEqual(expected, list(src.rows()))
+        # Batches do not depend on the ranges
+        batches = list(src.batches(7))
+        self.assertEqual([7] * 28 + [4], [len(batch) for batch in batches])
+        self.assertEqual(expected, sum(batches, []))
+        src.finalize()
+
+        src = brewery.ds.CSVDataSource(path, fields=fields, mapped=True)
+        src.initialize()
+        self.assertEqual(expected, list(src.rows()))
+        src.finalize()
+
+        src = brewery.ds.CSVDataSource(path, fields=fields, processes=3,
+                                       range_size=100, ordered=False)
+        src.initialize()
+        self.assertEqual(expected, sorted(src.rows()))
+        src.finalize()
+
+        src = brewery.ds.CSVDataSource(path, fields=fields, processes=2,
+                                       range_size=80, keep_fields=["amount"])
+        src.initialize()
+        self.assertEqual([[row[2]] for row in expected], list(src.rows()))
+        src.finalize()
+
+    def test_csv_target(self):
+        fields = brewery.FieldList(["name", "amount", "day", "flag"])
+        rows = [[u"J\u00e1n", 1.5, datetime.date(2012, 1, 31), True],
+                ["a,b", 10, None, False]]
+        expected = u'name,amount,day,flag\r\n' \
+                   u'J\u00e1n,1.5,2012-01-31,True\r\n' \
+                   u'"a,b",10,,False\r\n'
+
+        for encoding in ["utf-8", "cp1250"]:
+            output = StringIO.StringIO()
+            target = brewery.ds.CSVDataTarget(output, fields=fields,
+                                              encoding=encoding, buffer_size=60)
+            target.initialize()
+            target.append(rows[0])
+            # Buffered rows are written when the buffer is full
+            self.assertEqual("", output.getvalue())
+            target.append_many(rows[1:] * 2)
+            self.assertEqual(expected, output.getvalue().decode(encoding)[:len(expected)])
+            target.finalize()
+            self.assertEqual(expected + u'"a,b",10,,False\r\n',
+                             output.getvalue().decode(encoding))
+
+        # Values not representable in the encoding are not written
+        target = brewery.ds.CSVDataTarget(StringIO.StringIO(), fields=fields,
+                                          encoding="ascii")
+        target.initialize()
+        target.append(rows[0])
+        self.assertRaises(UnicodeEncodeError, target.finalize)
+
+    def test_to_bool(self):
+        to_bool = brewery.ds.csv_streams.to_bool
+        for value in ["true", "Yes", " ON ", "1", "t"]:
+            self.assertEqual(True, to_bool(value))
+        for value in ["false", "no", "0", ""]:
+            self.assertEqual(False, to_bool(value))
+        self.assertEqual(True, to_bool(1))
+        self.assertEqual(False, to_bool(None))
+
     def test_xls_source(self):
         src = brewery.ds.XLSDataSource(self.data_file('test.xls'))
         src.initialize()
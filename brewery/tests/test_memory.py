@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import brewery
+import unittest
+import StringIO
+
+from brewery.streams import *
+from brewery.nodes import *
+from brewery.memory import *
+
+class MemoryBudgetTestCase(unittest.TestCase):
+    def test_parse_size(self):
+        self.assertEqual(1000, parse_memory_size("1000"))
+        self.assertEqual(512 * 1024 ** 2, parse_memory_size("512M"))
+        self.assertEqual(2 * 1024, parse_memory_size("2kb"))
+        self.assertRaises(ValueError, parse_memory_size, "lots")
+
+    def test_spill_request(self):
+        budget = MemoryBudget(1000)
+        fixed = budget.account("fixed")
+        spillable = budget.account("spillable", spillable=True)
+
+        self.assertFalse(spillable.set(800))
+        self.assertFalse(fixed.set(100))
+        self.assertFalse(fixed.set(300))
+        self.assertTrue(spillable.spill_requested)
+
+        spillable.spilled(800)
+        self.assertFalse(spillable.spill_requested)
+        self.assertEqual(300, budget.used)
+        self.assertEqual(1100, budget.peak)
+
+    def test_exceeded(self):
+        budget = MemoryBudget(1000)
+        account = budget.account("greedy")
+        try:
+            account.set(2000)
+        except MemoryBudgetExceeded as e:
+            self.assertEqual("greedy", e.owner)
+            self.assertTrue("greedy" in str(e))
+        else:
+            self.fail("MemoryBudgetExceeded not raised")
+
+    def test_spillable_dict(self):
+        budget = MemoryBudget(1024 * 1024)
+        d = SpillableDict(budget.account("dict", spillable=True))
+
+        for i in range(0, 20000):
+            d[(i, "key")] = [i, "value %d" % i]
+
+        self.assertTrue(d.spilled())
+        self.assertTrue(budget.peak < 2 * 1024 * 1024)
+        self.assertEqual(20000, len(d))
+        self.assertEqual([10, "value 10"], d[(10, "key")])
+        self.assertTrue((19999, "key") in d)
+        self.assertFalse((20000, "key") in d)
+        self.assertEqual(None, d.get((20000, "key")))
+
+        d[(10, "key")] = "changed"
+        self.assertEqual("changed", d[(10, "key")])
+        self.assertEqual(20000, len(d.items()))
+
+        d.close()
+        self.assertEqual(0, budget.used)
+
+    def test_spillable_dict_equal_keys(self):
+        # Equal keys that are pickled differently
+        budget = MemoryBudget(64 * 1024)
+        d = SpillableDict(budget.account("dict", spillable=True))
+        d[("ab", "ab")] = "strings"
+        d[(1.0,)] = "float"
+        for i in range(0, 5000):
+            d[(i, "key")] = i
+        self.assertTrue(d.spilled())
+
+        b = "".join(["a", "b"])
+        self.assertTrue(("ab", b) in d)
+        self.assertEqual("strings", d[("ab", b)])
+        self.assertEqual("float", d[(1,)])
+
+        d[(1,)] = "integer"
+        d[("ab", b)] = "changed"
+        d.spill()
+        self.assertEqual(5002, len(d))
+        self.assertEqual("integer", d[(1.0,)])
+        self.assertEqual("changed", d[("ab", "ab")])
+        self.assertEqual(1, sum(1 for key in d.keys() if key == (1,)))
+        d.close()
+
+    def test_spillable_dict_ordered(self):
+        budget = MemoryBudget(256 * 1024)
+        d = SpillableDict(budget.account("dict", spillable=True), ordered=True)
+        keys = [(i * 7919 % 10000, "key") for i in range(0, 10000)]
+        for i, key in enumerate(keys):
+            d[key] = key[0]
+            # Values of spilled keys are assigned back
+            d[keys[0]] = d[keys[0]] + 1
+            self.assertEqual(i + 1, len(d))
+
+        self.assertTrue(d.spilled())
+        self.assertTrue(budget.peak < 512 * 1024)
+        self.assertEqual(10000, len(d))
+        self.assertEqual(keys, d.keys())
+        self.assertEqual(keys, [key for key, value in d.iteritems()])
+        self.assertEqual(10000, d[keys[0]])
+        self.assertEqual(keys[1][0], d[keys[1]])
+
+        d.close()
+        self.assertEqual(0, budget.used)
+
+    def test_spillable_list(self):
+        budget = MemoryBudget(256 * 1024)
+        l = SpillableList(budget.account("list", spillable=True))
+
+        for i in range(0, 10000):
+            l.append([i, "value %d" % i])
+
+        self.assertTrue(l.spilled())
+        self.assertEqual(10000, len(l))
+        self.assertEqual(range(0, 10000), [item[0] for item in l])
+
+        l.close()
+        self.assertEqual(0, budget.used)
+
+class StreamMemoryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.rows = [[i % 1000, i, "text %d" % i] for i in range(0, 20000)]
+        self.fields = brewery.FieldList(["key", "amount", "text"])
+
+    def create_stream(self, node):
+        self.target = RowListTargetNode()
+        nodes = {
+            "source": RowListSourceNode(self.rows, self.fields),
+            "process": node,
+            "target": self.target
+        }
+        connections = [("source", "process"), ("process", "target")]
+        return Stream(nodes, connections)
+
+    def test_accounting(self):
+        stream = self.create_stream(DistinctNode(["key"]))
+        stream.run()
+
+        self.assertEqual(1000, len(self.target.rows))
+        names = [name for name, size in stream.memory.usage()]
+        self.assertTrue("process" in names)
+        self.assertTrue("source -> process" in names)
+        self.assertEqual(0, stream.memory.used)
+        self.assertTrue(stream.memory.peak > 0)
+
+    def test_spill(self):
+        node = AggregateNode(keys=["key"], measures=["amount"])
+        stream = self.create_stream(node)
+        stream.run(memory_limit="1M")
+
+        self.assertTrue(node.memory.spills > 0)
+        self.assertEqual(1000, len(self.target.rows))
+        # Rows are in order of the first row of their key
+        self.assertEqual(range(0, 1000), [row[0] for row in self.target.rows])
+        sums = dict((row[0], row[1]) for row in self.target.rows)
+        self.assertEqual(sum(range(5, 20000, 1000)), sums[5])
+
+    def test_exceeded(self):
+        node = SampleNode(size=20000, method="random")
+        stream = self.create_stream(node)
+        try:
+            stream.run(memory_limit="1M")
+        except MemoryBudgetExceeded as e:
+            self.assertEqual("process", e.owner)
+        else:
+            self.fail("MemoryBudgetExceeded not raised")
+
+if __name__ == '__main__':
+    unittest.main()
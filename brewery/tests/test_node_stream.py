@@ -6,7 +6,12 @@ from brewery import ds
 import unittest
 import logging
 import time
+import threading
+import warnings
 import StringIO
+import tempfile
+import shutil
+import os
 
 from brewery.streams import *
 from brewery.nodes import *
@@ -69,6 +74,39 @@ class StreamBuildingTestCase(unittest.TestCase):
         self.stream.connect("html_target", "source")
         self.assertRaises(Exception, self.stream.sorted_nodes)
         
+    def test_neighbours(self):
+        self.assertEqual(set([self.node2, self.node3]),
+                         set(self.stream.node_targets("source")))
+        self.assertEqual([self.node1], self.stream.node_sources(self.node3))
+
+        self.stream.rename_node(self.node3, "sampler")
+        self.assertEqual("sampler", self.stream.node_name(self.node3))
+        self.assertRaises(ValueError, self.stream.rename_node, self.node3, "source")
+
+        self.stream.remove("sampler")
+        self.assertEqual([self.node2], self.stream.node_targets("source"))
+        self.assertEqual([], self.stream.node_sources("html_target"))
+
+        self.stream.remove_connection("source", "csv_target")
+        self.assertEqual(0, len(self.stream.connections))
+
+    def test_large_sort(self):
+        stream = Stream()
+        nodes = [Node() for i in range(0, 5000)]
+        for node in reversed(nodes):
+            stream.add(node)
+        for source, target in zip(nodes, nodes[1:]):
+            stream.connect(source, target)
+
+        start = time.time()
+        self.assertEqual(nodes, stream.sorted_nodes())
+        self.assertTrue(time.time() - start < 1.0)
+
+        # Order is cached until the stream is changed
+        self.assertTrue(stream._sorted_nodes is not None)
+        stream.connect(nodes[-1], nodes[0])
+        self.assertRaises(Exception, stream.sorted_nodes)
+
     def test_update(self):
         nodes = {
                 "source": {"type": "row_list_source"},
@@ -117,6 +155,64 @@ class SlowSourceNode(Node):
                 self.put([i])
             time.sleep(0.05)
         
+class SlowInitSourceNode(RowListSourceNode):
+    """Source node with slow initialization and finalization. Start and end
+    of both are recorded in `events` list, initialization waits for other
+    nodes at `barrier` if it is given."""
+    node_info = {}
+    def __init__(self, rows, fields, fail=False, events=None, barrier=None):
+        super(SlowInitSourceNode, self).__init__(rows, fields)
+        self.fail = fail
+        self.finalized = False
+        self.events = events if events is not None else []
+        self.barrier = barrier
+
+    def initialize(self):
+        self.events.append(("initialize", self))
+        if self.barrier:
+            self.barrier.wait()
+        else:
+            time.sleep(0.2)
+        self.events.append(("initialized", self))
+        if self.fail:
+            raise Exception("Initialization failed")
+
+    def finalize(self):
+        self.events.append(("finalize", self))
+        time.sleep(0.2)
+        self.finalized = True
+
+class EventTargetNode(RowListTargetNode):
+    """Target recording its finalization in `events` list"""
+    node_info = {}
+    def __init__(self, events):
+        super(EventTargetNode, self).__init__()
+        self.events = events
+
+    def finalize(self):
+        self.events.append(("finalize", self))
+        super(EventTargetNode, self).finalize()
+
+class Barrier(object):
+    """Blocks callers of `wait()` until `count` of them are waiting. `met` is
+    ``False`` if the callers gave up after `timeout`."""
+    def __init__(self, count, timeout=10):
+        self.count = count
+        self.timeout = timeout
+        self.waiting = 0
+        self.met = False
+        self.condition = threading.Condition()
+
+    def wait(self):
+        end = time.time() + self.timeout
+        with self.condition:
+            self.waiting += 1
+            if self.waiting >= self.count:
+                self.met = True
+                self.condition.notify_all()
+            while not self.met and time.time() < end:
+                self.condition.wait(end - time.time())
+
 class StreamInitializationTestCase(unittest.TestCase):
     def setUp(self):
         # Stream we have here:
@@ -218,7 +314,268 @@ class StreamInitializationTestCase(unittest.TestCase):
         stream = Stream(nodes, connections)
 
         self.assertRaises(StreamRuntimeError, stream.run)
-    
+
+    def test_profile(self):
+        nodes = {
+            "source": SlowSourceNode(),
+            "target": RowListTargetNode()
+        }
+        stream = Stream(nodes, [("source", "target")])
+        stream.run(profile=True)
+
+        profiler = stream.profiler
+        source = stream.node("source")
+        self.assertTrue(profiler.stats(source) is not None)
+        self.assertIn("run", profiler.report(source))
+
+        stacks = profiler.collapsed_stacks(source, root="source")
+        self.assertTrue(stacks)
+        self.assertTrue(stacks[0].startswith("source;run (test_node_stream.py"))
+
+        names = [item[0] for item in profiler.summary()]
+        self.assertEqual(set(["source", "target"]), set(names))
+
+        directory = tempfile.mkdtemp()
+        try:
+            profiler.write_reports(directory)
+            files = os.listdir(directory)
+            for name in ["source.txt", "source.prof", "source.folded",
+                         "target.folded", "stream.folded"]:
+                self.assertIn(name, files)
+        finally:
+            shutil.rmtree(directory)
+
+        stream.run()
+        self.assertEqual(None, stream.profiler)
+
+    def test_early_stop_batches(self):
+        # Sample stops reading, source sending batches finishes
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "data.csv")
+            with open(path, "w") as handle:
+                handle.write("id,name\n")
+                for i in range(0, 20000):
+                    handle.write("%d,name %d\n" % (i, i))
+
+            # Sequential and parallel parsing, sample ends within a range
+            for options in [{}, {"processes": 2, "range_size": 15000}]:
+                nodes = {
+                    "source": CSVSourceNode(path, **options),
+                    "sample": SampleNode(size=1500),
+                    "target": RowListTargetNode()
+                }
+                stream = Stream(nodes, [("source", "sample"), ("sample", "target")])
+                thread = threading.Thread(target=stream.run)
+                thread.daemon = True
+                thread.start()
+                thread.join(60)
+                self.assertFalse(thread.is_alive())
+                self.assertEqual(1500, len(nodes["target"].rows))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_stall_abort(self):
+        # Append node reads inputs sequentially, the second branch fills its
+        # buffers and blocks the source: source -> map -> append -> source
+        rows = [[i] for i in range(0, 10000)]
+        nodes = {
+            "source": RowListSourceNode(rows, brewery.FieldList(["i"])),
+            "map": FieldMapNode(),
+            "append": AppendNode(),
+            "target": RowListTargetNode()
+        }
+        connections = [
+            ("source", "append"),
+            ("source", "map"),
+            ("map", "append"),
+            ("append", "target")
+        ]
+        stream = Stream(nodes, connections)
+        # Make sure that the direct connection is the first input of append
+        stream.sorted_nodes = lambda: [nodes["source"], nodes["append"],
+                                       nodes["map"], nodes["target"]]
+
+        try:
+            stream.run(stall_timeout=0.3, abort_on_stall=True)
+        except StreamStallError as e:
+            self.assertEqual(1, len(e.cycles))
+            self.assertEqual(set(["source", "map", "append"]),
+                             set(stream.node_name(n) for n in e.cycles[0]))
+            self.assertIn("deadlock", e.report)
+            self.assertIn("waiting to send to 'map'", e.report)
+            self.assertIn("thread stacks", e.report)
+            with warnings.catch_warnings():
+                warnings.simplefilter("error", DeprecationWarning)
+                self.assertTrue(str(e).endswith(e.report))
+        else:
+            self.fail("StreamStallError not raised")
+
+        self.assertTrue(stream.stall_report)
+
+    def test_no_stall(self):
+        nodes = {
+            "source": SlowSourceNode(),
+            "target": RowListTargetNode()
+        }
+        stream = Stream(nodes, [("source", "target")])
+        stream.run(stall_timeout=0.3, abort_on_stall=True)
+        self.assertEqual(None, stream.stall_report)
+        self.assertEqual(10000, len(stream.node("target").list))
+
+    def test_parallel_initialize(self):
+        events = []
+        barrier = Barrier(4)
+        nodes = {"append": AppendNode(), "map": FieldMapNode(),
+                 "target": EventTargetNode(events)}
+        connections = [("append", "map"), ("map", "target")]
+        sources = []
+        for i in range(0, 4):
+            source = SlowInitSourceNode(self.src_list, self.fields, events=events,
+                                        barrier=barrier)
+            nodes["source%d" % i] = source
+            sources.append(source)
+            connections.append(("source%d" % i, "append"))
+        stream = Stream(nodes, connections)
+
+        # All sources are being initialized at once
+        stream.run()
+        self.assertTrue(barrier.met)
+        self.assertEqual(12, len(nodes["target"].rows))
+
+        # Target is finalized before its sources
+        finalized = [node for (event, node) in events if event == "finalize"]
+        self.assertEqual(nodes["target"], finalized[0])
+        self.assertEqual(set(sources), set(finalized[1:]))
+
+        source_stats = stream.stats["nodes"]["source1"]
+        self.assertTrue("initialize_time" in source_stats)
+        self.assertTrue(source_stats["finalize_time"] > 0)
+        self.assertTrue("run_time" in stream.stats["nodes"]["target"])
+        self.assertTrue(stream.stats["run_time"] >= 0)
+
+        # Serial initialization: each source ends before the next one starts
+        for source in sources:
+            source.barrier = None
+        del events[:]
+        stream.run(init_workers=1)
+        initialization = [event for (event, node) in events
+                                if event.startswith("initialize")]
+        self.assertEqual(["initialize", "initialized"] * 4, initialization)
+
+    def test_initialize_fail(self):
+        nodes = {
+            "source": SlowInitSourceNode(self.src_list, self.fields, fail=True),
+            "other": SlowInitSourceNode(self.src_list, self.fields),
+            "map": FieldMapNode(),
+            "target": RowListTargetNode()
+        }
+        connections = [("source", "map"), ("other", "map"), ("map", "target")]
+        stream = Stream(nodes, connections)
+
+        self.assertRaisesRegexp(Exception, "Initialization failed", stream.run)
+        self.assertFalse("map" in stream.stats["nodes"])
+
+        # All nodes are finalized, even if one of them fails
+        stream._finalize()
+        nodes["target"].finalize = nodes["source"].initialize
+        self.assertRaisesRegexp(Exception, "Initialization failed", stream._finalize)
+        self.assertTrue(nodes["other"].finalized)
+
+    def test_iter_rows(self):
+        rows = list(self.stream.iter_rows("map"))
+        self.assertEqual([[1, 2, "a"], [4, 5, "b"], [7, 8, "a"]], rows)
+
+        # Other targets are fed as well
+        self.assertEqual(3, len(self.stream.node("target").list))
+        self.assertEqual(2, len(self.stream.node("aggtarget").list))
+
+    def test_iter_batches(self):
+        stream = Stream({"source": SlowSourceNode()}, [])
+        batches = list(stream.iter_batches("source", batch_size=100))
+        self.assertEqual(100, len(batches))
+        self.assertEqual(100, len(batches[0]))
+        self.assertEqual(["i"], stream.node("source").output_fields.names())
+
+    def test_iter_cancel(self):
+        source = SlowSourceNode()
+        nodes = {
+            "source": source,
+            "target": RowListTargetNode()
+        }
+        stream = Stream(nodes, [("source", "target")])
+
+        rows = stream.iter_rows("source")
+        for i in range(0, 10):
+            rows.next()
+        rows.close()
+
+        self.assertTrue(all(pipe.closed() for pipe in stream.pipes))
+        self.assertTrue(len(stream.node("target").list) < 10000)
+
+    def test_iter_fail(self):
+        nodes = {
+            "source": RowListSourceNode(self.src_list, self.fields),
+            "fail": FailNode()
+        }
+        stream = Stream(nodes, [("source", "fail")])
+
+        self.assertRaisesRegexp(StreamRuntimeError, "This is fail node",
+                                list, stream.iter_rows("fail"))
+        self.assertRaises(TypeError, list, stream.iter_rows("source", foo=1))
+
+    def test_explain(self):
+        plan = self.stream.explain()
+
+        names = [node.name for node in plan.nodes]
+        self.assertEqual("source", names[0])
+        self.assertTrue(names.index("sample") < names.index("map"))
+
+        node = plan.node("map")
+        self.assertEqual(['a', 'b', 'str'], node.fields)
+        self.assertEqual("streaming", node.mode)
+        self.assertEqual("thread", node.backend)
+        self.assertEqual(3, node.estimated_rows)
+
+        node = plan.node("aggregate")
+        self.assertEqual("blocking", node.mode)
+        self.assertTrue(node.estimated_memory > 0)
+        self.assertEqual(['str', 'record_count'], plan.node("aggtarget").fields)
+
+        # Nothing was run
+        self.assertEqual([], self.stream.node("target").list)
+        self.assertTrue("aggregate" in str(plan))
+        self.assertEqual(5, len(plan.to_dict()["pipes"]))
+
+        plan = self.stream.explain(initialize=False, scheduler="cooperative",
+                                   workers=2)
+        self.assertEqual(None, plan.node("map").fields)
+        self.assertEqual("worker 0", plan.nodes[0].backend)
+        self.assertEqual("worker 1", plan.nodes[-1].backend)
+
+    def test_explain_analyze(self):
+        plan = self.stream.explain(analyze=True)
+        self.assertTrue(plan.analyzed)
+        self.assertEqual(3, len(self.stream.node("target").list))
+
+        actual = plan.node("aggregate").actual
+        self.assertEqual(3, actual["rows_in"])
+        self.assertEqual(2, actual["rows_out"])
+        self.assertTrue(actual["run_time"] >= 0)
+        self.assertEqual(2, plan.node("aggtarget").actual["rows_in"])
+        self.assertTrue("spills" in str(plan))
+
+    def test_explain_fail(self):
+        nodes = {
+            "source": SlowInitSourceNode(self.src_list, self.fields, fail=True),
+            "map": FieldMapNode(),
+            "target": RowListTargetNode()
+        }
+        stream = Stream(nodes, [("source", "map"), ("map", "target")])
+        plan = stream.explain()
+        self.assertTrue("Initialization failed" in plan.node("source").notes[0])
+        self.assertEqual(None, plan.node("map").fields)
+
 class StreamConfigurationTestCase(unittest.TestCase):
     def test_create_node(self):
         self.assertEqual(RowListSourceNode, type(create_node("row_list_source")))
@@ -64,6 +64,22 @@ class NodesTestCase(unittest.TestCase):
         self.assertNotIn("source", d)
         self.assertNotIn("aggregate_node", d)
 
+    def test_node_catalogue_cache(self):
+        catalogue = brewery.nodes.node_catalogue()
+        self.assertIs(brewery.nodes.base._node_catalogue,
+                      brewery.nodes.base._get_node_catalogue())
+        self.assertNotIn("cache_test", catalogue)
+
+        # Defining a node class resets the catalogue
+        class CacheTestNode(brewery.nodes.Node):
+            node_info = {}
+        self.assertIn("cache_test", brewery.nodes.node_catalogue())
+        self.assertEqual(CacheTestNode, brewery.nodes.node_dictionary()["cache_test"])
+
+        catalogue["aggregate"]["label"] = "changed"
+        self.assertNotEqual("changed", brewery.nodes.node_catalogue()["aggregate"].get("label"))
+        self.assertRaises(KeyError, brewery.nodes.create_node, "no_such_node")
+
     def test_sample_node_first_n(self):
         node = brewery.nodes.SampleNode(size = 5, discard_sample = False, method = 'first')
         self.setup_node(node)
@@ -58,6 +58,31 @@ class PipeTestCase(unittest.TestCase):
         src.join()
         self.assertEqual(self.processed_count, 1000)
 
+    def test_put_many(self):
+        self.pipe = streams.Pipe(buffer_size = 10)
+
+        def source():
+            self.pipe.put(0)
+            for start in range(1, 1000, 333):
+                self.pipe.put_many(range(start, min(start + 333, 1000)))
+            self.pipe.done_sending()
+
+        src = threading.Thread(target=source)
+        src.start()
+        rows = list(self.pipe.rows())
+        src.join()
+        self.assertEqual(range(0, 1000), rows)
+
+    def test_put_many_closed(self):
+        # Receiver closed the pipe, rows are discarded
+        self.pipe = streams.Pipe(buffer_size = 10)
+        self.pipe.put_many(range(0, 5))
+        self.pipe.done_receiving()
+        self.pipe.put_many(range(0, 100))
+        self.pipe.put(0)
+        self.pipe.put_many(range(0, 100))
+        self.assertTrue(self.pipe.closed())
+
     def test_early_get_finish(self):
         self.pipe = streams.Pipe(buffer_size = 10)
         src = threading.Thread(target=self.source_function)
@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+import tempfile
+import shutil
+import os
+from decimal import Decimal
+import brewery
+import brewery.ds as ds
+
+from sqlalchemy import create_engine, MetaData, Table, Column, Integer, String
+from brewery.streams import *
+from brewery.nodes import *
+from brewery.planner import *
+
+def greater_than(value, threshold):
+    return value > threshold
+
+def in_range(value, low, high):
+    return low < value and value < high
+
+class PlannerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.url = "sqlite:///" + os.path.join(self.directory, "test.db")
+        engine = create_engine(self.url)
+        metadata = MetaData()
+        table = Table("data", metadata,
+                      Column("id", Integer),
+                      Column("name", String(20)),
+                      Column("region", String(20)),
+                      Column("amount", Integer))
+        metadata.create_all(engine)
+
+        self.rows = []
+        regions = ["north", "south", None]
+        for i in range(0, 30):
+            amount = None if i % 7 == 0 else i * 10
+            self.rows.append([i, u"item%d" % i, regions[i % 3], amount])
+        engine.execute(table.insert(), [dict(zip(["id", "name", "region", "amount"], row))
+                                        for row in self.rows])
+        self.engine = engine
+
+    def tearDown(self):
+        self.engine.dispose()
+        shutil.rmtree(self.directory)
+
+    def test_node_predicates(self):
+        node = SetSelectNode("region", ["north", "south"])
+        self.assertEqual(Comparison("region", "in", ["north", "south"]),
+                         node_predicate(node))
+        node.discard = True
+        self.assertEqual(Comparison("region", "not in", ["north", "south"]),
+                         node_predicate(node))
+
+        node = FunctionSelectNode(greater_than, ["amount"], threshold=100)
+        self.assertEqual(Comparison("amount", ">", 100), node_predicate(node))
+        node = FunctionSelectNode(lambda v: 100 >= v, ["amount"])
+        self.assertEqual(Comparison("amount", "<=", 100), node_predicate(node))
+
+        # Boolean operators are not traceable
+        node = FunctionSelectNode(in_range, ["amount"], low=1, high=10)
+        self.assertEqual(None, node_predicate(node))
+        node = FunctionSelectNode(lambda v: v in (1, 2), ["amount"])
+        self.assertEqual(None, node_predicate(node))
+        node = FunctionSelectNode(lambda v: v.startswith("a"), ["name"])
+        self.assertEqual(None, node_predicate(node))
+
+        node = SelectNode(lambda amount, **record: amount < 5)
+        self.assertEqual(Comparison("amount", "<", 5), node_predicate(node))
+
+    def test_expressions(self):
+        predicate = expression_predicate("amount > 100 and region in ('north', None)")
+        self.assertEqual(And([Comparison("amount", ">", 100),
+                              Comparison("region", "in", ["north", None])]),
+                         predicate)
+
+        predicate = expression_predicate("not (1 < amount <= 10) or name is None")
+        self.assertEqual("(amount <= 1 or amount > 10) or name == None", str(predicate))
+
+        self.assertEqual(None, expression_predicate("amount > other"))
+        self.assertEqual(None, expression_predicate("len(name) > 3"))
+        self.assertEqual(None, expression_predicate("amount < None"))
+        self.assertEqual(None, expression_predicate("amount >"))
+
+    def test_mongo_query(self):
+        predicate = And([Comparison("amount", "<", 10),
+                         Comparison("region", "not in", ["north"])])
+        expected = {"$and": [{"$or": [{"amount": {"$lt": 10}}, {"amount": None}]},
+                             {"region": {"$nin": ["north"]}}]}
+        self.assertEqual(expected, predicate.mongo_query())
+
+    def test_null_semantics(self):
+        # Database filter should select the same rows as python
+        conditions = ["amount < 100", "amount <= 100", "amount > 100",
+                      "amount != 100", "amount == None", "amount != None",
+                      "region in ('north', None)", "region not in ('north',)",
+                      "region not in ('north', None)", "not (amount >= 50)",
+                      "region == 'south' or amount < 30"]
+        names = ["id", "name", "region", "amount"]
+        for condition in conditions:
+            expected = [row for row in self.rows
+                            if eval(condition, None, dict(zip(names, row)))]
+            source = ds.SQLDataSource(url=self.url, table="data")
+            self.assertTrue(source.push_predicate(expression_predicate(condition)))
+            rows = [list(row) for row in source.rows()]
+            source.finalize()
+            self.assertEqual(expected, rows, "condition: %s" % condition)
+
+    def create_stream(self, select, field_map=None):
+        nodes = {
+            "source": SQLSourceNode(url=self.url, table="data"),
+            "select": select,
+            "target": RowListTargetNode()
+        }
+        connections = [("source", "select")]
+        if field_map:
+            nodes["map"] = field_map
+            connections += [("select", "map"), ("map", "target")]
+        else:
+            connections.append(("select", "target"))
+        return Stream(nodes, connections)
+
+    def test_pushdown(self):
+        stream = self.create_stream(SelectNode("amount >= 250"),
+                                    FieldMapNode(keep_fields=["name", "id"]))
+        stream.run(optimize=True)
+        self.assertTrue(stream.node("select").pushed_down)
+        self.assertEqual(["id", "name"],
+                         stream.node("source").output_fields.names())
+        expected = [[25, "item25"], [26, "item26"], [27, "item27"], [29, "item29"]]
+        self.assertEqual(expected, stream.node("target").rows)
+
+        plan = stream.explain(optimize=True)
+        self.assertEqual(["performed by the source node"], plan.node("select").notes)
+        self.assertTrue("pushed down filter: amount >= 250" in plan.node("source").notes)
+
+        # Same result without pushdown, which is the default
+        stream.run()
+        self.assertFalse(stream.node("select").pushed_down)
+        self.assertEqual(4, len(stream.node("source").output_fields))
+        self.assertEqual(expected, stream.node("target").rows)
+
+    def test_fallback(self):
+        # Field used by the python filter is read from the database
+        select = FunctionSelectNode(lambda name: name.endswith("5"), ["name"])
+        stream = self.create_stream(select, FieldMapNode(drop_fields=["name", "region"]))
+        stream.run(optimize=True)
+
+        self.assertFalse(select.pushed_down)
+        self.assertEqual(["id", "name", "amount"],
+                         stream.node("source").output_fields.names())
+        self.assertEqual([[5, 50], [15, 150], [25, 250]], stream.node("target").rows)
+
+    def test_aggregation(self):
+        aggregate = AggregateNode(keys=["region"], measures=["amount", "id"])
+        stream = self.create_stream(SetSelectNode("region", ["north", None]))
+        stream.add(aggregate, "aggregate")
+        stream.remove_connection("select", "target")
+        stream.connect("select", "aggregate")
+        stream.connect("aggregate", "target")
+
+        stream.run(optimize=True)
+        self.assertTrue(aggregate.pushed_down)
+        names = ["region", "amount_sum", "amount_min", "amount_max", "amount_average",
+                 "id_sum", "id_min", "id_max", "id_average", "record_count"]
+        self.assertEqual(names, stream.node("source").output_fields.names())
+        pushed = sorted(list(row) for row in stream.node("target").rows)
+
+        # Decimals returned by some databases are converted
+        convert = stream.node("source").stream._aggregation_converter()
+        row = [u"north", Decimal("1410"), 20, 290L, Decimal("156.6667"),
+               Decimal("155"), 2, 29, Decimal("15.5"), 10L]
+        self.assertEqual([int, int, int, float, int, int, int, float, int],
+                         [type(value) for value in convert(row)[1:]])
+
+        stream.run()
+        self.assertFalse(aggregate.pushed_down)
+        self.assertEqual(names, aggregate.output_fields.names())
+        expected = sorted(stream.node("target").rows)
+
+        self.assertEqual(expected, pushed)
+        self.assertEqual([type(value) for value in expected[0]],
+                         [type(value) for value in pushed[0]])
+        # Empty amount of id 14 is ignored
+        self.assertEqual([None, 1410, 20, 290, 1410 / 9.0, 155, 2, 29, 15.5, 10],
+                         expected[0])
+
+        plan = stream.explain(optimize=True)
+        self.assertEqual("streaming", plan.node("aggregate").mode)
+        self.assertTrue("pushed down aggregation: amount, id by region"
+                        in plan.node("source").notes)
+
+    def test_aggregation_no_keys(self):
+        stream = self.create_stream(SelectNode("id > 100"))
+        stream.add(AggregateNode(measures=["amount"]), "aggregate")
+        stream.remove_connection("select", "target")
+        stream.connect("select", "aggregate")
+        stream.connect("aggregate", "target")
+
+        stream.run(optimize=True)
+        self.assertEqual([], stream.node("target").rows)
+
+        stream.node("select").condition = "id < 3"
+        stream.run(optimize=True)
+        self.assertEqual([[30, 10, 20, 15.0, 3]],
+                         [list(row) for row in stream.node("target").rows])
+
+    def test_csv_projection(self):
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            "data", "test.csv")
+        fields = brewery.FieldList(["id", "name", "type", "location.name",
+                                    "location.code", ["amount", "integer"]])
+        nodes = {
+            "source": CSVSourceNode(path, fields=fields),
+            "aggregate": AggregateNode(keys=["type"], measures=["amount"]),
+            "target": RowListTargetNode()
+        }
+        stream = Stream(nodes, [("source", "aggregate"), ("aggregate", "target")])
+        stream.run(optimize=True)
+
+        self.assertEqual(["type", "amount"],
+                         stream.node("source").output_fields.names())
+        rows = sorted(list(row) for row in stream.node("target").rows)
+        self.assertEqual([u"fruit", 70, 10, 40, 70 / 3.0, 3], rows[0])
+
+        stream.remove_connection("source", "aggregate")
+        stream.add(FieldMapNode(drop_fields=["location.name", "location.code"]),
+                   "map")
+        stream.connect("source", "map")
+        stream.connect("map", "aggregate")
+        stream.run(optimize=True)
+        self.assertEqual(["id", "name", "type", "amount"],
+                         stream.node("source").output_fields.names())
+        self.assertEqual(rows, sorted(list(row) for row in stream.node("target").rows))
+
+    def test_csv_select_projection(self):
+        # Filter is not pushed to the CSV source, its fields are still read
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            "data", "test.csv")
+        fields = brewery.FieldList(["id", "name", "type", "location.name",
+                                    "location.code", ["amount", "integer"]])
+        nodes = {
+            "source": CSVSourceNode(path, fields=fields),
+            "select": SelectNode("name != 'apple'"),
+            "aggregate": AggregateNode(keys=["type"], measures=["amount"]),
+            "target": RowListTargetNode()
+        }
+        stream = Stream(nodes, [("source", "select"), ("select", "aggregate"),
+                                ("aggregate", "target")])
+        stream.run(optimize=True)
+
+        self.assertFalse(stream.node("select").pushed_down)
+        self.assertEqual(["name", "type", "amount"],
+                         stream.node("source").output_fields.names())
+        rows = sorted(list(row) for row in stream.node("target").rows)
+        self.assertEqual([u"fruit", 60, 20, 40, 30.0, 2], rows[0])
+        self.assertEqual([u"vegetable", 290, 30, 80, 58.0, 5], rows[1])
+
+        stream.remove_connection("select", "aggregate")
+        stream.add(FieldMapNode(keep_fields=["type", "amount"]), "map")
+        stream.connect("select", "map")
+        stream.connect("map", "aggregate")
+        stream.run(optimize=True)
+        self.assertEqual(["name", "type", "amount"],
+                         stream.node("source").output_fields.names())
+        self.assertEqual(rows, sorted(list(row) for row in stream.node("target").rows))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import brewery
+import unittest
+import threading
+
+from brewery.streams import *
+from brewery.nodes import *
+from brewery.common import *
+from brewery.scheduler import *
+from test_node_stream import FailNode, SlowSourceNode
+
+class CooperativeSchedulerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.fields = brewery.FieldList(["i", "key"])
+        self.rows = [[i, i % 10] for i in range(0, 5000)]
+
+    def create_wide_stream(self, width):
+        # source ---+---> map ----> aggregate ----> target
+        #           +---> ... (width times)
+        nodes = {
+            "source": RowListSourceNode(self.rows, self.fields)
+        }
+        connections = []
+        for i in range(0, width):
+            nodes["map%d" % i] = FieldMapNode(map_fields={"i": "value"})
+            nodes["aggregate%d" % i] = AggregateNode(keys=["key"], measures=["value"])
+            nodes["target%d" % i] = RowListTargetNode()
+            connections += [("source", "map%d" % i),
+                            ("map%d" % i, "aggregate%d" % i),
+                            ("aggregate%d" % i, "target%d" % i)]
+
+        return Stream(nodes, connections)
+
+    def test_run(self):
+        width = 20
+        stream = self.create_wide_stream(width)
+
+        threads = []
+        original = CooperativeScheduler.start
+        def start(scheduler):
+            original(scheduler)
+            threads.append(threading.active_count())
+        CooperativeScheduler.start = start
+        try:
+            stream.run(scheduler="cooperative", workers=3)
+        finally:
+            CooperativeScheduler.start = original
+
+        # 61 nodes are run by 3 workers
+        self.assertTrue(threads[0] < 10)
+
+        self.assertTrue(all(isinstance(pipe, CooperativePipe) for pipe in stream.pipes))
+        expected = sum(range(3, 5000, 10))
+        for i in range(0, width):
+            rows = stream.node("target%d" % i).rows
+            self.assertEqual(10, len(rows))
+            self.assertEqual(expected, rows[3][1])
+            self.assertEqual(500, rows[3][-1])
+
+    def test_single_worker(self):
+        stream = self.create_wide_stream(3)
+        stream.run(scheduler="cooperative", workers=1)
+        self.assertEqual(10, len(stream.node("target2").rows))
+
+    def test_iter_rows(self):
+        stream = self.create_wide_stream(2)
+        rows = list(stream.iter_rows("map1", scheduler="cooperative", workers=2))
+        self.assertEqual(self.rows, rows)
+
+        rows = stream.iter_rows("map1", scheduler="cooperative")
+        rows.next()
+        rows.close()
+        self.assertTrue(all(pipe.closed() for pipe in stream.pipes))
+
+    def test_fail(self):
+        nodes = {
+            "source": SlowSourceNode(),
+            "fail": FailNode(),
+            "target": RowListTargetNode()
+        }
+        stream = Stream(nodes, [("source", "fail"), ("fail", "target")])
+        self.assertRaisesRegexp(StreamRuntimeError, "This is fail node",
+                                stream.run, scheduler="cooperative")
+
+    def test_stall_abort(self):
+        rows = [[i] for i in range(0, 10000)]
+        nodes = {
+            "source": RowListSourceNode(rows, brewery.FieldList(["i"])),
+            "map": FieldMapNode(),
+            "append": AppendNode(),
+            "target": RowListTargetNode()
+        }
+        connections = [("source", "append"), ("source", "map"),
+                       ("map", "append"), ("append", "target")]
+        stream = Stream(nodes, connections)
+        stream.sorted_nodes = lambda: [nodes["source"], nodes["append"],
+                                       nodes["map"], nodes["target"]]
+
+        try:
+            stream.run(scheduler="cooperative", workers=2,
+                       stall_timeout=0.3, abort_on_stall=True)
+        except StreamStallError as e:
+            self.assertEqual(1, len(e.cycles))
+            self.assertTrue("thread stacks" in e.report)
+        else:
+            self.fail("StreamStallError not raised")
+
+    def test_invalid_options(self):
+        stream = self.create_wide_stream(1)
+        self.assertRaises(StreamError, stream.run, scheduler="unknown")
+        self.assertRaises(StreamError, stream.run, scheduler="cooperative",
+                          profile=True)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,11 +2,18 @@
 import unittest
 import threading
 import time
+import tempfile
+import shutil
+import os
+import datetime
+import weakref
+import gc
 from brewery import ds
 import brewery.metadata
+import brewery.planner
 
-from sqlalchemy import Table, Column, Integer, String, Text
-from sqlalchemy import create_engine, MetaData
+from sqlalchemy import Table, Column, Integer, String, Text, Date
+from sqlalchemy import create_engine, MetaData, event
 
 class SQLStreamsTestCase(unittest.TestCase):
     def setUp(self):
@@ -92,4 +99,407 @@ class SQLStreamsTestCase(unittest.TestCase):
 
         c = stream.table.c["line_item"]
 
-        self.assertEqual(123, c.type.length)
\ No newline at end of file
+        self.assertEqual(123, c.type.length)
+
+    def create_numbers(self, count):
+        table = Table('numbers', self.metadata,
+                    Column('id', Integer, primary_key=True),
+                    Column('value', Integer)
+                )
+        self.metadata.create_all(self.engine)
+        self.engine.execute(table.insert(),
+                            [{"id": i, "value": i % 5} for i in range(count)])
+
+    def test_source_fetch(self):
+        self.create_numbers(23)
+
+        stream = ds.SQLDataSource(connection=self.engine, table="numbers")
+        self.assertEqual("cursor", stream.fetch_method())
+        expected = [list(row) for row in stream.rows()]
+        self.assertEqual(23, len(expected))
+
+        for fetch in ["cursor", "stream", "keyset"]:
+            stream = ds.SQLDataSource(connection=self.engine, table="numbers",
+                                      fetch=fetch, chunk_size=5)
+            self.assertEqual(fetch, stream.fetch_method())
+            self.assertEqual(expected, [list(row) for row in stream.rows()])
+
+        self.assertRaises(ValueError, ds.SQLDataSource, connection=self.engine,
+                          table="numbers", fetch="unknown")
+
+    def test_source_keyset_projection(self):
+        # Key column is not selected
+        self.create_numbers(23)
+        stream = ds.SQLDataSource(connection=self.engine, table="numbers",
+                                  fetch="keyset", chunk_size=5,
+                                  keep_fields=["value"])
+        values = [list(row) for row in stream.rows()]
+        self.assertEqual([[i % 5] for i in range(23)], values)
+
+    def test_source_partitions(self):
+        # Partitions are read by other threads, in-memory database is not
+        # shared between them
+        path = tempfile.mkdtemp()
+        try:
+            url = "sqlite:///" + os.path.join(path, "data.db")
+            self.engine = create_engine(url)
+            self.create_numbers(103)
+
+            for method in ["range", "hash"]:
+                stream = ds.SQLDataSource(url=url, table="numbers",
+                                          partition_column="id", partitions=4,
+                                          partition_method=method,
+                                          chunk_size=10)
+                self.assertEqual(4, len(stream.partition_clauses()))
+                ids = sorted(row[0] for row in stream.rows())
+                self.assertEqual(range(103), ids)
+
+            stream = ds.SQLDataSource(url=url, table="numbers",
+                                      partition_column="id", partitions=4,
+                                      ordered=True, chunk_size=10)
+            ids = [row[0] for row in stream.rows()]
+            self.assertEqual(range(103), ids)
+            self.assertEqual([25, 51, 76], stream.partition_bounds())
+
+            stream = ds.SQLDataSource(url=url, table="numbers",
+                                      partition_column="id", partitions=4,
+                                      partition_method="hash")
+            stream.push_predicate(brewery.planner.Comparison("value", "==", 1))
+            ids = sorted(row[0] for row in stream.rows())
+            self.assertEqual(range(1, 103, 5), ids)
+        finally:
+            shutil.rmtree(path)
+
+    def test_source_partition_dates(self):
+        table = Table('events', self.metadata,
+                    Column('day', Date),
+                    Column('value', Integer)
+                )
+        self.metadata.create_all(self.engine)
+        start = datetime.date(2012, 1, 1)
+        days = [start + datetime.timedelta(i) for i in range(40)]
+        self.engine.execute(table.insert(), [{"day": day} for day in days])
+
+        stream = ds.SQLDataSource(connection=self.engine, table="events",
+                                  partition_column="day", partitions=4)
+        bounds = stream.partition_bounds()
+        self.assertEqual([datetime.date(2012, 1, 10),
+                          datetime.date(2012, 1, 20),
+                          datetime.date(2012, 1, 30)], bounds)
+
+        stream = ds.SQLDataSource(connection=self.engine, table="events",
+                                  partition_column="day", partitions=4,
+                                  partition_method="hash")
+        self.assertRaises(ValueError, stream.partition_clauses)
+
+    def test_source_statement(self):
+        self.create_numbers(23)
+        statement = "SELECT id, value * 1.5 AS half, 'x' AS label " \
+                    "FROM numbers WHERE value = :value"
+        executed = []
+        def count_statement(conn, cursor, text, params, context, many):
+            if text.startswith("SELECT id, value"):
+                executed.append(text)
+        event.listen(self.engine, "before_cursor_execute", count_statement)
+
+        stream = ds.SQLDataSource(connection=self.engine, statement=statement,
+                                  params={"value": 2})
+        self.assertEqual(["id", "half", "label"], stream.fields.names())
+        self.assertEqual(["integer", "float", "string"],
+                         [f.storage_type for f in stream.fields])
+        rows = [list(row) for row in stream.rows()]
+        self.assertEqual([[i, 3.0, "x"] for i in range(2, 23, 5)], rows)
+        # Result read for the fields is passed by rows()
+        self.assertEqual(1, len(executed))
+
+        # Later rows() executes the statement again
+        self.assertEqual(5, len(list(stream.rows())))
+        self.assertEqual(2, len(executed))
+
+        self.assertFalse(stream.push_predicate(None))
+
+        stream = ds.SQLDataSource(connection=self.engine, statement=statement,
+                                  params={"value": 2}, keep_fields=["id"])
+        self.assertEqual(["id"], stream.fields.names())
+        self.assertEqual([[i] for i in range(2, 23, 5)],
+                         [list(row) for row in stream.rows()])
+
+    def test_source_statement_cache(self):
+        self.create_numbers(23)
+        path = tempfile.mkdtemp()
+        try:
+            checks = []
+            def check(engine):
+                checks.append(engine)
+                return len(checks) < 3 and "fresh" or "changed"
+
+            statement = "SELECT id FROM numbers WHERE value = :value"
+            stream = ds.SQLDataSource(connection=self.engine,
+                                      statement=statement, params={"value": 1},
+                                      cache=path, cache_check=check)
+            self.assertEqual(["integer"], [f.storage_type for f in stream.fields])
+            expected = [(i, ) for i in range(1, 23, 5)]
+
+            # Cached result is read although the table changes
+            self.engine.execute("DELETE FROM numbers")
+            self.assertEqual(expected, list(stream.rows()))
+
+            # Freshness token changes - statement is executed again
+            self.assertEqual([], list(stream.rows()))
+
+            # Different parameters are cached separately
+            stream = ds.SQLDataSource(connection=self.engine,
+                                      statement=statement, params={"value": 2},
+                                      cache=path, cache_ttl=0)
+            self.assertEqual([], list(stream.rows()))
+            self.assertEqual(["unknown"], [f.storage_type for f in stream.fields])
+
+            stream.cache.invalidate()
+            self.assertEqual([], os.listdir(path))
+
+            # Cache directory writable by others is not used
+            os.chmod(path, 0o777)
+            self.assertRaises(IOError, stream.rows)
+            os.chmod(path, 0o700)
+
+            # Default directory is private to the user
+            environ = dict(os.environ)
+            os.environ["XDG_CACHE_HOME"] = os.path.join(path, "home")
+            try:
+                stream = ds.SQLDataSource(connection=self.engine,
+                                          statement=statement, cache=True,
+                                          params={"value": 2})
+                self.assertEqual([], list(stream.rows()))
+            finally:
+                os.environ.clear()
+                os.environ.update(environ)
+            cache_path = os.path.join(path, "home", "brewery", "sql")
+            self.assertEqual(cache_path, stream.cache.path)
+            self.assertEqual(0o700, os.stat(cache_path).st_mode & 0o777)
+        finally:
+            shutil.rmtree(path)
+
+    def test_target_bulk(self):
+        rows = [[u"cat", u"Category", None, u"Sub", u"item %d" % i, 2012, i]
+                    for i in range(25)]
+        for method in ["dicts", "executemany", "multirow"]:
+            stream = ds.SQLDataTarget(connection=self.engine, table="test",
+                                      create=True, replace=True,
+                                      fields=self.fields, bulk=method,
+                                      buffer_size=10)
+            stream.initialize()
+            self.assertEqual(method, stream.bulk_method)
+            for row in rows[:-1]:
+                stream.append(row)
+            stream.append(dict(zip(self.fields.names(), rows[-1])))
+            stream.finalize()
+
+            result = self.engine.execute("SELECT * FROM test ORDER BY amount")
+            self.assertEqual(rows, [list(row) for row in result])
+
+        stream = ds.SQLDataTarget(connection=self.engine, table="test",
+                                  fields=self.fields)
+        stream.initialize()
+        self.assertEqual("multirow", stream.bulk_method)
+
+        stream = ds.SQLDataTarget(connection=self.engine, table="test",
+                                  fields=self.fields, bulk="copy")
+        self.assertRaises(ValueError, stream.initialize)
+        self.assertRaises(ValueError, ds.SQLDataTarget, connection=self.engine,
+                          table="test", bulk="unknown")
+
+    def test_target_commit_size(self):
+        stream = ds.SQLDataTarget(connection=self.engine, table="test",
+                                  create=True, fields=self.fields,
+                                  buffer_size=10, commit_size=20)
+        stream.initialize()
+        for i in range(15):
+            stream.append(self.example_row)
+        # One buffer is inserted, but not committed yet
+        self.assertEqual(10, stream._uncommitted)
+        stream.append_many([self.example_row] * 10)
+        self.assertEqual(0, stream._uncommitted)
+        stream.finalize()
+
+        count = self.engine.execute("SELECT COUNT(*) FROM test").scalar()
+        self.assertEqual(25, count)
+
+    def test_copy_text(self):
+        self.assertEqual("\\N", ds.sql_streams._copy_text(None))
+        self.assertEqual("f", ds.sql_streams._copy_text(False))
+        self.assertEqual("a\\tb\\nc\\\\", ds.sql_streams._copy_text("a\tb\nc\\"))
+        self.assertEqual("\xc4\x8d", ds.sql_streams._copy_text(u"\u010d"))
+        self.assertEqual("1234567.891234", ds.sql_streams._copy_text(1234567.891234))
+        self.assertEqual(0.1, float(ds.sql_streams._copy_text(0.1)))
+
+    def test_target_writers(self):
+        path = tempfile.mkdtemp()
+        try:
+            url = "sqlite:///" + os.path.join(path, "data.db")
+            engine = create_engine(url)
+            table = Table('loaded', self.metadata,
+                        Column('id', Integer, nullable=False),
+                        Column('name', String(32))
+                    )
+            self.metadata.create_all(engine)
+            fields = brewery.metadata.FieldList(["id", "name"])
+            rows = [[i, u"n%d" % (i % 7)] for i in range(200)]
+
+            def count():
+                return engine.execute("SELECT COUNT(*) FROM loaded").scalar()
+
+            for partition_field in [None, "name"]:
+                target = ds.SQLDataTarget(url=url, table="loaded", truncate=True,
+                                          fields=fields, writers=3,
+                                          buffer_size=20,
+                                          partition_field=partition_field)
+                target.initialize()
+                for row in rows:
+                    target.append(row)
+                target.flush()
+                target.finalize()
+                self.assertEqual(200, count())
+
+            # Staged rows are moved only by flush()
+            target = ds.SQLDataTarget(url=url, table="loaded", truncate=True,
+                                      fields=fields, writers=2, buffer_size=20,
+                                      commit="all")
+            target.initialize()
+            for row in rows:
+                target.append(row)
+            target.finalize()
+            self.assertEqual(200, count())
+            self.assertEqual(["loaded"], engine.table_names())
+
+            # Failed writer - target table is not changed
+            target = ds.SQLDataTarget(url=url, table="loaded", truncate=True,
+                                      fields=fields, writers=2, buffer_size=20,
+                                      commit="all")
+            target.initialize()
+            for row in rows:
+                target.append(row)
+            target.append([None, u"fail"])
+            self.assertRaises(Exception, target.flush)
+            target.finalize()
+            self.assertEqual(200, count())
+            self.assertEqual(["loaded"], engine.table_names())
+        finally:
+            shutil.rmtree(path)
+
+    def test_target_upsert(self):
+        fields = brewery.metadata.FieldList([("id", "integer"),
+                                             ("name", "string"),
+                                             ("amount", "integer")])
+        rows = [[i, u"n%d" % i, i] for i in range(10)]
+        changes = [[2, u"changed", None], [3, u"n3", 3], [12, u"new", 1],
+                   [12, u"new", 2], [4, u"n4", 40]]
+        expected = [list(row) for row in rows] + [[12, u"new", 2]]
+        expected[2] = [2, u"changed", None]
+        expected[4] = [4, u"n4", 40]
+
+        for method in ["on_conflict", "staging"]:
+            stream = ds.SQLDataTarget(connection=self.engine, table="upsert",
+                                      create=True, replace=True, fields=fields,
+                                      mode="upsert", keys=["id"],
+                                      upsert_method=method, buffer_size=4)
+            stream.initialize()
+            self.assertEqual(method, stream.upsert_method)
+            for row in rows:
+                stream.append(row)
+            stream.flush()
+
+            before = self.engine.execute("SELECT total_changes()").scalar()
+            for row in changes:
+                stream.append(row)
+            stream.finalize()
+            after = self.engine.execute("SELECT total_changes()").scalar()
+
+            result = self.engine.execute("SELECT * FROM upsert ORDER BY id")
+            self.assertEqual(expected, [list(row) for row in result])
+            self.assertEqual(["upsert"], self.engine.table_names())
+            if method == "on_conflict":
+                # Unchanged row 3 is not written
+                self.assertEqual(3, after - before)
+
+        self.assertRaises(ValueError, ds.SQLDataTarget, connection=self.engine,
+                          table="upsert", mode="upsert")
+        stream = ds.SQLDataTarget(connection=self.engine, table="upsert",
+                                  mode="upsert", keys=["id"], bulk="dicts")
+        self.assertRaises(ValueError, stream.initialize)
+
+    def test_target_upsert_staged(self):
+        # Rows with the same key in more buffers, the latest row is merged
+        path = tempfile.mkdtemp()
+        try:
+            url = "sqlite:///" + os.path.join(path, "data.db")
+            engine = create_engine(url)
+            fields = brewery.metadata.FieldList([("id", "integer"),
+                                                 ("name", "string")])
+            for method in ["on_conflict", "staging"]:
+                target = ds.SQLDataTarget(url=url, table="upsert", create=True,
+                                          replace=True, fields=fields,
+                                          mode="upsert", keys=["id"])
+                target.initialize()
+                target.append_many([[1, u"a"], [2, u"b"]])
+                target.finalize()
+
+                target = ds.SQLDataTarget(url=url, table="upsert", fields=fields,
+                                          mode="upsert", keys=["id"],
+                                          upsert_method=method, commit="all",
+                                          buffer_size=2)
+                target.initialize()
+                for row in [[2, u"x"], [3, u"y"], [2, u"LAST"], [3, u"z"],
+                            [4, u"new"], [4, u"newest"]]:
+                    target.append(row)
+                target.flush()
+                target.finalize()
+
+                result = engine.execute("SELECT * FROM upsert ORDER BY id")
+                self.assertEqual([[1, u"a"], [2, u"LAST"], [3, u"z"], [4, u"newest"]],
+                                 [list(row) for row in result])
+                self.assertEqual(["upsert"], engine.table_names())
+            engine.dispose()
+        finally:
+            shutil.rmtree(path)
+
+    def test_shared_engine(self):
+        path = tempfile.mkdtemp()
+        try:
+            url = "sqlite:///" + os.path.join(path, "data.db")
+            self.engine = create_engine(url)
+            self.create_numbers(5)
+
+            first = ds.SQLDataSource(url=url, table="numbers")
+            second = ds.SQLDataSource(url=url, table="numbers")
+            self.assertTrue(first.context.metadata.bind is second.context.metadata.bind)
+            self.assertTrue(first.table is second.table)
+
+            # Replaced table is reflected again
+            target = ds.SQLDataTarget(url=url, table="numbers", create=True,
+                                      replace=True, fields=self.fields)
+            target.initialize()
+            target.finalize()
+            third = ds.SQLDataSource(url=url, table="numbers")
+            self.assertEqual(self.fields.names(), third.fields.names())
+
+            ds.clear_sql_caches()
+            fourth = ds.SQLDataSource(url=url, table="numbers")
+            self.assertFalse(fourth.context.metadata.bind is first.context.metadata.bind)
+        finally:
+            shutil.rmtree(path)
+
+    def test_reflected_engine_collected(self):
+        # Tables reflected from an engine of the caller do not keep it alive
+        count = len(ds.sql_streams._reflected)
+        engine = create_engine("sqlite://")
+        engine.execute("CREATE TABLE numbers (id INTEGER)")
+        table = ds.reflected_table(engine, "numbers")
+        self.assertEqual(["id"], table.c.keys())
+        self.assertTrue(engine in ds.sql_streams._reflected)
+
+        reference = weakref.ref(engine)
+        del engine
+        gc.collect()
+        self.assertEqual(None, reference())
+        self.assertEqual(count, len(ds.sql_streams._reflected))
+
@@ -4,6 +4,7 @@
 """Brewery handy utilities"""
 
 import re
+import sys
 import logging
 
 logger_name = 'brewery'
@@ -60,6 +61,46 @@ class MissingPackage(object):
         raise Exception("Optional package '%s' is not installed. Please install the package%s%s%s" % 
                             (self.package, source, use, comment))
 
+class LazyModule(object):
+    """Proxy of a module which is imported on first attribute access. Used for optional packages
+    of data stream backends, so that importing brewery does not import all the backends. If the
+    module can not be imported, attribute access raises the same exception as
+    :class:`MissingPackage`.
+
+    `module` might be a dotted name, then the top-level package is returned as with the
+    ``import`` statement: ``LazyModule("gdata.spreadsheet.text_db").spreadsheet.text_db``.
+    """
+
+    def __init__(self, module, feature = None, source = None, comment = None, package = None):
+        self.__dict__["_lazy_name"] = module
+        self.__dict__["_lazy_missing"] = MissingPackage(package or module.split(".")[0],
+                                                        feature, source, comment)
+        self.__dict__["_lazy_module"] = None
+
+    def _load(self):
+        module = self.__dict__["_lazy_module"]
+        if module is None:
+            try:
+                module = __import__(self._lazy_name)
+            except ImportError:
+                module = self._lazy_missing
+            self.__dict__["_lazy_module"] = module
+        return module
+
+    def is_available(self):
+        """Returns ``True`` if the module can be imported."""
+        return not isinstance(self._load(), MissingPackage)
+
+    def is_loaded(self):
+        """Returns ``True`` if the module was already imported."""
+        return self._lazy_name in sys.modules
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __repr__(self):
+        return "<lazy module '%s'>" % self._lazy_name
+
 class IgnoringDictionary(dict):
     """Simple dictionary extension that will ignore any keys of which values are empty (None/False)"""
     def setnoempty(self, key, value):
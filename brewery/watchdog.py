@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""Stall and deadlock detection for running streams.
+
+Stream nodes run in threads and exchange data through pipes with limited
+buffers. A node waiting for data that never comes (or for a buffer that is
+never consumed) blocks the whole stream forever. The :class:`StreamWatchdog`
+watches progress of all pipes of a running stream. When there is no progress
+for a configured time, it creates a report with state of each node, buffer
+occupancy of each pipe, cycles of nodes waiting for each other (deadlocks)
+and stacks of node threads. Optionally the stream is aborted.
+"""
+
+import threading
+import traceback
+import time
+import sys
+from brewery.utils import get_logger
+
+__all__ = [
+    "StreamWatchdog",
+    "waiting_cycles"
+]
+
+class StreamWatchdog(threading.Thread):
+    """Thread watching progress of a running stream."""
+
+    def __init__(self, stream, threads, stall_timeout, abort=False):
+        """Creates a stream watchdog.
+
+        :Parameters:
+            * `stream` - initialized stream being run
+            * `threads` - list of (`thread`, `node`) tuples of the running
+              stream
+            * `stall_timeout` - number of seconds without any progress in the
+              stream pipes after which the stream is considered stalled
+            * `abort` - if ``True``, then stalled stream is aborted: all pipes
+              are closed, so the waiting nodes are released.
+
+        After stall is detected, the report is stored in the `report`
+        attribute and `stalled` is set to ``True``.
+        """
+
+        super(StreamWatchdog, self).__init__(name="brewery-watchdog")
+        self.daemon = True
+
+        self.stream = stream
+        self.threads = threads
+        self.stall_timeout = stall_timeout
+        self.abort = abort
+        self.check_interval = min(1.0, stall_timeout / 4.0)
+
+        self.stalled = False
+        self.aborted = False
+        self.report = None
+        self.cycles = []
+
+        self.logger = get_logger()
+        self._stopped = threading.Event()
+
+    def stop(self):
+        """Stop watching the stream."""
+        self._stopped.set()
+
+    def run(self):
+        last_progress = time.time()
+        last_state = None
+
+        while not self._stopped.is_set():
+            self._stopped.wait(self.check_interval)
+            if self._stopped.is_set():
+                break
+
+            state = self._progress_state()
+            now = time.time()
+            if state != last_state:
+                last_state = state
+                last_progress = now
+                continue
+
+            idle = now - last_progress
+            if idle >= self.stall_timeout and not self.stalled:
+                self.stalled = True
+                self.cycles = waiting_cycles(self._waits_for())
+                self.report = self.create_report(idle)
+                self.logger.warn(self.report)
+
+                if self.abort:
+                    self.logger.info("aborting stalled stream")
+                    self.aborted = True
+                    self.stream.kill_threads()
+                    break
+
+    def _progress_state(self):
+        """Return a tuple that changes whenever anything in the stream moves:
+        activity time of each pipe and number of finished threads."""
+        pipe_state = tuple(pipe.last_activity for pipe in self.stream.pipes)
+        finished = len([t for t, node in self.threads if not t.is_alive()])
+        return (pipe_state, finished)
+
+    def node_state(self, node):
+        """Return tuple (`state`, `pipe`) for `node` where state is one of:
+        ``finished``, ``sending`` (waiting for an output buffer to be
+        consumed), ``receiving`` (waiting for input data) or ``running``.
+        `pipe` is the pipe the node is waiting for."""
+
+        for thread, thread_node in self.threads:
+            if thread_node is node and not thread.is_alive():
+                return ("finished", None)
+
+        for pipe in node.outputs:
+            if pipe.sender_waiting:
+                return ("sending", pipe)
+        for pipe in node.inputs:
+            if pipe.receiver_waiting:
+                return ("receiving", pipe)
+
+        return ("running", None)
+
+    def _waits_for(self):
+        """Return wait-for graph as a dictionary where keys are nodes and
+        values are nodes they are waiting for."""
+        waits = {}
+        ends = self.stream.pipe_ends
+        for thread, node in self.threads:
+            (state, pipe) = self.node_state(node)
+            if state == "sending":
+                waits[node] = ends[pipe][1]
+            elif state == "receiving":
+                waits[node] = ends[pipe][0]
+        return waits
+
+    def create_report(self, idle):
+        """Create a text report about state of the stream."""
+
+        ends = self.stream.pipe_ends
+
+        def name(node):
+            # Pipes without target node are read by stream iterators
+            return self.stream.node_name(node) if node else "(iterator)"
+
+        lines = ["stream stalled: no progress for %.1f s" % idle]
+
+        if self.cycles:
+            for cycle in self.cycles:
+                names = [name(node) for node in cycle + [cycle[0]]]
+                lines.append("deadlock: nodes waiting in cycle: %s"
+                             % " -> ".join(names))
+        else:
+            lines.append("no cycle of waiting nodes found")
+
+        lines.append("nodes:")
+        for thread, node in self.threads:
+            (state, pipe) = self.node_state(node)
+            if state == "sending":
+                detail = "waiting to send to '%s'" % name(ends[pipe][1])
+            elif state == "receiving":
+                detail = "waiting to receive from '%s'" % name(ends[pipe][0])
+            else:
+                detail = state
+            lines.append("    %s (%s): %s" % (name(node), node.identifier(), detail))
+
+        lines.append("pipes:")
+        now = time.time()
+        for pipe in self.stream.pipes:
+            (source, target) = ends[pipe]
+            lines.append("    %s -> %s: staged %d/%d, ready %d, sent %d, "
+                         "closed: %s, idle %.1f s"
+                         % (name(source), name(target),
+                            len(pipe.staging_buffer), pipe.buffer_size,
+                            pipe.ready_count(), pipe.rows_sent,
+                            "yes" if pipe.closed() else "no",
+                            now - pipe.last_activity))
+
+        lines.append("thread stacks:")
+        frames = sys._current_frames()
+        for thread, node in self.threads:
+            if hasattr(thread, "frame"):
+                # Node run by the cooperative scheduler
+                frame = thread.frame()
+            else:
+                frame = frames.get(thread.ident)
+            if frame is None:
+                continue
+            lines.append("    node %s:" % name(node))
+            for entry in traceback.format_stack(frame):
+                for line in entry.rstrip().split("\n"):
+                    lines.append("        " + line)
+
+        return "\n".join(lines)
+
+def waiting_cycles(waits):
+    """Find cycles in a wait-for graph `waits` - a dictionary where keys are
+    waiting objects and values are objects they wait for. Returns list of
+    cycles, each cycle is a list of objects."""
+
+    cycles = []
+    visited = set()
+
+    for start in waits:
+        path = []
+        on_path = {}
+        current = start
+        while current in waits and current not in visited:
+            visited.add(current)
+            on_path[current] = len(path)
+            path.append(current)
+            current = waits[current]
+
+        if current in on_path:
+            cycles.append(path[on_path[current]:])
+
+    return cycles
@@ -0,0 +1,160 @@
+"""
+Data Brewery - http://databrewery.org
+
+Benchmark: typed CSV reading.
+
+Generates a CSV file with integer, float, string, date and boolean columns
+and reads it with the CSV data source - row by row, in batches, memory
+mapped, only two of the columns and in parallel worker processes - and with
+the previous reader implementation, which recoded every line and converted
+values in a Python loop. Lines alone are read from the file and from the
+memory mapped file as well. Use a bigger file with:
+
+    python csv_read.py --rows 20000000 --encoding latin-1 --processes 8
+
+Parallel reading pays for sending parsed rows between processes, it is
+faster only with more CPUs than the consumer of the rows needs.
+
+"""
+
+import argparse
+import codecs
+import csv
+import os
+import tempfile
+import time
+
+import brewery
+import brewery.ds as ds
+
+fields = brewery.FieldList([("id", "integer"), ("name", "string"),
+                            ("amount", "float"), ("day", "date"),
+                            ("flag", "boolean"), ("note", "string")])
+
+def generate(path, count, encoding):
+    with codecs.open(path, "w", encoding=encoding) as handle:
+        handle.write(u",".join(fields.names()) + u"\n")
+        for i in xrange(count):
+            handle.write(u"%d,n\u00e1me %d,%.2f,2012-%02d-%02d,%s,%s\n" %
+                         (i, i % 100, i * 0.25, i % 12 + 1, i % 28 + 1,
+                          "true" if i % 2 else "false",
+                          "" if i % 3 else u"note"))
+
+class PreviousReader(object):
+    """Reader as it was implemented before: each line is decoded and encoded
+    to UTF-8 again, each value is converted in a Python loop."""
+
+    def __init__(self, f, encoding):
+        if encoding:
+            f = codecs.getreader(encoding)(f)
+            lines = (line.encode("utf-8") for line in f)
+        else:
+            lines = f
+        self.reader = csv.reader(lines)
+        # Header
+        self.reader.next()
+        converters = {"integer": int, "float": float}
+        self.converters = [converters.get(f.storage_type) for f in fields]
+
+    def __iter__(self):
+        for row in self.reader:
+            result = []
+            for i, value in enumerate(row):
+                f = self.converters[i]
+                if f:
+                    result.append(f(value))
+                else:
+                    value = unicode(value, "utf-8")
+                    result.append(value or None)
+            yield result
+
+def read_previous(path, encoding):
+    with open(path) as handle:
+        return sum(1 for row in PreviousReader(handle, encoding))
+
+def read_file_lines(path, encoding):
+    with open(path, "rb") as handle:
+        return sum(1 for line in handle)
+
+def read_mapped_lines(path, encoding):
+    with ds.base.MappedFile(path) as handle:
+        return sum(1 for line in handle)
+
+def read_rows(path, encoding):
+    source = ds.CSVDataSource(path, encoding=encoding, fields=fields)
+    source.initialize()
+    count = sum(1 for row in source.rows())
+    source.finalize()
+    return count
+
+def read_batches(path, encoding):
+    source = ds.CSVDataSource(path, encoding=encoding, fields=fields)
+    source.initialize()
+    count = sum(len(rows) for rows in source.batches())
+    source.finalize()
+    return count
+
+def read_mapped(path, encoding):
+    source = ds.CSVDataSource(path, encoding=encoding, fields=fields,
+                              mapped=True)
+    source.initialize()
+    count = sum(len(rows) for rows in source.batches())
+    source.finalize()
+    return count
+
+def read_projected(path, encoding):
+    source = ds.CSVDataSource(path, encoding=encoding, fields=fields,
+                              keep_fields=["id", "amount"])
+    source.initialize()
+    count = sum(len(rows) for rows in source.batches())
+    source.finalize()
+    return count
+
+def read_parallel(path, encoding, processes):
+    source = ds.CSVDataSource(path, encoding=encoding, fields=fields,
+                              processes=processes, range_size=4*1024*1024)
+    source.initialize()
+    count = sum(len(rows) for rows in source.batches())
+    source.finalize()
+    return count
+
+def main():
+    parser = argparse.ArgumentParser(description="CSV reading benchmark")
+    parser.add_argument("--rows", type=int, default=500000)
+    parser.add_argument("--encoding", default="utf-8")
+    parser.add_argument("--file", help="use existing generated file")
+    parser.add_argument("--processes", type=int, default=4,
+                        help="number of processes of parallel reading")
+    args = parser.parse_args()
+
+    path = args.file
+    if not path:
+        (fd, path) = tempfile.mkstemp(suffix=".csv")
+        os.close(fd)
+        generate(path, args.rows, args.encoding)
+
+    size = os.path.getsize(path) / (1024.0 * 1024.0)
+    print "file: %s (%.1f MB, %s)" % (path, size, args.encoding)
+
+    try:
+        parallel = lambda path, encoding: read_parallel(path, encoding,
+                                                        args.processes)
+        for name, function in [("lines", read_file_lines),
+                               ("map lines", read_mapped_lines),
+                               ("previous", read_previous),
+                               ("rows", read_rows),
+                               ("batches", read_batches),
+                               ("mapped", read_mapped),
+                               ("projected", read_projected),
+                               ("parallel", parallel)]:
+            start = time.time()
+            count = function(path, args.encoding)
+            elapsed = time.time() - start
+            print "%-10s %8.2f s %10.0f rows/s %8.1f MB/s" % \
+                    (name, elapsed, count / elapsed, size / elapsed)
+    finally:
+        if not args.file:
+            os.remove(path)
+
+if __name__ == "__main__":
+    main()
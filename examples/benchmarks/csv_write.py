@@ -0,0 +1,105 @@
+"""
+Data Brewery - http://databrewery.org
+
+Benchmark: CSV writing.
+
+Writes rows with integer, unicode string, float, date and boolean values
+with the CSV data target - row by row and in batches - and with the previous
+writer implementation, which encoded, decoded and re-encoded every row and
+wrote it to the file immediately. Use more rows or other encoding with:
+
+    python csv_write.py --rows 5000000 --encoding latin-1
+
+"""
+
+import argparse
+import codecs
+import cStringIO
+import csv
+import datetime
+import os
+import tempfile
+import time
+
+import brewery
+import brewery.ds as ds
+
+fields = brewery.FieldList(["id", "name", "amount", "day", "flag"])
+
+def generate(count):
+    day = datetime.date(2012, 1, 1)
+    return [[i, u"n\u00e1me %d" % (i % 100), i * 0.25, day, bool(i % 2)]
+                for i in xrange(count)]
+
+class PreviousWriter(object):
+    """Writer as it was implemented before: each row is written to a queue,
+    read back, decoded, encoded and written to the file."""
+
+    def __init__(self, f, encoding):
+        self.queue = cStringIO.StringIO()
+        self.writer = csv.writer(self.queue)
+        self.stream = f
+        self.encoder = codecs.getincrementalencoder(encoding)()
+
+    def writerow(self, row):
+        new_row = []
+        for value in row:
+            if type(value) == unicode or type(value) == str:
+                new_row.append(value.encode("utf-8"))
+            elif value is not None:
+                new_row.append(unicode(value))
+            else:
+                new_row.append(None)
+
+        self.writer.writerow(new_row)
+        data = self.queue.getvalue()
+        data = data.decode("utf-8")
+        data = self.encoder.encode(data)
+        self.stream.write(data)
+        self.queue.truncate(0)
+
+def write_previous(path, rows, encoding):
+    with open(path, "w") as handle:
+        writer = PreviousWriter(handle, encoding)
+        for row in rows:
+            writer.writerow(row)
+
+def write_rows(path, rows, encoding):
+    target = ds.CSVDataTarget(path, fields=fields, encoding=encoding)
+    target.initialize()
+    for row in rows:
+        target.append(row)
+    target.finalize()
+
+def write_batches(path, rows, encoding):
+    target = ds.CSVDataTarget(path, fields=fields, encoding=encoding)
+    target.initialize()
+    for i in xrange(0, len(rows), 1000):
+        target.append_many(rows[i:i + 1000])
+    target.finalize()
+
+def main():
+    parser = argparse.ArgumentParser(description="CSV writing benchmark")
+    parser.add_argument("--rows", type=int, default=500000)
+    parser.add_argument("--encoding", default="utf-8")
+    args = parser.parse_args()
+
+    rows = generate(args.rows)
+    (fd, path) = tempfile.mkstemp(suffix=".csv")
+    os.close(fd)
+
+    try:
+        for name, function in [("previous", write_previous),
+                               ("rows", write_rows),
+                               ("batches", write_batches)]:
+            start = time.time()
+            function(path, rows, args.encoding)
+            elapsed = time.time() - start
+            size = os.path.getsize(path) / (1024.0 * 1024.0)
+            print "%-10s %8.2f s %10.0f rows/s %8.1f MB/s" % \
+                    (name, elapsed, len(rows) / elapsed, size / elapsed)
+    finally:
+        os.remove(path)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+Data Brewery - http://databrewery.org
+
+Benchmark: bulk insert methods of the SQL data target.
+
+Inserts generated rows into a SQLite database file with each bulk insert
+method and prints rows per second. Use another database with:
+
+    python sql_bulk_load.py --url postgresql://localhost/test --rows 1000000
+
+"""
+
+import argparse
+import datetime
+import os
+import tempfile
+import time
+
+import brewery
+import brewery.ds as ds
+
+fields = brewery.FieldList([("id", "integer"), ("name", "string"),
+                            ("amount", "float"), ("day", "date"),
+                            ("note", "text")])
+
+def generate(count):
+    start = datetime.date(2012, 1, 1)
+    for i in xrange(count):
+        yield [i, u"name %d" % (i % 100), i * 0.5,
+               start + datetime.timedelta(i % 365), None]
+
+def load(url, method, count, buffer_size, commit_size):
+    target = ds.SQLDataTarget(url=url, table="bulk_load", create=True,
+                              replace=True, fields=fields, bulk=method,
+                              buffer_size=buffer_size, commit_size=commit_size)
+    target.initialize()
+    start = time.time()
+    for row in generate(count):
+        target.append(row)
+    target.flush()
+    elapsed = time.time() - start
+    target.finalize()
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description="SQL bulk insert benchmark")
+    parser.add_argument("--url", help="database URL, default is a temporary "
+                                      "SQLite file")
+    parser.add_argument("--rows", type=int, default=200000)
+    parser.add_argument("--buffer-size", type=int, default=1000)
+    parser.add_argument("--commit-size", type=int, default=None)
+    parser.add_argument("methods", nargs="*",
+                        default=["dicts", "executemany", "multirow", "auto"])
+    args = parser.parse_args()
+
+    path = None
+    url = args.url
+    if not url:
+        (fd, path) = tempfile.mkstemp(suffix=".sqlite")
+        os.close(fd)
+        url = "sqlite:///" + path
+
+    try:
+        for method in args.methods:
+            elapsed = load(url, method, args.rows, args.buffer_size,
+                           args.commit_size)
+            print "%-12s %8.2f s %10.0f rows/s" % (method, elapsed,
+                                                   args.rows / elapsed)
+    finally:
+        if path:
+            os.remove(path)
+
+if __name__ == "__main__":
+    main()